@@ -10,6 +10,11 @@ from ..core.database import get_db
 from .auth import get_current_user
 from ..models.user import User
 from ..services.ai_service import ai_service, get_current_rate_info
+from ..services.context_cache import context_cache
+from ..services.near_duplicate import near_duplicate_index
+from ..core.key_pool import openrouter_keys, replicate_keys
+from ..core.user_slots import user_slots
+from ..core.config import settings as app_settings
 
 router = APIRouter(prefix="/admin", tags=["Admin"])
 
@@ -815,6 +820,7 @@ async def delete_user(
         await db.execute(text("UPDATE admin_logs SET target_user_id = NULL WHERE target_user_id = :user_id"), {"user_id": user_id})
         await db.execute(text("DELETE FROM users WHERE id = :user_id"), {"user_id": user_id})
         await db.commit()
+        await context_cache.invalidate_user(user_id)
 
         await db.execute(text("INSERT INTO admin_logs (admin_id, action, details, created_at) VALUES (:admin_id, :action, :details, NOW())"), {"admin_id": current_user.id, "action": "delete_user", "details": json.dumps({"deleted_username": username, "deleted_user_id": user_id})})
         await db.commit()
@@ -824,6 +830,30 @@ async def delete_user(
         await db.rollback()
         raise HTTPException(status_code=500, detail="Ошибка: " + str(e))
 
+@router.get("/cache/near-duplicates")
+async def get_near_duplicate_report(
+    limit: int = Query(50, ge=1, le=200),
+    admin: User = Depends(require_admin)
+):
+    """Отчёт по кэшу почти одинаковых промптов: доля попаданий и примеры совпадений"""
+    return await near_duplicate_index.report(limit)
+
+@router.get("/upstream-keys")
+async def get_upstream_keys(admin: User = Depends(require_admin)):
+    """Ключи OpenRouter и Replicate: вес, состояние и расход по каждому (без самих ключей)"""
+    return {"pools": [await openrouter_keys.status(), await replicate_keys.status()]}
+
+@router.get("/user-concurrency")
+async def get_user_concurrency(
+    user_id: Optional[int] = Query(None),
+    admin: User = Depends(require_admin)
+):
+    """Генерации, которые сейчас выполняются у пользователей, и лимиты по полосам"""
+    return {
+        "in_flight": await user_slots.in_flight(user_id),
+        "limits": app_settings.USER_CONCURRENCY_LIMITS
+    }
+
 # === System Settings ===
 
 @router.get("/settings")
@@ -942,13 +972,26 @@ async def cleanup_old_messages(
 
     # Используем параметризованный запрос для защиты от SQL injection
     result = await db.execute(
-        text("DELETE FROM messages WHERE created_at < NOW() - INTERVAL '1 day' * :days RETURNING id"),
+        text("""
+            WITH deleted AS (
+                DELETE FROM messages WHERE created_at < NOW() - INTERVAL '1 day' * :days
+                RETURNING id, conversation_id
+            ), counted AS (
+                UPDATE conversations c
+                SET message_count = GREATEST(c.message_count - d.removed, 0)
+                FROM (SELECT conversation_id, COUNT(*) AS removed FROM deleted GROUP BY conversation_id) d
+                WHERE c.id = d.conversation_id
+            )
+            SELECT id FROM deleted
+        """),
         {"days": days}
     )
     deleted = len(result.fetchall())
 
     await log_admin_action(db, admin.id, "cleanup_messages", None, {"days": days, "deleted": deleted}, request.client.host if request.client else None)
     await db.commit()
+    if deleted:
+        await context_cache.invalidate_all()
 
     return {"success": True, "deleted_messages": deleted}
 
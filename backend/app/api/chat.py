@@ -1,20 +1,37 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Request, Response, status
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, func, text
-from sqlalchemy.orm import selectinload
-from typing import List
-from datetime import date
-
-from ..core.database import get_db
+from sqlalchemy import select, func, text, tuple_, update
+from typing import List, Optional
+from datetime import date, datetime
+import asyncio
+import json
+import logging
+
+from ..core.database import AsyncSessionLocal, get_db, release_connection, upstream_call, track_round_trips
+from ..core.http import UpstreamUnavailable
+from ..core.admission import admission_control, AdmissionTicket
+from ..core.scheduler import set_request_lane
+from ..core.disconnect import ClientDisconnected, CLIENT_CLOSED_REQUEST, cancel_on_disconnect, record_cancelled
+from ..core.idempotency import run_idempotent
 from ..models.user import User
 from ..models.conversation import Conversation, Message, MessageRole, AIModel
 from ..schemas.conversation import (
     ConversationCreate, ConversationResponse, ConversationListResponse,
-    ChatRequest, ChatResponse, MessageResponse, ConversationUpdate
+    ChatRequest, ChatResponse, MessageResponse, MessagePageResponse, ConversationUpdate
 )
 from ..api.auth import get_current_user
-from ..services.ai_service import ai_service, prepare_multimodal_message, extract_text_from_document
+from ..services.ai_service import ai_service, usage_cost_usd, prepare_multimodal_message, extract_text_from_document
+from ..services.currency_service import currency_service
 from ..services.file_service import UPLOAD_DIR, supports_vision, supports_documents
+from ..services.tokenizer import token_counter
+from ..services.context_budget import context_budgeter
+from ..services.prompt_builder import build_prompt
+from ..services.context_cache import context_cache, context_entry, CONTEXT_WINDOW
+from ..services.billing_service import billing_service, budget_from_row, check_budget, BudgetError
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter(tags=["Chat"])
 
@@ -36,28 +53,56 @@ async def create_conversation(
     return new_conversation
 
 
+def _make_cursor(timestamp: datetime, row_id: int) -> str:
+    """Курсор keyset-пагинации: время и id последней отданной строки"""
+    return f"{timestamp.isoformat()}_{row_id}"
+
+
+def _parse_cursor(cursor: str):
+    try:
+        timestamp, row_id = cursor.rsplit("_", 1)
+        return datetime.fromisoformat(timestamp), int(row_id)
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid cursor"
+        )
+
+
 @router.get("/conversations", response_model=List[ConversationListResponse])
 async def get_conversations(
+    response: Response,
+    cursor: Optional[str] = Query(None, description="X-Next-Cursor из предыдущей страницы"),
+    limit: int = Query(100, ge=1, le=200),
     current_user: User = Depends(get_current_user),
     db: AsyncSession = Depends(get_db)
 ):
-    result = await db.execute(
-        select(Conversation)
+    """Диалоги пользователя, новые сверху. Курсор следующей страницы - в заголовке X-Next-Cursor"""
+    query = (
+        select(
+            Conversation.id,
+            Conversation.title,
+            Conversation.ai_model,
+            Conversation.created_at,
+            Conversation.updated_at,
+            Conversation.message_count
+        )
         .where(Conversation.user_id == current_user.id)
-        .order_by(Conversation.updated_at.desc())
+        .order_by(Conversation.updated_at.desc(), Conversation.id.desc())
+        .limit(limit)
     )
-    conversations = result.scalars().all()
-
-    response = []
-    for conv in conversations:
-        msg_count = await db.scalar(
-            select(func.count(Message.id)).where(Message.conversation_id == conv.id)
+    if cursor:
+        updated_at, conversation_id = _parse_cursor(cursor)
+        query = query.where(
+            tuple_(Conversation.updated_at, Conversation.id) < tuple_(updated_at, conversation_id)
         )
-        response.append({
-            **conv.__dict__,
-            "message_count": msg_count or 0
-        })
-    return response
+
+    rows = (await db.execute(query)).mappings().all()
+
+    if len(rows) == limit:
+        last = rows[-1]
+        response.headers["X-Next-Cursor"] = _make_cursor(last["updated_at"], last["id"])
+    return rows
 
 
 @router.get("/conversations/{conversation_id}", response_model=ConversationResponse)
@@ -66,10 +111,9 @@ async def get_conversation(
     current_user: User = Depends(get_current_user),
     db: AsyncSession = Depends(get_db)
 ):
+    """Метаданные диалога; сообщения - постранично через /conversations/{id}/messages"""
     result = await db.execute(
-        select(Conversation)
-        .options(selectinload(Conversation.messages))
-        .where(
+        select(Conversation).where(
             Conversation.id == conversation_id,
             Conversation.user_id == current_user.id
         )
@@ -84,6 +128,72 @@ async def get_conversation(
     return conversation
 
 
+@router.get("/conversations/{conversation_id}/messages", response_model=MessagePageResponse)
+async def get_conversation_messages(
+    conversation_id: int,
+    before: Optional[str] = Query(None, description="next_cursor из предыдущей страницы"),
+    limit: int = Query(50, ge=1, le=200),
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Сообщения диалога страницами от новых к старым (внутри страницы - по времени).
+    Строки читаются напрямую, без ORM-объектов; владелец проверяется в том же запросе.
+    """
+    before_at, before_id = _parse_cursor(before) if before else (None, None)
+
+    result = await db.execute(
+        text("""
+            SELECT c.id AS owner_check, m.id, m.role, m.content, m.tokens_used, m.model_used, m.created_at
+            FROM conversations c
+            LEFT JOIN LATERAL (
+                SELECT id, lower(role::text) AS role, content, tokens_used, model_used, created_at
+                FROM messages
+                WHERE conversation_id = c.id
+                  AND (CAST(:before_at AS TIMESTAMP) IS NULL OR (created_at, id) < (:before_at, :before_id))
+                ORDER BY created_at DESC, id DESC
+                LIMIT :limit
+            ) m ON TRUE
+            WHERE c.id = :conversation_id AND c.user_id = :user_id
+        """),
+        {
+            "conversation_id": conversation_id,
+            "user_id": current_user.id,
+            "before_at": before_at,
+            "before_id": before_id,
+            "limit": limit
+        }
+    )
+    rows = result.mappings().all()
+
+    if not rows:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Conversation not found"
+        )
+
+    messages = [
+        {
+            "id": row["id"],
+            "conversation_id": conversation_id,
+            "role": row["role"],
+            "content": row["content"],
+            "tokens_used": row["tokens_used"] or 0,
+            "model_used": row["model_used"],
+            "created_at": row["created_at"]
+        }
+        for row in rows if row["id"] is not None
+    ]
+
+    next_cursor = None
+    if len(messages) == limit:
+        oldest = messages[-1]
+        next_cursor = _make_cursor(oldest["created_at"], oldest["id"])
+
+    messages.reverse()
+    return {"messages": messages, "next_cursor": next_cursor}
+
+
 @router.patch("/conversations/{conversation_id}", response_model=ConversationResponse)
 async def update_conversation(
     conversation_id: int,
@@ -111,6 +221,7 @@ async def update_conversation(
         conversation.ai_model = AIModel(update_data.ai_model)
 
     await db.commit()
+    await context_cache.invalidate(current_user.id, conversation_id)
     await db.refresh(conversation)
     return conversation
 
@@ -137,157 +248,147 @@ async def delete_conversation(
 
     await db.delete(conversation)
     await db.commit()
+    await context_cache.invalidate(current_user.id, conversation_id)
 
 
-@router.post("/send", response_model=ChatResponse)
-async def send_message(
-    chat_request: ChatRequest,
-    current_user: User = Depends(get_current_user),
-    db: AsyncSession = Depends(get_db)
-):
-    # FIX: Сохраняем user_id для избежания двойного списания
-    user_id = current_user.id
-    
+async def _preflight(db: AsyncSession, chat_request: ChatRequest, user_id: int) -> dict:
+    """
+    Всё, что нужно до запроса к модели, одним обращением к БД:
+    бюджет пользователя, проверка владельца диалога и последние сообщения.
+    Если история диалога есть в Redis, сообщения из БД не читаются.
+    """
+    today = date.today()
+    cached_history = None
+    if chat_request.conversation_id:
+        cached_history = await context_cache.get(user_id, chat_request.conversation_id)
+
     result = await db.execute(
         text("""
-            SELECT balance, budget_period, budget_coins, daily_spent, daily_spent_date
-            FROM users WHERE id = :user_id
+            SELECT
+                u.balance, u.budget_period, u.budget_coins,
+                CASE WHEN u.daily_spent_date = :today THEN COALESCE(u.daily_spent, 0) ELSE 0 END AS daily_spent,
+                c.id AS conversation_id, c.title, c.message_count, c.summary, c.summary_upto_id, h.history
+            FROM users u
+            LEFT JOIN conversations c ON c.id = :conversation_id AND c.user_id = u.id
+            LEFT JOIN LATERAL (
+                SELECT json_agg(
+                    json_build_object('id', m.id, 'role', lower(m.role::text), 'content', m.content, 'tokens', m.tokens_used)
+                    ORDER BY m.created_at, m.id
+                ) AS history
+                FROM (
+                    SELECT id, role, content, tokens_used, created_at
+                    FROM messages
+                    WHERE conversation_id = c.id AND :load_history
+                    ORDER BY created_at DESC, id DESC
+                    LIMIT :history_window
+                ) m
+            ) h ON TRUE
+            WHERE u.id = :user_id
         """),
-        {"user_id": current_user.id}
+        {
+            "user_id": user_id,
+            "conversation_id": chat_request.conversation_id,
+            "history_window": CONTEXT_WINDOW,
+            "load_history": cached_history is None,
+            "today": today
+        }
     )
     row = result.fetchone()
-    current_balance = row[0] or 0
-    budget_period = row[1] or "none"
-    budget_coins = row[2] or 0
-    daily_spent = row[3] or 0
-    daily_spent_date = row[4]
-
-    today = date.today()
-    if daily_spent_date and daily_spent_date != today:
-        await db.execute(
-            text("UPDATE users SET daily_spent = 0, daily_spent_date = :today WHERE id = :user_id"),
-            {"today": today, "user_id": user_id}
-        )
-        daily_spent = 0
-
-    period_days_map = {"none": 0, "week": 7, "two_weeks": 14, "three_weeks": 21, "month": 30}
-    period_days = period_days_map.get(budget_period, 0)
-    daily_limit = budget_coins // period_days if period_days > 0 else 0
-
-    requested_model = chat_request.ai_model
-    if not requested_model or requested_model == "auto":
-        requested_model = "google/gemini-2.0-flash-001"
-
-    estimated_tokens = ai_service.estimate_tokens(chat_request.message) + 500
-    estimated_coins = ai_service.estimate_coins(requested_model, estimated_tokens, 500)
-
-    if current_balance <= 0:
-        raise HTTPException(
-            status_code=status.HTTP_402_PAYMENT_REQUIRED,
-            detail={
-                "error": "Недостаточно коинов. Пожалуйста, пополните баланс.",
-                "error_type": "no_balance",
-                "balance": current_balance,
-                "topup_url": "/pricing"
-            }
-        )
 
-    if current_balance < estimated_coins:
+    if chat_request.conversation_id and row.conversation_id is None:
         raise HTTPException(
-            status_code=status.HTTP_402_PAYMENT_REQUIRED,
-            detail={
-                "error": f"Недостаточно коинов. Нужно ~{estimated_coins}, у вас {current_balance}.",
-                "error_type": "low_balance",
-                "balance": current_balance,
-                "topup_url": "/pricing"
-            }
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Conversation not found"
         )
 
-    if budget_period != "none" and daily_limit > 0:
-        daily_remaining = daily_limit - daily_spent
-
-        if daily_spent >= daily_limit:
-            raise HTTPException(
-                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
-                detail={
-                    "error": f"Достигнут дневной лимит ({daily_limit} коинов). Попробуйте завтра.",
-                    "error_type": "daily_limit",
-                    "daily_limit": daily_limit,
-                    "daily_spent": daily_spent,
-                    "daily_remaining": 0,
-                    "settings_url": "/settings"
-                }
-            )
-
-        if daily_remaining < estimated_coins:
-            raise HTTPException(
-                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
-                detail={
-                    "error": f"Недостаточно коинов в дневном лимите. Осталось {daily_remaining}, нужно ~{estimated_coins}.",
-                    "error_type": "daily_limit",
-                    "daily_limit": daily_limit,
-                    "daily_spent": daily_spent,
-                    "daily_remaining": daily_remaining,
-                    "settings_url": "/settings"
-                }
-            )
+    if cached_history is not None:
+        history = cached_history
+    else:
+        history = row.history or []
+        if isinstance(history, str):
+            history = json.loads(history)
 
-    conversation_id = chat_request.conversation_id
-    existing_messages = []
+    return {
+        "budget": budget_from_row(row.balance, row.budget_period, row.budget_coins, row.daily_spent, today),
+        "conversation_id": row.conversation_id,
+        "title": row.title,
+        "history": history,
+        "history_cached": cached_history is not None,
+        "message_count": row.message_count or 0,
+        "summary": row.summary,
+        "summary_upto_id": row.summary_upto_id
+    }
 
-    if conversation_id:
-        conv_result = await db.execute(
-            select(Conversation)
-            .where(
-                Conversation.id == conversation_id,
-                Conversation.user_id == current_user.id
-            )
-        )
-        conversation = conv_result.scalar_one_or_none()
 
-        if not conversation:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="Conversation not found"
-            )
+async def _save_turn(
+    db: AsyncSession,
+    preflight: dict,
+    chat_request: ChatRequest,
+    user_id: int,
+    ai_response: dict,
+    sent_at: datetime
+):
+    """Создаёт диалог (если новый) и сохраняет пару сообщений пользователь/ассистент"""
+    conversation_id = preflight["conversation_id"]
+    title = chat_request.message[:50] + ("..." if len(chat_request.message) > 50 else "")
 
-        msgs_result = await db.execute(
-            select(Message)
-            .where(Message.conversation_id == conversation_id)
-            .order_by(Message.created_at.desc())
-            .limit(10)
-        )
-        existing_messages = list(reversed(msgs_result.scalars().all()))
-    else:
+    if conversation_id is None:
         conversation = Conversation(
-            user_id=current_user.id,
-            title="New Chat",
-            ai_model=AIModel.GPT4O
+            user_id=user_id,
+            title=title,
+            ai_model=AIModel.GPT4O,
+            message_count=2
         )
         db.add(conversation)
         await db.flush()
+        conversation_id = conversation.id
+    else:
+        values = {
+            "message_count": Conversation.message_count + 2,
+            "updated_at": func.now()
+        }
+        if preflight["title"] == "New Chat":
+            values["title"] = title
+        await db.execute(
+            update(Conversation)
+            .where(Conversation.id == conversation_id)
+            .values(**values)
+        )
 
     user_message = Message(
-        conversation_id=conversation.id,
+        conversation_id=conversation_id,
         role=MessageRole.USER,
         content=chat_request.message,
-        tokens_used=ai_service.estimate_tokens(chat_request.message)
+        tokens_used=ai_service.estimate_tokens(chat_request.message, ai_response["model"]),
+        created_at=sent_at
     )
-    db.add(user_message)
-    await db.flush()
-
-    # Системный промпт с текущей датой
-    from datetime import datetime
-    current_date = datetime.now().strftime("%d.%m.%Y")
-    system_prompt = f"""Ты — полезный AI-ассистент LANA. Сегодня {current_date}.
-Отвечай на языке пользователя. Будь точным, полезным и дружелюбным.
-Если не знаешь ответа — честно скажи об этом."""
-    messages_history = [{"role": "system", "content": system_prompt}]
-    for msg in existing_messages:
-        messages_history.append({
-            "role": msg.role.value,
-            "content": msg.content
-        })
+    assistant_message = Message(
+        conversation_id=conversation_id,
+        role=MessageRole.ASSISTANT,
+        content=ai_response["content"],
+        # Токены самого ответа, чтобы размер контекста считался суммой по сообщениям
+        tokens_used=ai_response["output_tokens"] or ai_service.estimate_tokens(ai_response["content"], ai_response["model"]),
+        model_used=ai_response["model"]
+    )
+    db.add_all([user_message, assistant_message])
+
+    return conversation_id, user_message, assistant_message
+
+
+async def _remember_turn(preflight: dict, user_id: int, conversation_id: int, user_message: Message, assistant_message: Message):
+    """Обновляет кэш контекста после сохранённого ответа"""
+    entries = [context_entry(user_message), context_entry(assistant_message)]
+    if preflight["history_cached"]:
+        await context_cache.append(user_id, conversation_id, entries)
+    else:
+        await context_cache.fill(user_id, conversation_id, preflight["history"] + entries)
+
+
+async def _build_messages_history(chat_request: ChatRequest, requested_model: str, context: dict) -> list:
+    """
+    Запрос к модели (см. prompt_builder.build_prompt): история в пределах
+    бюджета (context_budgeter.fit) + сообщение пользователя (с файлом, если есть)
+    """
     # Обработка файла если есть
     user_content = chat_request.message
     file_path = None
@@ -316,133 +417,137 @@ async def send_message(
     # Формируем сообщение пользователя
     if file_path and chat_request.file_type == "image":
         user_msg = await prepare_multimodal_message(chat_request.message, file_path)
-        messages_history.append(user_msg)
     else:
-        messages_history.append({
+        user_msg = {
             "role": "user",
             "content": user_content
-        })
+        }
 
-    try:
-        ai_response = await ai_service.send_message(
-            model=requested_model,
-            messages=messages_history
-        )
+    return build_prompt(
+        requested_model, context["history"], user_msg,
+        summary=context["summary"], history_complete=context["history_complete"]
+    )
 
-        coins_spent = ai_response["coins_spent"]
-        cost_usd = ai_response["cost_usd"]
-        usd_rate = ai_response["usd_rate"]
-
-        if current_balance < coins_spent:
-            await db.rollback()
-            raise HTTPException(
-                status_code=status.HTTP_402_PAYMENT_REQUIRED,
-                detail={
-                    "error": f"Недостаточно коинов. Нужно {coins_spent}, у вас {current_balance}.",
-                    "error_type": "low_balance",
-                    "balance": current_balance,
-                    "topup_url": "/pricing"
-                }
-            )
 
-        if budget_period != "none" and daily_limit > 0:
-            if (daily_spent + coins_spent) > daily_limit:
-                await db.rollback()
-                raise HTTPException(
-                    status_code=status.HTTP_429_TOO_MANY_REQUESTS,
-                    detail={
-                        "error": f"Превышен дневной лимит.",
-                        "error_type": "daily_limit",
-                        "daily_limit": daily_limit,
-                        "daily_spent": daily_spent,
-                        "settings_url": "/settings"
-                    }
-                )
+def _requested_model(chat_request: ChatRequest) -> str:
+    requested_model = chat_request.ai_model
+    if not requested_model or requested_model == "auto":
+        requested_model = "google/gemini-2.0-flash-001"
+    return requested_model
 
-        assistant_message = Message(
-            conversation_id=conversation.id,
-            role=MessageRole.ASSISTANT,
-            content=ai_response["content"],
-            tokens_used=ai_response["tokens_used"],
-            model_used=ai_response["model"]
-        )
-        db.add(assistant_message)
 
-        # Удаляем старые сообщения, оставляем последние 30
-        await db.execute(
-            text("""
-                DELETE FROM messages
-                WHERE conversation_id = :conv_id
-                AND id NOT IN (
-                    SELECT id FROM messages
-                    WHERE conversation_id = :conv_id
-                    ORDER BY created_at DESC
-                    LIMIT 30
-                )
-            """),
-            {"conv_id": conversation.id}
-        )
+# Ожидаемая длина ответа, пока в диалоге нет ответов ассистента
+DEFAULT_OUTPUT_TOKENS = 500
+MAX_OUTPUT_TOKENS = 4096
 
-        await db.execute(
-            text("""
-                UPDATE users SET
-                    balance = balance - :coins,
-                    daily_spent = daily_spent + :coins,
-                    daily_spent_date = :today
-                WHERE id = :user_id
-            """),
-            {"coins": coins_spent, "today": today, "user_id": user_id}
-        )
 
-        await db.execute(
-            text("""
-                INSERT INTO usage_logs (user_id, model_id, tokens_used, cost_rub, coins_spent)
-                VALUES (:user_id, :model_id, :tokens_used, :cost_rub, :coins_spent)
-            """),
-            {
-                "user_id": user_id,
-                "model_id": ai_response["model"],
-                "tokens_used": ai_response["tokens_used"],
-                "cost_rub": coins_spent / 100,
-                "coins_spent": coins_spent
-            }
-        )
+def _estimate_message_coins(chat_request: ChatRequest, requested_model: str, context: dict) -> int:
+    """
+    Оценка стоимости запроса для резерва: входные токены - сумма сохранённых
+    счётчиков истории плюс системный промпт и новое сообщение, выходные -
+    средняя длина прошлых ответов в диалоге.
+    """
+    history = context["history"]
+    prompt = build_prompt(requested_model, history, {"role": "user", "content": chat_request.message}, summary=context["summary"])
+    input_tokens = token_counter.count_messages(prompt, requested_model)
 
-        # Записываем транзакцию с себестоимостью для мониторинга
-        await db.execute(
-            text("""
-                INSERT INTO transactions (user_id, type, amount, balance_before, balance_after, description, model, tokens_used, cost_usd, usd_rate, source)
-                VALUES (:user_id, 'spend', :amount, :before, :after, :desc, :model, :tokens, :cost_usd, :usd_rate, :source)
-            """),
-            {
-                "user_id": user_id,
-                "amount": -coins_spent,
-                "before": current_balance,
-                "after": current_balance - coins_spent,
-                "desc": "AI сообщение",
-                "model": ai_response["model"],
-                "tokens": ai_response["tokens_used"],
-                "cost_usd": cost_usd,
-                "usd_rate": usd_rate,
-                "source": chat_request.source or "web"
-            }
+    # Без сохранённого счётчика (старые ответы, см. migration_messages_tokens_used.sql) - по тексту
+    answers = [
+        msg.get("tokens") or token_counter.count(msg["content"], requested_model)
+        for msg in history if msg["role"] == "assistant"
+    ]
+    output_tokens = sum(answers) // len(answers) if answers else DEFAULT_OUTPUT_TOKENS
+
+    return ai_service.estimate_coins(requested_model, input_tokens, min(output_tokens, MAX_OUTPUT_TOKENS))
+
+
+@router.post("/send", response_model=ChatResponse, dependencies=[Depends(admission_control("chat")), Depends(track_round_trips("chat_send"))])
+async def send_message(
+    chat_request: ChatRequest,
+    request: Request,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Сообщение в диалог. Повтор с тем же Idempotency-Key (клиент не дождался
+    ответа) возвращает первый результат - без второго запроса к модели и списания.
+    """
+    return await run_idempotent(
+        "chat", current_user.id, idempotency_key, chat_request.model_dump(), ChatResponse,
+        lambda: _send_message(chat_request, request, current_user, db)
+    )
+
+
+async def _send_message(chat_request: ChatRequest, request: Request, current_user: User, db: AsyncSession):
+    # FIX: Сохраняем user_id для избежания двойного списания
+    user_id = current_user.id
+    sent_at = datetime.utcnow()
+    set_request_lane(current_user, chat_request.source)
+
+    preflight = await _preflight(db, chat_request, user_id)
+    budget = preflight["budget"]
+    daily_limit = budget["daily_limit"]
+
+    requested_model = _requested_model(chat_request)
+    context = context_budgeter.fit(preflight, requested_model)
+    estimated_coins = _estimate_message_coins(chat_request, requested_model, context)
+
+    try:
+        check_budget(budget, estimated_coins)
+        reservation = await billing_service.reserve(db, user_id, estimated_coins, "chat")
+    except BudgetError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+
+    # Все чтения завершены, резерв поставлен — отдаём соединение в пул до ответа модели
+    await release_connection(db)
+
+    try:
+        messages_history = await _build_messages_history(chat_request, requested_model, context)
+
+        async with upstream_call(db, "chat"):
+            # Клиент ушёл - запрос к модели отменяется, резерв снимается ниже
+            ai_response = await cancel_on_disconnect(
+                request,
+                ai_service.send_message(
+                    model=requested_model,
+                    messages=messages_history,
+                    temperature=chat_request.temperature,
+                    use_cache=chat_request.use_cache
+                ),
+                "chat"
+            )
+
+        coins_spent = ai_response["coins_spent"]
+
+        # Короткая транзакция записи результата
+        conversation_id, user_message, assistant_message = await _save_turn(
+            db, preflight, chat_request, user_id, ai_response, sent_at
         )
 
-        if conversation.title == "New Chat":
-            conversation.title = chat_request.message[:50] + ("..." if len(chat_request.message) > 50 else "")
+        settled = await billing_service.settle(
+            db, reservation,
+            coins=coins_spent,
+            model=ai_response["model"],
+            tokens_used=ai_response["tokens_used"],
+            cost_usd=ai_response["cost_usd"],
+            usd_rate=ai_response["usd_rate"],
+            description="AI сообщение (из кэша)" if ai_response["cached"] else "AI сообщение",
+            source=chat_request.source
+        )
+        if settled is None:
+            await billing_service.abort(db, reservation)
+            await billing_service.raise_insufficient(db, user_id, coins_spent)
 
         await db.commit()
+        await _remember_turn(preflight, user_id, conversation_id, user_message, assistant_message)
+        context_budgeter.schedule_summary(conversation_id, context)
 
-        new_result = await db.execute(
-            text("SELECT balance, daily_spent FROM users WHERE id = :user_id"),
-            {"user_id": current_user.id}
-        )
-        new_row = new_result.fetchone()
-        new_balance = new_row[0] or 0
-        new_daily_spent = new_row[1] or 0
+        new_balance = settled["balance"]
+        new_daily_spent = settled["daily_spent"]
 
         return {
-            "conversation_id": conversation.id,
+            "conversation_id": conversation_id,
             "user_message": user_message,
             "assistant_message": assistant_message,
             "coins_spent": coins_spent,
@@ -452,16 +557,245 @@ async def send_message(
             "daily_remaining": max(0, daily_limit - new_daily_spent) if daily_limit > 0 else new_balance
         }
 
+    except BudgetError as e:
+        await billing_service.abort(db, reservation)
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    except ClientDisconnected:
+        await billing_service.abort(db, reservation)
+        raise HTTPException(status_code=CLIENT_CLOSED_REQUEST, detail="Client disconnected")
+    except UpstreamUnavailable as e:
+        await billing_service.abort(db, reservation)
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=e.detail,
+            headers={"Retry-After": str(e.retry_after_seconds)}
+        )
     except HTTPException:
+        await billing_service.abort(db, reservation)
         raise
     except Exception as e:
-        await db.rollback()
+        await billing_service.abort(db, reservation)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"AI service error: {str(e)}"
         )
 
 
+_background_tasks = set()
+
+
+def _spawn(coro) -> asyncio.Task:
+    """Фоновая задача, которую не отменит завершение запроса"""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_done)
+    return task
+
+
+def _background_done(task: asyncio.Task):
+    _background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Background task failed: {task.exception()!r}")
+
+
+async def _settle_cancelled_stream(reservation: dict, model: str, messages_history: list, partial: str, source: Optional[str]):
+    """
+    Поток прерван клиентом: провайдер уже посчитал отданные токены, поэтому
+    списывается оценка по полученной части ответа (без неё резерв просто снимается).
+    """
+    input_tokens = token_counter.count_messages(messages_history, model)
+    output_tokens = token_counter.count(partial, model) if partial else 0
+    record_cancelled("chat_stream", "stream", model=model, output_tokens=output_tokens)
+
+    try:
+        async with AsyncSessionLocal() as db:
+            if not output_tokens:
+                await billing_service.abort(db, reservation)
+                return
+            await billing_service.settle(
+                db, reservation,
+                coins=ai_service.estimate_coins(model, input_tokens, output_tokens),
+                model=model,
+                tokens_used=input_tokens + output_tokens,
+                cost_usd=usage_cost_usd({"prompt_tokens": input_tokens, "completion_tokens": output_tokens}, model),
+                usd_rate=currency_service.get_cached_rate(),
+                description="AI сообщение (прервано клиентом)",
+                source=source,
+                allow_overdraft=True
+            )
+            await db.commit()
+    except Exception as e:
+        # Резерв вернёт release_stale_holds
+        logger.error(f"Failed to settle cancelled stream: {e}")
+
+
+def _sse_event(payload: dict) -> str:
+    return f"data: {json.dumps(payload, ensure_ascii=False, default=str)}\n\n"
+
+
+@router.post("/send/stream", dependencies=[Depends(track_round_trips("chat_send_stream"))])
+async def send_message_stream(
+    chat_request: ChatRequest,
+    admission: AdmissionTicket = Depends(admission_control("chat_stream")),
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Потоковый вариант /send (Server-Sent Events).
+
+    События: start (модель), delta (фрагмент ответа), done (диалог, сообщения
+    и списание по usage последнего чанка), error.
+    Ошибки баланса/лимитов возвращаются обычным HTTP-ответом до начала потока.
+    """
+    user_id = current_user.id
+    sent_at = datetime.utcnow()
+    # Поток читается при отправке ответа в том же контексте - полоса сохраняется
+    set_request_lane(current_user, chat_request.source)
+
+    preflight = await _preflight(db, chat_request, user_id)
+    budget = preflight["budget"]
+    daily_limit = budget["daily_limit"]
+
+    requested_model = _requested_model(chat_request)
+    context = context_budgeter.fit(preflight, requested_model)
+    estimated_coins = _estimate_message_coins(chat_request, requested_model, context)
+
+    try:
+        check_budget(budget, estimated_coins)
+        reservation = await billing_service.reserve(db, user_id, estimated_coins, "chat")
+    except BudgetError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+
+    # Соединение не держим на время потока
+    await release_connection(db)
+
+    try:
+        messages_history = await _build_messages_history(chat_request, requested_model, context)
+    except HTTPException:
+        await billing_service.abort(db, reservation)
+        raise
+
+    async def finish_turn(ai_response: dict) -> Optional[dict]:
+        """
+        Сохранение ответа и списание по фактическому usage - в своей сессии и
+        до конца, даже если клиент уже ушёл. None - списать не удалось (резерв снят).
+        """
+        async with AsyncSessionLocal() as session:
+            try:
+                conversation_id, user_message, assistant_message = await _save_turn(
+                    session, preflight, chat_request, user_id, ai_response, sent_at
+                )
+                # Ответ уже доставлен клиенту, поэтому фактическая стоимость
+                # списывается даже сверх резерва
+                settled = await billing_service.settle(
+                    session, reservation,
+                    coins=ai_response["coins_spent"],
+                    model=ai_response["model"],
+                    tokens_used=ai_response["tokens_used"],
+                    cost_usd=ai_response["cost_usd"],
+                    usd_rate=ai_response["usd_rate"],
+                    description="AI сообщение",
+                    source=chat_request.source,
+                    allow_overdraft=True
+                )
+                if settled is None:
+                    # Со списанием сверх резерва сюда попадаем, только если не нашлось пользователя
+                    logger.error(f"Failed to settle streamed answer for user {user_id}, hold {reservation['hold_id']}")
+                    await billing_service.abort(session, reservation)
+                    return None
+                await session.commit()
+            except Exception:
+                await billing_service.abort(session, reservation)
+                raise
+
+        await _remember_turn(preflight, user_id, conversation_id, user_message, assistant_message)
+        context_budgeter.schedule_summary(conversation_id, context)
+
+        new_balance = settled["balance"]
+        new_daily_spent = settled["daily_spent"]
+        return {
+            "type": "done",
+            "conversation_id": conversation_id,
+            "user_message": MessageResponse.model_validate(user_message).model_dump(mode="json"),
+            "assistant_message": MessageResponse.model_validate(assistant_message).model_dump(mode="json"),
+            "coins_spent": ai_response["coins_spent"],
+            "balance_remaining": new_balance,
+            "daily_spent": new_daily_spent,
+            "daily_limit": daily_limit,
+            "daily_remaining": max(0, daily_limit - new_daily_spent) if daily_limit > 0 else new_balance
+        }
+
+    # Резерв закрывается ровно одним путём: finish_turn (ответ получен целиком),
+    # _settle_cancelled_stream (поток прерван) или abort (ошибка)
+    state = {"started": False, "closed": False}
+
+    async def event_stream():
+        state["started"] = True
+        content_parts = []
+        ai_response = None
+        try:
+            yield _sse_event({"type": "start", "model": requested_model})
+
+            # StreamingResponse забирает следующий чанк только после отправки
+            # предыдущего клиенту — медленный клиент притормаживает чтение из OpenRouter
+            async with upstream_call(db, "chat_stream"):
+                async for event in ai_service.stream_message(messages_history, requested_model, chat_request.temperature):
+                    if event["type"] == "delta":
+                        # Лимит потоков подстраивается под время до первого токена, а не длину потока
+                        admission.first_token()
+                        content_parts.append(event["content"])
+                        yield _sse_event(event)
+                    else:
+                        ai_response = event
+
+            # Отмена во время записи не прерывает её: задача доработает в фоне
+            state["closed"] = True
+            done = await asyncio.shield(_spawn(finish_turn(ai_response)))
+            if done is None:
+                yield _sse_event({"type": "error", "detail": "Не удалось списать коины за ответ"})
+                return
+            yield _sse_event(done)
+
+        except UpstreamUnavailable as e:
+            if not state["closed"]:
+                state["closed"] = True
+                await billing_service.abort(db, reservation)
+            yield _sse_event({"type": "error", **e.detail, "detail": e.detail["error"]})
+        except Exception as e:
+            if not state["closed"]:
+                state["closed"] = True
+                await billing_service.abort(db, reservation)
+            yield _sse_event({"type": "error", "detail": f"AI service error: {str(e)}"})
+        except BaseException:
+            # Клиент закрыл поток (CancelledError / GeneratorExit) - ждать здесь уже нельзя.
+            # Ответ получен целиком - сохраняется и списывается по usage; иначе
+            # списывается оценка по полученной части (без неё резерв снимается)
+            if not state["closed"]:
+                state["closed"] = True
+                if ai_response is not None:
+                    _spawn(finish_turn(ai_response))
+                else:
+                    _spawn(_settle_cancelled_stream(
+                        reservation, requested_model, messages_history, "".join(content_parts), chat_request.source
+                    ))
+            raise
+
+    async def release_unstarted():
+        # Клиент ушёл до первого чанка - генератор так и не запускался
+        if not state["started"]:
+            _spawn(_settle_cancelled_stream(reservation, requested_model, messages_history, "", chat_request.source))
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        background=BackgroundTask(release_unstarted),
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no"  # nginx не должен буферизовать поток
+        }
+    )
+
+
 @router.get("/balance")
 async def get_balance(
     current_user: User = Depends(get_current_user),
@@ -516,7 +850,6 @@ async def get_available_models(
     db: AsyncSession = Depends(get_db)
 ):
     from ..services.ai_service import get_usd_to_coins_multiplier, get_model_prices_usd
-    from ..services.currency_service import currency_service
     usd_rate = await currency_service.get_usd_rate()
     multiplier = get_usd_to_coins_multiplier(usd_rate)
 
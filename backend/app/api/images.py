@@ -2,19 +2,24 @@
 API endpoints для генерации изображений
 """
 
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, Header, HTTPException, Request, status
 from fastapi.responses import FileResponse
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import text
 from pydantic import BaseModel, Field
 from typing import Optional, List
-from datetime import date
 from pathlib import Path
 
-from ..core.database import get_db
+from ..core.database import get_db, release_connection, upstream_call, track_round_trips
+from ..core.http import UpstreamUnavailable
+from ..core.admission import admission_control
+from ..core.scheduler import set_request_lane
+from ..core.user_slots import user_slots, UserConcurrencyLimited
+from ..core.disconnect import ClientDisconnected, CLIENT_CLOSED_REQUEST, cancel_on_disconnect
+from ..core.idempotency import run_idempotent
 from ..models.user import User
 from ..api.auth import get_current_user
 from ..services.image_service import image_service, IMAGES_DIR, IMAGE_MODELS
+from ..services.billing_service import billing_service, BudgetError
 
 router = APIRouter(tags=["Images"])
 
@@ -34,178 +39,115 @@ class ImageGenerateResponse(BaseModel):
     prompt: str
 
 
-@router.post("/generate", response_model=ImageGenerateResponse)
+@router.post("/generate", response_model=ImageGenerateResponse, dependencies=[Depends(admission_control("images")), Depends(track_round_trips("images_generate"))])
 async def generate_image(
     request: ImageGenerateRequest,
+    http_request: Request,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
     current_user: User = Depends(get_current_user),
     db: AsyncSession = Depends(get_db)
 ):
-    """Генерация изображения по текстовому описанию"""
-    user_id = current_user.id
-
-    # Получаем баланс и бюджет пользователя
-    result = await db.execute(
-        text("""
-            SELECT balance, budget_period, budget_coins, daily_spent, daily_spent_date
-            FROM users WHERE id = :user_id
-        """),
-        {"user_id": user_id}
+    """Генерация изображения по текстовому описанию (повтор с тем же Idempotency-Key вернёт первый результат)"""
+    return await run_idempotent(
+        "images", current_user.id, idempotency_key, request.model_dump(), ImageGenerateResponse,
+        lambda: _generate_image(request, http_request, current_user, db)
     )
-    row = result.fetchone()
-    current_balance = row[0] or 0
-    budget_period = row[1] or "none"
-    budget_coins = row[2] or 0
-    daily_spent = row[3] or 0
-    daily_spent_date = row[4]
-
-    today = date.today()
-    if daily_spent_date and daily_spent_date != today:
-        await db.execute(
-            text("UPDATE users SET daily_spent = 0, daily_spent_date = :today WHERE id = :user_id"),
-            {"today": today, "user_id": user_id}
-        )
-        daily_spent = 0
-
-    # Рассчитываем дневной лимит
-    period_days_map = {"none": 0, "week": 7, "two_weeks": 14, "three_weeks": 21, "month": 30}
-    period_days = period_days_map.get(budget_period, 0)
-    daily_limit = budget_coins // period_days if period_days > 0 else 0
 
-    # Примерная стоимость генерации (~500 коинов)
-    estimated_cost = 500
 
-    # Проверка баланса
-    if current_balance <= 0:
-        raise HTTPException(
-            status_code=status.HTTP_402_PAYMENT_REQUIRED,
-            detail={
-                "error": "Недостаточно коинов. Пополните баланс.",
-                "error_type": "no_balance",
-                "balance": current_balance,
-                "topup_url": "/pricing"
-            }
-        )
+async def _generate_image(request: ImageGenerateRequest, http_request: Request, current_user: User, db: AsyncSession):
+    user_id = current_user.id
+    lane = set_request_lane(current_user, request.source)
 
-    if current_balance < estimated_cost:
+    # Не больше N одновременных генераций на пользователя (по всем воркерам)
+    try:
+        lease = await user_slots.acquire("images", user_id, lane)
+    except UserConcurrencyLimited as e:
         raise HTTPException(
-            status_code=status.HTTP_402_PAYMENT_REQUIRED,
-            detail={
-                "error": f"Недостаточно коинов. Нужно ~{estimated_cost}, у вас {current_balance}.",
-                "error_type": "low_balance",
-                "balance": current_balance,
-                "topup_url": "/pricing"
-            }
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=e.detail,
+            headers={"Retry-After": str(e.retry_after_seconds)}
         )
 
-    # Проверка дневного лимита
-    if budget_period != "none" and daily_limit > 0:
-        daily_remaining = daily_limit - daily_spent
-        if daily_spent >= daily_limit:
-            raise HTTPException(
-                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
-                detail={
-                    "error": f"Достигнут дневной лимит ({daily_limit} коинов).",
-                    "error_type": "daily_limit",
-                    "daily_limit": daily_limit,
-                    "daily_spent": daily_spent
-                }
-            )
-
+    # Слот освобождается при любом исходе, в том числе при ошибке резерва
     try:
-        # Генерация изображения
-        result = await image_service.generate_image(
-            prompt=request.prompt,
-            model=request.model,
-            aspect_ratio=request.aspect_ratio
-        )
-
-        coins_spent = result["coins_spent"]
-        cost_usd = result["cost_usd"]
-        usd_rate = result["usd_rate"]
-
-        # Финальная проверка баланса
-        if current_balance < coins_spent:
-            raise HTTPException(
-                status_code=status.HTTP_402_PAYMENT_REQUIRED,
-                detail={
-                    "error": f"Недостаточно коинов. Нужно {coins_spent}, у вас {current_balance}.",
-                    "error_type": "low_balance",
-                    "balance": current_balance
-                }
+        # Примерная стоимость генерации (~500 коинов) — резервируется до ответа
+        estimated_cost = 500
+
+        # Резерв коинов одним условным UPDATE; при нехватке баланса или лимита -
+        # BudgetError с причиной отказа
+        try:
+            reservation = await billing_service.reserve(db, user_id, estimated_cost, "image")
+        except BudgetError as e:
+            raise HTTPException(status_code=e.status_code, detail=e.detail)
+
+        # Все чтения завершены — отдаём соединение в пул до ответа провайдера
+        await release_connection(db)
+
+        try:
+            # Генерация изображения
+            async with upstream_call(db, "images"):
+                # Клиент ушёл - запрос к провайдеру отменяется, резерв снимается ниже
+                result = await cancel_on_disconnect(
+                    http_request,
+                    image_service.generate_image(
+                        prompt=request.prompt,
+                        model=request.model,
+                        aspect_ratio=request.aspect_ratio
+                    ),
+                    "images"
+                )
+
+            coins_spent = result["coins_spent"]
+
+            # Списание по фактической стоимости (с финальной проверкой баланса)
+            settled = await billing_service.settle(
+                db, reservation,
+                coins=coins_spent,
+                model=result["model"],
+                tokens_used=result.get("input_tokens", 0) + result.get("output_tokens", 0),
+                cost_usd=result["cost_usd"],
+                usd_rate=result["usd_rate"],
+                description="Генерация изображения",
+                source=request.source
             )
+            if settled is None:
+                await billing_service.abort(db, reservation)
+                await billing_service.raise_insufficient(db, user_id, coins_spent)
 
-        # Списываем коины
-        await db.execute(
-            text("""
-                UPDATE users SET
-                    balance = balance - :coins,
-                    daily_spent = daily_spent + :coins,
-                    daily_spent_date = :today
-                WHERE id = :user_id
-            """),
-            {"coins": coins_spent, "today": today, "user_id": user_id}
-        )
-
-        # Записываем в usage_logs
-        await db.execute(
-            text("""
-                INSERT INTO usage_logs (user_id, model_id, tokens_used, cost_rub, coins_spent)
-                VALUES (:user_id, :model_id, :tokens_used, :cost_rub, :coins_spent)
-            """),
-            {
-                "user_id": user_id,
-                "model_id": result["model"],
-                "tokens_used": result.get("input_tokens", 0) + result.get("output_tokens", 0),
-                "cost_rub": coins_spent / 100,
-                "coins_spent": coins_spent
-            }
-        )
+            await db.commit()
 
-        # Записываем транзакцию
-        await db.execute(
-            text("""
-                INSERT INTO transactions (user_id, type, amount, balance_before, balance_after, description, model, tokens_used, cost_usd, usd_rate, source)
-                VALUES (:user_id, 'spend', :amount, :before, :after, :desc, :model, :tokens, :cost_usd, :usd_rate, :source)
-            """),
-            {
-                "user_id": user_id,
-                "amount": -coins_spent,
-                "before": current_balance,
-                "after": current_balance - coins_spent,
-                "desc": "Генерация изображения",
+            return {
+                "images": result["images"],
+                "coins_spent": coins_spent,
+                "balance_remaining": settled["balance"],
                 "model": result["model"],
-                "tokens": result.get("input_tokens", 0) + result.get("output_tokens", 0),
-                "cost_usd": cost_usd,
-                "usd_rate": usd_rate,
-                "source": request.source or "web"
+                "prompt": request.prompt
             }
-        )
-
-        await db.commit()
 
-        # Получаем обновленный баланс
-        new_result = await db.execute(
-            text("SELECT balance FROM users WHERE id = :user_id"),
-            {"user_id": user_id}
-        )
-        new_balance = new_result.scalar() or 0
-
-        return {
-            "images": result["images"],
-            "coins_spent": coins_spent,
-            "balance_remaining": new_balance,
-            "model": result["model"],
-            "prompt": request.prompt
-        }
-
-    except HTTPException:
-        raise
-    except Exception as e:
-        await db.rollback()
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Ошибка генерации: {str(e)}"
-        )
+        except BudgetError as e:
+            await billing_service.abort(db, reservation)
+            raise HTTPException(status_code=e.status_code, detail=e.detail)
+        except ClientDisconnected:
+            await billing_service.abort(db, reservation)
+            raise HTTPException(status_code=CLIENT_CLOSED_REQUEST, detail="Client disconnected")
+        except UpstreamUnavailable as e:
+            await billing_service.abort(db, reservation)
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail=e.detail,
+                headers={"Retry-After": str(e.retry_after_seconds)}
+            )
+        except HTTPException:
+            await billing_service.abort(db, reservation)
+            raise
+        except Exception as e:
+            await billing_service.abort(db, reservation)
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail=f"Ошибка генерации: {str(e)}"
+            )
+    finally:
+        await lease.release()
 
 
 @router.get("/models")
@@ -3,7 +3,6 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import text
 from datetime import datetime
 import uuid
-import httpx
 import base64
 import json
 import logging
@@ -12,6 +11,8 @@ from ..core.database import get_db
 from ..models.user import User
 from ..api.auth import get_current_user
 from ..core.config import settings
+from ..core.http import http_clients, UpstreamHTTPError
+from ..core.retry import retry_call, should_retry_http
 
 router = APIRouter(tags=["Payments"])
 logger = logging.getLogger(__name__)
@@ -71,7 +72,9 @@ async def create_payment(
             }
         }
         
-        async with httpx.AsyncClient() as client:
+        client = http_clients.get("yookassa")
+
+        async def attempt():
             response = await client.post(
                 f"{YOOKASSA_API_URL}/payments",
                 json=payment_data,
@@ -81,6 +84,12 @@ async def create_payment(
                     "Content-Type": "application/json"
                 }
             )
+            if should_retry_http(response.status_code):
+                raise UpstreamHTTPError.from_response("YooKassa", response)
+            return response
+
+        # Повторы с тем же Idempotence-Key не создадут второй платёж
+        response = await retry_call("yookassa", attempt)
         
         if response.status_code != 200:
             logger.error(f"YooKassa error: {response.text}")
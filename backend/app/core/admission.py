@@ -0,0 +1,195 @@
+"""
+Admission control for the AI, image and video endpoints.
+
+Every worker keeps an adaptive concurrency limit per endpoint class. A request
+that would go over the limit is rejected before it touches the database or
+the upstream: 503 with Retry-After instead of one more coroutine waiting on a
+slow provider and holding memory and a DB connection.
+
+The limit follows upstream latency (AIMD). The baseline is a slow moving
+average of request latency, the recent latency a fast one. While recent
+latency stays within ADMISSION_LATENCY_TOLERANCE times the baseline and the
+limit is actually used, it grows by about one per limit requests. When
+latency climbs above that, or requests fail with 5xx (upstream down, timeouts),
+it is cut by ADMISSION_BACKOFF, at most once per recent latency so a burst of
+slow completions does not collapse it.
+
+Streaming chat has its own class: a stream holds its slot for as long as the
+client reads, so its latency sample is the time to the first token, reported
+by the endpoint through the AdmissionTicket the dependency yields.
+"""
+import time
+from typing import Optional
+
+from fastapi import HTTPException, status
+
+from .config import settings
+from .http import UpstreamUnavailable
+from .metrics import metrics, MetricNames
+
+# (initial, min, max) concurrent requests per worker
+ADMISSION_LIMITS = {
+    "chat": (100, 10, 500),
+    "chat_stream": (100, 10, 500),
+    "images": (20, 2, 100),
+    "videos": (10, 1, 50),
+}
+
+ADMISSION_BACKOFF = 0.9
+BASELINE_ALPHA = 0.01
+RECENT_ALPHA = 0.2
+# Samples before latency starts to move the limit
+WARMUP_SAMPLES = 20
+
+
+class AdmissionRejected(UpstreamUnavailable):
+    """The worker is at its concurrency limit for the endpoint class"""
+
+    error_type = "overloaded"
+    user_message = "Сервис перегружен. Попробуйте через {seconds} сек."
+
+    def __init__(self, endpoint: str, retry_after: float):
+        super().__init__(f"Admission limit reached for {endpoint}", "lana", endpoint, retry_after)
+
+
+class AdmissionTicket:
+    """What the dependency yields; streams call first_token() so the sample is time to first token"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.first_token_latency: Optional[float] = None
+
+    def first_token(self):
+        if self.first_token_latency is None:
+            self.first_token_latency = time.perf_counter() - self.started
+
+    def latency(self) -> float:
+        if self.first_token_latency is not None:
+            return self.first_token_latency
+        return time.perf_counter() - self.started
+
+
+class AdaptiveLimit:
+    def __init__(self, name: str, initial: int, min_limit: int, max_limit: int):
+        self.name = name
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.inflight = 0
+        self.baseline: Optional[float] = None
+        self.recent: Optional[float] = None
+        self.samples = 0
+        self._last_decrease = 0.0
+
+    def try_acquire(self) -> bool:
+        if self.inflight >= int(self.limit):
+            return False
+        self.inflight += 1
+        return True
+
+    def release(self, latency: Optional[float], overloaded: bool = False):
+        """Free the slot; latency of a successful request (None - no sample) or an overload signal"""
+        inflight = self.inflight
+        self.inflight -= 1
+
+        if overloaded:
+            self._decrease()
+            return
+        if latency is None:
+            return
+
+        self.samples += 1
+        if self.baseline is None:
+            self.baseline = self.recent = latency
+        else:
+            self.baseline += BASELINE_ALPHA * (latency - self.baseline)
+            self.recent += RECENT_ALPHA * (latency - self.recent)
+        if self.samples < WARMUP_SAMPLES:
+            return
+
+        if self.recent > self.baseline * settings.ADMISSION_LATENCY_TOLERANCE:
+            self._decrease()
+        elif inflight * 2 >= self.limit:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    def _decrease(self):
+        now = time.monotonic()
+        if now - self._last_decrease < (self.recent or 1.0):
+            return
+        self._last_decrease = now
+        self.limit = max(self.min_limit, self.limit * ADMISSION_BACKOFF)
+
+    def retry_after(self) -> float:
+        """Rough time until a slot frees up"""
+        return (self.recent or 1.0) / max(1, self.inflight)
+
+
+class AdmissionController:
+    def __init__(self, limits: dict[str, tuple]):
+        self._limits = {
+            name: AdaptiveLimit(name, *bounds)
+            for name, bounds in limits.items()
+        }
+
+    def get(self, endpoint: str) -> AdaptiveLimit:
+        return self._limits[endpoint]
+
+    def snapshot(self) -> list:
+        return [
+            {
+                "endpoint": limit.name,
+                "limit": int(limit.limit),
+                "inflight": limit.inflight,
+                "latency_baseline": round(limit.baseline or 0, 2),
+                "latency_recent": round(limit.recent or 0, 2)
+            }
+            for limit in self._limits.values()
+        ]
+
+    def record_metrics(self):
+        for limit in self._limits.values():
+            labels = {"endpoint": limit.name}
+            metrics.set_gauge(MetricNames.ADMISSION_LIMIT, int(limit.limit), labels=labels)
+            metrics.set_gauge(MetricNames.ADMISSION_INFLIGHT, limit.inflight, labels=labels)
+
+
+admission_controller = AdmissionController(ADMISSION_LIMITS)
+
+
+def admission_control(endpoint: str):
+    """
+    FastAPI dependency: takes a slot of the endpoint class for the whole
+    request (streaming responses included) or rejects it with 503.
+    Yields an AdmissionTicket.
+    """
+    async def dependency():
+        ticket = AdmissionTicket()
+        if not settings.ADMISSION_CONTROL_ENABLED:
+            yield ticket
+            return
+
+        limit = admission_controller.get(endpoint)
+        if not limit.try_acquire():
+            metrics.inc_counter(MetricNames.ADMISSION_SHED, labels={"endpoint": endpoint})
+            error = AdmissionRejected(endpoint, limit.retry_after())
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail=error.detail,
+                headers={"Retry-After": str(error.retry_after_seconds)}
+            )
+
+        latency, overloaded = None, False
+        try:
+            yield ticket
+            latency = ticket.latency()
+        except HTTPException as e:
+            # 4xx (balance, validation) answer fast and say nothing about the upstream
+            overloaded = e.status_code >= 500
+            raise
+        except Exception:
+            overloaded = True
+            raise
+        finally:
+            limit.release(latency, overloaded)
+
+    return dependency
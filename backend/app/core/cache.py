@@ -2,11 +2,15 @@
 Redis caching service for LANA AI Platform
 """
 import json
+import logging
+import time
 import redis.asyncio as redis
 from typing import Optional, Any
 from functools import wraps
 from .config import settings
 
+logger = logging.getLogger(__name__)
+
 
 class CacheService:
     """Redis-based caching service"""
@@ -27,6 +31,12 @@ class CacheService:
                 print(f"Redis connection error: {e}")
                 self._redis = None
 
+    async def client(self) -> Optional[redis.Redis]:
+        """Raw Redis client for primitives not covered here (locks, pub/sub)"""
+        if not self._redis:
+            await self.connect()
+        return self._redis
+
     async def close(self):
         """Close Redis connection"""
         if self._redis:
@@ -73,6 +83,72 @@ class CacheService:
         except Exception:
             pass
 
+    async def list_get(self, key: str) -> Optional[list]:
+        """Get whole JSON list (None if key is missing or Redis is unavailable)"""
+        if not self._redis:
+            await self.connect()
+        try:
+            values = await self._redis.lrange(key, 0, -1)
+            if not values:
+                return None
+            return [json.loads(v) for v in values]
+        except Exception:
+            return None
+
+    async def list_set(self, key: str, values: list, max_len: int, ttl: int = 300):
+        """Replace list with the last max_len values"""
+        if not self._redis:
+            await self.connect()
+        try:
+            async with self._redis.pipeline(transaction=True) as pipe:
+                pipe.delete(key)
+                if values:
+                    pipe.rpush(key, *[json.dumps(v) for v in values[-max_len:]])
+                    pipe.expire(key, ttl)
+                await pipe.execute()
+        except Exception as e:
+            logger.warning(f"Failed to write cached list {key}: {e}")
+
+    async def list_append(self, key: str, values: list, max_len: int, ttl: int = 300):
+        """Append values to an existing list and cap it to max_len (missing key stays missing)"""
+        if not self._redis:
+            await self.connect()
+        try:
+            async with self._redis.pipeline(transaction=True) as pipe:
+                pipe.rpushx(key, *[json.dumps(v) for v in values])
+                pipe.ltrim(key, -max_len, -1)
+                pipe.expire(key, ttl)
+                await pipe.execute()
+        except Exception as e:
+            logger.warning(f"Failed to append to cached list {key}: {e}")
+
+    async def set_capped(self, key: str, value: Any, ttl: int, index_key: str, max_entries: int) -> int:
+        """
+        Set value with TTL and register it in a sorted-set index; when the index
+        grows over max_entries the oldest keys are evicted. Returns evicted count.
+        """
+        if not self._redis:
+            await self.connect()
+        try:
+            now = time.time()
+            async with self._redis.pipeline(transaction=True) as pipe:
+                pipe.setex(key, ttl, json.dumps(value))
+                pipe.zadd(index_key, {key: now})
+                # Записи, у которых истёк TTL, из индекса тоже убираем
+                pipe.zremrangebyscore(index_key, 0, now - ttl)
+                pipe.zcard(index_key)
+                results = await pipe.execute()
+
+            overflow = results[-1] - max_entries
+            if overflow <= 0:
+                return 0
+            evicted = await self._redis.zpopmin(index_key, overflow)
+            if evicted:
+                await self._redis.delete(*[member for member, _ in evicted])
+            return len(evicted)
+        except Exception:
+            return 0
+
     async def is_healthy(self) -> bool:
         """Check if Redis is healthy"""
         try:
@@ -107,6 +183,10 @@ class CacheKeys:
     def user_settings(user_id: int) -> str:
         return f"user:{user_id}:settings"
 
+    @staticmethod
+    def conversation_context(user_id: int, conversation_id: int) -> str:
+        return f"user:{user_id}:conversation:{conversation_id}:context"
+
 
 # Cache TTLs (in seconds)
 class CacheTTL:
@@ -0,0 +1,223 @@
+"""
+Circuit breakers for upstream APIs, keyed per upstream and model.
+
+closed    - calls pass; outage-like failures (5xx, timeouts, connection errors)
+            are counted in a sliding Redis window.
+open      - after CIRCUIT_FAILURE_THRESHOLD failures within CIRCUIT_WINDOW_SECONDS
+            calls fail fast with CircuitOpenError for CIRCUIT_OPEN_SECONDS
+            instead of waiting for the upstream timeout.
+half-open - once the open period is over, one call (across all workers) is let
+            through as a probe: success closes the breaker, failure reopens it.
+
+State lives in Redis so every worker sees the same breaker. Closed state is
+cached locally for a second to keep the happy path free of Redis round trips.
+Without Redis breakers stay closed (calls are not blocked).
+"""
+import asyncio
+import logging
+import math
+import time
+from collections.abc import Awaitable, Callable
+from typing import Any
+
+import httpx
+
+from .cache import cache
+from .config import settings
+from .http import UpstreamHTTPError, UpstreamUnavailable
+from .metrics import metrics, MetricNames
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+INDEX_KEY = "circuit:index"
+LOCAL_CLOSED_TTL = 1.0
+# A probe that never reports back (worker died) frees the slot after this long
+PROBE_LOCK_SECONDS = 300
+
+
+class CircuitOpenError(UpstreamUnavailable):
+    """Upstream is failing; the call was rejected without being made"""
+
+    def __init__(self, upstream: str, scope: str, retry_after: float):
+        super().__init__(
+            f"{upstream} is temporarily unavailable for {scope}, retry in {math.ceil(retry_after)}s",
+            upstream, scope, retry_after
+        )
+
+
+def is_outage_error(error: BaseException) -> bool:
+    """Failures that say the upstream is down, not that the request was bad"""
+    if isinstance(error, UpstreamHTTPError):
+        return error.status_code >= 500
+    return isinstance(error, (httpx.TransportError, asyncio.TimeoutError))
+
+
+class CircuitBreakerRegistry:
+    def __init__(self):
+        self._closed_until: dict[str, float] = {}
+
+    def _key(self, upstream: str, scope: str) -> str:
+        return f"circuit:{upstream}:{scope}"
+
+    def _transition(self, upstream: str, scope: str, state: str):
+        metrics.inc_counter(MetricNames.CIRCUIT_TRANSITIONS, labels={"upstream": upstream, "scope": scope, "state": state})
+        log = logger.info if state == CLOSED else logger.warning
+        log(f"Circuit {upstream}/{scope} -> {state}")
+
+    async def before_call(self, upstream: str, scope: str) -> bool:
+        """
+        Raises CircuitOpenError if the call must not be made.
+        Returns True when the call is the half-open probe.
+        """
+        key = self._key(upstream, scope)
+        if self._closed_until.get(key, 0) > time.monotonic():
+            return False
+
+        redis = await cache.client()
+        if redis is None:
+            return False
+        try:
+            state = await redis.hgetall(f"{key}:state")
+            if not state:
+                self._closed_until[key] = time.monotonic() + LOCAL_CLOSED_TTL
+                return False
+
+            remaining = float(state["open_until"]) - time.time()
+            if remaining <= 0 and await redis.set(f"{key}:probe", "1", nx=True, ex=PROBE_LOCK_SECONDS):
+                if state.get("state") != HALF_OPEN:
+                    await redis.hset(f"{key}:state", "state", HALF_OPEN)
+                    self._transition(upstream, scope, HALF_OPEN)
+                return True
+        except Exception as e:
+            logger.warning(f"Circuit breaker check failed for {upstream}/{scope}: {e}")
+            return False
+
+        metrics.inc_counter(MetricNames.CIRCUIT_REJECTED, labels={"upstream": upstream, "scope": scope})
+        # While a probe is in flight, ask to come back shortly
+        raise CircuitOpenError(upstream, scope, max(remaining, 1.0))
+
+    async def record_success(self, upstream: str, scope: str, probe: bool):
+        if not probe:
+            return
+        key = self._key(upstream, scope)
+        redis = await cache.client()
+        try:
+            await redis.delete(f"{key}:state", f"{key}:probe", f"{key}:failures")
+        except Exception as e:
+            logger.warning(f"Circuit breaker update failed for {upstream}/{scope}: {e}")
+            return
+        self._transition(upstream, scope, CLOSED)
+
+    async def record_failure(self, upstream: str, scope: str, probe: bool, error: BaseException):
+        if not is_outage_error(error):
+            # The upstream answered; a failed probe must not keep the slot
+            if probe:
+                await self.record_success(upstream, scope, probe)
+            return
+
+        key = self._key(upstream, scope)
+        redis = await cache.client()
+        if redis is None:
+            return
+        try:
+            if not probe:
+                async with redis.pipeline(transaction=True) as pipe:
+                    pipe.incr(f"{key}:failures")
+                    pipe.exists(f"{key}:state")
+                    failures, is_open = await pipe.execute()
+                if failures == 1:
+                    await redis.expire(f"{key}:failures", settings.CIRCUIT_WINDOW_SECONDS)
+                if is_open or failures < settings.CIRCUIT_FAILURE_THRESHOLD:
+                    return
+
+            async with redis.pipeline(transaction=True) as pipe:
+                pipe.hset(f"{key}:state", mapping={
+                    "state": OPEN,
+                    "open_until": time.time() + settings.CIRCUIT_OPEN_SECONDS,
+                    "error": str(error)[:200]
+                })
+                pipe.delete(f"{key}:probe", f"{key}:failures")
+                pipe.sadd(INDEX_KEY, f"{upstream}|{scope}")
+                await pipe.execute()
+        except Exception as e:
+            logger.warning(f"Circuit breaker update failed for {upstream}/{scope}: {e}")
+            return
+
+        self._closed_until.pop(key, None)
+        self._transition(upstream, scope, OPEN)
+
+    async def call(self, upstream: str, scope: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """fn() guarded by the breaker for (upstream, scope)"""
+        probe = await self.before_call(upstream, scope)
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            if probe:
+                await self.release_probe(upstream, scope)
+            raise
+        except Exception as e:
+            await self.record_failure(upstream, scope, probe, e)
+            raise
+        await self.record_success(upstream, scope, probe)
+        return result
+
+    async def release_probe(self, upstream: str, scope: str):
+        """The probe call was abandoned (cancelled) - let another call probe"""
+        redis = await cache.client()
+        if redis is None:
+            return
+        try:
+            await redis.delete(f"{self._key(upstream, scope)}:probe")
+        except Exception as e:
+            # The probe lock expires on its own
+            logger.warning(f"Failed to release circuit probe {upstream}/{scope}: {e}")
+
+    async def snapshot(self) -> list[dict]:
+        """Every breaker that has been opened, with its current state"""
+        redis = await cache.client()
+        if redis is None:
+            return []
+        members = sorted(await redis.smembers(INDEX_KEY))
+        async with redis.pipeline(transaction=False) as pipe:
+            for member in members:
+                upstream, scope = member.split("|", 1)
+                key = self._key(upstream, scope)
+                pipe.hgetall(f"{key}:state")
+                pipe.get(f"{key}:failures")
+            results = await pipe.execute()
+
+        now = time.time()
+        breakers = []
+        for i, member in enumerate(members):
+            upstream, scope = member.split("|", 1)
+            state, failures = results[2 * i], results[2 * i + 1]
+            entry = {"upstream": upstream, "scope": scope, "state": CLOSED, "failures": int(failures or 0)}
+            if state:
+                entry["state"] = state.get("state", OPEN)
+                entry["retry_after"] = max(0, round(float(state["open_until"]) - now, 1))
+                entry["last_error"] = state.get("error")
+            breakers.append(entry)
+        return breakers
+
+    async def record_metrics(self) -> list[dict]:
+        """Export breaker states as gauges (0 closed, 1 half-open, 2 open)"""
+        try:
+            breakers = await self.snapshot()
+        except Exception as e:
+            logger.warning(f"Circuit breaker snapshot failed: {e}")
+            return []
+        for breaker in breakers:
+            metrics.set_gauge(
+                MetricNames.CIRCUIT_STATE, STATE_VALUES[breaker["state"]],
+                labels={"upstream": breaker["upstream"], "scope": breaker["scope"]}
+            )
+        return breakers
+
+
+circuit_breakers = CircuitBreakerRegistry()
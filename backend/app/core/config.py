@@ -11,6 +11,9 @@ class Settings(BaseSettings):
     ANTHROPIC_API_KEY: Optional[str] = None
     OPENROUTER_API_KEY: Optional[str] = None
     REPLICATE_API_TOKEN: Optional[str] = None
+    # Пулы ключей: "key1,key2:2" (через двоеточие - вес); пусто - используется одиночный ключ
+    OPENROUTER_API_KEYS: str = ""
+    REPLICATE_API_TOKENS: str = ""
 
     YUKASSA_SHOP_ID: Optional[str] = None
     YUKASSA_SECRET_KEY: Optional[str] = None
@@ -23,6 +26,58 @@ class Settings(BaseSettings):
     YOOKASSA_SHOP_ID: str = ""
     YOOKASSA_SECRET_KEY: str = ""
 
+    # Хранение истории чатов: сколько последних сообщений оставлять в диалоге
+    CHAT_RETENTION_MESSAGES: int = 30
+    CHAT_RETENTION_BATCH_SIZE: int = 200  # диалогов за одну транзакцию
+    CHAT_RETENTION_INTERVAL_SECONDS: int = 600
+    # Бюджет токенов истории в запросе к модели (остальное - через краткое содержание)
+    CHAT_HISTORY_TOKEN_BUDGET: int = 6000
+
+    # Кэш одинаковых запросов к моделям (выключен по умолчанию)
+    RESPONSE_CACHE_ENABLED: bool = False
+    RESPONSE_CACHE_TTL_SECONDS: int = 3600
+    RESPONSE_CACHE_MAX_ENTRIES: int = 10000
+    RESPONSE_CACHE_DISCOUNT: float = 0.5  # доля скидки от стоимости ответа при попадании в кэш
+
+    # Ответы на почти одинаковые одноходовые промпты (SimHash), только дешёвые модели
+    NEAR_DUP_CACHE_ENABLED: bool = False
+    NEAR_DUP_MODELS: str = "google/gemini-2.0-flash-001,openai/gpt-4o-mini,deepseek/deepseek-chat"
+    NEAR_DUP_MAX_HAMMING: int = 3
+    NEAR_DUP_MIN_JACCARD: float = 0.8
+
+    # Переключение на равноценную модель при 5xx/429/зависании провайдера
+    FAILOVER_ENABLED: bool = True
+    FAILOVER_STALL_SECONDS: float = 45.0  # сколько ждать первого фрагмента потока, прежде чем перейти к следующей модели
+    # Хеджирование: второй запрос к запасной модели, если основная отвечает дольше своего p95
+    HEDGING_ENABLED: bool = True
+    HEDGE_MIN_DELAY_SECONDS: float = 2.0
+    HEDGE_MAX_DELAY_SECONDS: float = 20.0
+
+    # Предохранители провайдеров (по провайдеру и модели, состояние в Redis)
+    CIRCUIT_FAILURE_THRESHOLD: int = 5  # сбоев за окно, после которых запросы отклоняются сразу
+    CIRCUIT_WINDOW_SECONDS: int = 60
+    CIRCUIT_OPEN_SECONDS: int = 30  # через сколько пропустить пробный запрос
+
+    # Ограничение частоты запросов к моделям (лимиты узнаются из x-ratelimit-* заголовков)
+    UPSTREAM_RATE_LIMIT_WINDOW_SECONDS: float = 60.0  # окно, к которому относится x-ratelimit-limit
+    UPSTREAM_RATE_LIMIT_MAX_WAIT_SECONDS: float = 5.0  # дольше в очереди не ждём
+
+    # Контроль допуска: адаптивный лимит одновременных запросов к чату/картинкам/видео на воркер
+    ADMISSION_CONTROL_ENABLED: bool = True
+    ADMISSION_LATENCY_TOLERANCE: float = 2.0  # во сколько раз задержка может превысить обычную, прежде чем лимит снижается
+
+    # Одновременные запросы к провайдерам на воркер; сверх них - очередь по приоритетам (core.scheduler)
+    UPSTREAM_SLOTS_OPENROUTER: int = 64
+    UPSTREAM_SLOTS_REPLICATE: int = 8
+    UPSTREAM_QUEUE_TIMEOUT_SECONDS: float = 30.0
+
+    # Одновременные генерации одного пользователя (по всем воркерам, через Redis): endpoint -> полоса -> лимит
+    USER_CONCURRENCY_LIMITS: dict[str, dict[str, int]] = {
+        "images": {"subscriber": 4, "paid": 3, "free": 1, "bot": 1},
+        "videos": {"subscriber": 2, "paid": 2, "free": 1, "bot": 1},
+    }
+    USER_CONCURRENCY_WAIT_SECONDS: float = 0.0  # 0 - сразу 429, иначе ждать освобождения столько секунд
+
     class Config:
         env_file = ".env"
         case_sensitive = True
@@ -1,6 +1,11 @@
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Optional
+from sqlalchemy import event
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
 from sqlalchemy.orm import declarative_base
 from .config import settings
+from .metrics import metrics, MetricNames
 
 engine = create_async_engine(
     settings.DATABASE_URL,
@@ -20,9 +25,70 @@ AsyncSessionLocal = async_sessionmaker(
 
 Base = declarative_base()
 
+
+@event.listens_for(engine.sync_engine, "checkout")
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+    metrics.set_gauge(MetricNames.DB_POOL_CHECKED_OUT, engine.pool.checkedout())
+
+
+@event.listens_for(engine.sync_engine, "checkin")
+def _on_checkin(dbapi_connection, connection_record):
+    metrics.set_gauge(MetricNames.DB_POOL_CHECKED_OUT, engine.pool.checkedout())
+
+
+# Счётчик обращений к БД в рамках текущего запроса (список, чтобы его видели и дочерние задачи стриминга)
+_round_trips: ContextVar[Optional[list]] = ContextVar("db_round_trips", default=None)
+
+
+def _count_round_trip(*args, **kwargs):
+    counter = _round_trips.get()
+    if counter is not None:
+        counter[0] += 1
+
+
+event.listen(engine.sync_engine, "before_cursor_execute", _count_round_trip)
+event.listen(engine.sync_engine, "commit", _count_round_trip)
+event.listen(engine.sync_engine, "rollback", _count_round_trip)
+
+
+def track_round_trips(endpoint: str):
+    """
+    Зависимость FastAPI: считает обращения к БД (запросы, COMMIT, ROLLBACK)
+    за время обработки запроса и пишет их в гистограмму по endpoint.
+    """
+    async def dependency():
+        counter = [0]
+        _round_trips.set(counter)
+        try:
+            yield
+        finally:
+            _round_trips.set(None)
+            metrics.observe_histogram(MetricNames.DB_ROUND_TRIPS, counter[0], labels={"endpoint": endpoint})
+
+    return dependency
+
+
 async def get_db():
     async with AsyncSessionLocal() as session:
         try:
             yield session
         finally:
             await session.close()
+
+
+async def release_connection(db: AsyncSession):
+    """
+    Завершает текущую транзакцию и возвращает соединение в пул.
+    Вызывается после всех предварительных чтений и перед долгим внешним вызовом
+    (OpenRouter/Replicate), чтобы запрос не держал соединение десятки секунд.
+    """
+    if db.in_transaction():
+        await db.commit()
+
+
+@asynccontextmanager
+async def upstream_call(db: AsyncSession, endpoint: str):
+    """Оборачивает внешний вызов и считает случаи, когда сессия держит соединение через await"""
+    if db.in_transaction():
+        metrics.inc_counter(MetricNames.DB_CONNECTIONS_HELD_ACROSS_AWAIT, labels={"endpoint": endpoint})
+    yield
@@ -0,0 +1,61 @@
+"""
+Cancel upstream work when the client goes away.
+
+cancel_on_disconnect() runs the upstream call as a task and checks every
+DISCONNECT_POLL_SECONDS whether the client is still connected. If it closed
+the tab (or the bot gave up), the task is cancelled - that closes the httpx
+request and frees the upstream slot, lease and breaker probe on the way out -
+and ClientDisconnected is raised so the endpoint can release the coin hold
+instead of saving and billing an answer nobody will read.
+
+Streaming responses need no polling: Starlette cancels the stream itself on
+http.disconnect; record_cancelled() is called from the stream for metrics.
+"""
+import asyncio
+from collections.abc import Awaitable
+from typing import TypeVar
+
+from starlette.requests import Request
+
+from .logging import logger
+from .metrics import metrics, MetricNames
+
+DISCONNECT_POLL_SECONDS = 1.0
+# Status written to access logs for requests the client abandoned (nginx convention)
+CLIENT_CLOSED_REQUEST = 499
+
+T = TypeVar("T")
+
+
+class ClientDisconnected(Exception):
+    """The client disconnected while the upstream call was running"""
+
+    def __init__(self, endpoint: str):
+        super().__init__(f"Client disconnected during {endpoint}")
+        self.endpoint = endpoint
+
+
+def record_cancelled(endpoint: str, stage: str, **details):
+    """stage: upstream - before the answer was ready, stream - in the middle of a stream"""
+    metrics.inc_counter(MetricNames.REQUESTS_CANCELLED, labels={"endpoint": endpoint, "stage": stage})
+    logger.info(f"Request cancelled by client disconnect: {endpoint}", endpoint=endpoint, stage=stage, **details)
+
+
+async def cancel_on_disconnect(request: Request, awaitable: Awaitable[T], endpoint: str) -> T:
+    """Await the call unless the client disconnects first (then ClientDisconnected)"""
+    task = asyncio.ensure_future(awaitable)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_SECONDS)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                break
+    finally:
+        if not task.done():
+            task.cancel()
+
+    # Let the task unwind (release slots, close the connection) before billing cleanup
+    await asyncio.wait({task})
+    record_cancelled(endpoint, "upstream")
+    raise ClientDisconnected(endpoint)
@@ -0,0 +1,209 @@
+"""
+Shared pooled HTTP clients for upstream APIs.
+
+One httpx.AsyncClient per upstream for the whole process, so calls reuse
+keep-alive (and HTTP/2 where h2 is installed) connections instead of paying
+DNS + TCP + TLS on every request. Started and closed in main.lifespan.
+"""
+import asyncio
+import logging
+import math
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+import httpx
+
+from .metrics import metrics, MetricNames
+
+logger = logging.getLogger(__name__)
+
+try:
+    import h2  # noqa: F401 - enables HTTP/2 in httpx
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Retry-After header (delta-seconds or HTTP date) as seconds from now"""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+class UpstreamHTTPError(Exception):
+    """Non-success HTTP status from an upstream API"""
+
+    def __init__(self, upstream: str, status_code: int, body: str = "", retry_after: Optional[float] = None):
+        super().__init__(f"{upstream} API error: {status_code} - {body}")
+        self.upstream = upstream
+        self.status_code = status_code
+        self.body = body
+        self.retry_after = retry_after
+
+    @classmethod
+    def from_response(cls, upstream: str, response: httpx.Response, body: Optional[str] = None) -> "UpstreamHTTPError":
+        return cls(
+            upstream,
+            response.status_code,
+            response.text if body is None else body,
+            retry_after=parse_retry_after(response.headers.get("retry-after"))
+        )
+
+
+class UpstreamUnavailable(Exception):
+    """The call was not made: the upstream is down or over its rate limit for now"""
+
+    error_type = "upstream_unavailable"
+    user_message = "Модель временно недоступна. Попробуйте через {seconds} сек."
+
+    def __init__(self, message: str, upstream: str, scope: str, retry_after: float):
+        super().__init__(message)
+        self.upstream = upstream
+        self.scope = scope
+        self.retry_after = retry_after
+
+    @property
+    def retry_after_seconds(self) -> int:
+        return max(1, math.ceil(self.retry_after))
+
+    @property
+    def detail(self) -> dict:
+        """Body of the 503 response"""
+        return {
+            "error": self.user_message.format(seconds=self.retry_after_seconds),
+            "error_type": self.error_type,
+            "retry_after": self.retry_after_seconds
+        }
+
+
+class UpstreamConfig:
+    def __init__(
+        self,
+        max_connections: int,
+        max_keepalive: int,
+        timeout: float,
+        warm_url: Optional[str] = None,
+        http2: bool = True
+    ):
+        self.max_connections = max_connections
+        self.max_keepalive = max_keepalive
+        self.timeout = timeout
+        self.warm_url = warm_url
+        self.http2 = http2
+
+
+UPSTREAMS: dict[str, UpstreamConfig] = {
+    "openrouter": UpstreamConfig(100, 20, 120.0, warm_url="https://openrouter.ai/api/v1/models"),
+    "replicate": UpstreamConfig(20, 10, 300.0, warm_url="https://api.replicate.com/v1/models"),
+    "yookassa": UpstreamConfig(10, 5, 30.0, warm_url="https://api.yookassa.ru/v3/"),
+    # Arbitrary hosts (generated video downloads)
+    "downloads": UpstreamConfig(20, 5, 120.0, http2=False),
+}
+
+KEEPALIVE_EXPIRY = 60.0
+WARM_CONNECTIONS = 2
+
+
+class _PoolTransport(httpx.AsyncHTTPTransport):
+    """Counts requests that had to wait for a free pooled connection"""
+
+    def __init__(self, upstream: str, max_connections: int, **kwargs):
+        super().__init__(**kwargs)
+        self.upstream = upstream
+        self.max_connections = max_connections
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        stats = pool_stats(self)
+        if stats["idle"] == 0 and stats["in_use"] >= self.max_connections:
+            metrics.inc_counter(MetricNames.HTTP_POOL_WAITS, labels={"upstream": self.upstream})
+        return await super().handle_async_request(request)
+
+
+def pool_stats(transport: httpx.AsyncHTTPTransport) -> dict:
+    """In-use/idle connections and queued requests of a transport's connection pool"""
+    pool = getattr(transport, "_pool", None)
+    connections = list(getattr(pool, "connections", []))
+    idle = sum(1 for c in connections if c.is_idle())
+    queued = sum(1 for r in getattr(pool, "_requests", []) if getattr(r, "is_queued", lambda: False)())
+    return {"in_use": len(connections) - idle, "idle": idle, "queued": queued}
+
+
+class HTTPClientRegistry:
+    def __init__(self):
+        self._clients: dict[str, httpx.AsyncClient] = {}
+        self._transports: dict[str, _PoolTransport] = {}
+
+    def _create(self, name: str) -> httpx.AsyncClient:
+        config = UPSTREAMS[name]
+        limits = httpx.Limits(
+            max_connections=config.max_connections,
+            max_keepalive_connections=config.max_keepalive,
+            keepalive_expiry=KEEPALIVE_EXPIRY
+        )
+        transport = _PoolTransport(
+            name,
+            config.max_connections,
+            limits=limits,
+            http2=config.http2 and HTTP2_AVAILABLE,
+            retries=1  # reconnect once if a kept-alive connection was closed by the server
+        )
+        self._transports[name] = transport
+        return httpx.AsyncClient(transport=transport, timeout=config.timeout)
+
+    def get(self, name: str) -> httpx.AsyncClient:
+        """Client for an upstream (created on first use if start() was not called)"""
+        client = self._clients.get(name)
+        if client is None or client.is_closed:
+            client = self._create(name)
+            self._clients[name] = client
+        return client
+
+    async def start(self):
+        """Create all clients and pre-warm connections to known upstreams"""
+        for name in UPSTREAMS:
+            self.get(name)
+
+        async def warm(name: str, url: str):
+            try:
+                await self._clients[name].head(url, timeout=5.0)
+            except Exception as e:
+                logger.warning(f"HTTP pre-warm failed for {name}: {e}")
+
+        await asyncio.gather(*[
+            warm(name, config.warm_url)
+            for name, config in UPSTREAMS.items() if config.warm_url
+            for _ in range(WARM_CONNECTIONS)
+        ])
+
+    async def close(self):
+        for client in self._clients.values():
+            await client.aclose()
+        self._clients.clear()
+        self._transports.clear()
+
+    def stats(self) -> dict[str, dict]:
+        return {name: pool_stats(transport) for name, transport in self._transports.items()}
+
+    def record_metrics(self):
+        """Export pool gauges (called when /metrics is scraped)"""
+        for name, stats in self.stats().items():
+            labels = {"upstream": name}
+            metrics.set_gauge(MetricNames.HTTP_POOL_IN_USE, stats["in_use"], labels=labels)
+            metrics.set_gauge(MetricNames.HTTP_POOL_IDLE, stats["idle"], labels=labels)
+            metrics.set_gauge(MetricNames.HTTP_POOL_QUEUED, stats["queued"], labels=labels)
+
+
+http_clients = HTTPClientRegistry()
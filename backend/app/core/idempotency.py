@@ -0,0 +1,156 @@
+"""
+Idempotency-Key support for paid generation endpoints.
+
+Clients that retry on a network timeout send the same Idempotency-Key
+header. The first request with a key stores an in-progress record in Redis
+(per endpoint and user); when it succeeds the serialized response replaces
+it for IDEMPOTENCY_TTL_SECONDS. A replay either returns that response or, while
+the original is still running, waits for it - it never calls the upstream or
+bills a second time.
+
+A failed request deletes its record (the coin hold was released, nothing was
+charged), so a retry with the same key runs again. A key reused with a
+different request body is rejected with 422. While the request runs its
+in-progress record is refreshed every IN_PROGRESS_SECONDS / 3, so a slow
+upstream chain (failover, hedging, retries) cannot outlive it and let a retry
+run and bill twice; if the worker dies the record expires on its own.
+Without Redis requests run as usual.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import time
+from collections.abc import Awaitable, Callable
+from typing import Any, Optional
+
+from fastapi import HTTPException, status
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+
+from .cache import cache
+from .metrics import metrics, MetricNames
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENCY_TTL_SECONDS = 86400
+MAX_KEY_LENGTH = 255
+POLL_SECONDS = 0.5
+IN_PROGRESS = "in_progress"
+DONE = "done"
+
+# TTL of the in-progress record (refreshed while the request runs) and how long a replay waits for it
+IN_PROGRESS_SECONDS = {
+    "chat": 180,
+    "images": 600,
+    "videos": 1200,
+}
+
+
+def fingerprint(payload: Any) -> str:
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def _count(endpoint: str, outcome: str):
+    metrics.inc_counter(MetricNames.IDEMPOTENCY_REQUESTS, labels={"endpoint": endpoint, "outcome": outcome})
+
+
+async def _keep_in_progress(redis, key: str, ttl: int):
+    """Extend the in-progress record until cancelled"""
+    while True:
+        await asyncio.sleep(ttl / 3)
+        try:
+            await redis.expire(key, ttl)
+        except Exception as e:
+            logger.warning(f"Failed to refresh idempotency key {key}: {e}")
+
+
+async def run_idempotent(
+    endpoint: str,
+    user_id: int,
+    idempotency_key: Optional[str],
+    payload: Any,
+    response_model: type[BaseModel],
+    fn: Callable[[], Awaitable[Any]]
+) -> Any:
+    """
+    fn() once per (endpoint, user, key). payload is the request body (a reused
+    key must come with the same one); response_model serializes the stored result.
+    """
+    if not idempotency_key:
+        return await fn()
+    if len(idempotency_key) > MAX_KEY_LENGTH:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Idempotency-Key is too long")
+
+    redis = await cache.client()
+    if redis is None:
+        return await fn()
+
+    key = f"idempotency:{endpoint}:{user_id}:{idempotency_key}"
+    request_hash = fingerprint(payload)
+    in_progress_seconds = IN_PROGRESS_SECONDS.get(endpoint, 300)
+    deadline = time.monotonic() + in_progress_seconds
+    waited = False
+
+    try:
+        while True:
+            record = json.dumps({"state": IN_PROGRESS, "fingerprint": request_hash})
+            if await redis.set(key, record, nx=True, ex=in_progress_seconds):
+                break  # this request owns the key
+
+            stored = await redis.get(key)
+            if stored is None:
+                continue  # the original failed and released the key - take it over
+            stored = json.loads(stored)
+            if stored["fingerprint"] != request_hash:
+                _count(endpoint, "mismatch")
+                raise HTTPException(
+                    status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                    detail="Idempotency-Key was already used with a different request"
+                )
+            if stored["state"] == DONE:
+                _count(endpoint, "replayed_after_wait" if waited else "replayed")
+                return JSONResponse(content=stored["response"], headers={"Idempotent-Replayed": "true"})
+            if time.monotonic() >= deadline:
+                _count(endpoint, "conflict")
+                raise HTTPException(
+                    status_code=status.HTTP_409_CONFLICT,
+                    detail="A request with this Idempotency-Key is still in progress",
+                    headers={"Retry-After": "5"}
+                )
+            waited = True
+            await asyncio.sleep(POLL_SECONDS)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.warning(f"Idempotency check failed for {endpoint}: {e}")
+        return await fn()
+
+    _count(endpoint, "new")
+    heartbeat = asyncio.ensure_future(_keep_in_progress(redis, key, in_progress_seconds))
+    try:
+        result = await fn()
+    except BaseException:
+        try:
+            await redis.delete(key)
+        except Exception as e:
+            # Expires with the in-progress TTL
+            logger.warning(f"Failed to release idempotency key for {endpoint}: {e}")
+        raise
+    finally:
+        heartbeat.cancel()
+
+    try:
+        response = response_model.model_validate(result).model_dump(mode="json")
+        await redis.set(
+            key,
+            json.dumps({"state": DONE, "fingerprint": request_hash, "response": response}),
+            ex=IDEMPOTENCY_TTL_SECONDS
+        )
+    except Exception as e:
+        logger.warning(f"Failed to store idempotent response for {endpoint}: {e}")
+        try:
+            await redis.delete(key)  # replays must not wait for a record that never completes
+        except Exception as e:
+            logger.warning(f"Failed to release idempotency key for {endpoint}: {e}")
+    return result
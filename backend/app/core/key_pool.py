@@ -0,0 +1,211 @@
+"""
+API key pools for upstream providers.
+
+Several accounts can be configured per provider (OPENROUTER_API_KEYS,
+REPLICATE_API_TOKENS: comma-separated "key" or "key:weight"); the single-key
+settings are used when the list is empty. Each call picks a healthy key at
+random in proportion to its weight.
+
+When the pool has more than one key, a key that answers 401 (revoked) or
+402 (out of credit) is taken out of rotation for KEY_DISABLE_SECONDS, on 429
+for Retry-After (or KEY_RATE_LIMITED_SECONDS). The disabled state is shared
+through Redis so other workers stop using the key too. Spend per key is reported as a counter
+and accumulated in Redis for the admin API. Keys are identified in metrics,
+logs and the admin API by a short hash, never by the secret.
+"""
+import hashlib
+import logging
+import random
+import time
+from typing import Optional
+
+import httpx
+
+from .cache import cache
+from .config import settings
+from .http import UpstreamHTTPError, UpstreamUnavailable, parse_retry_after
+from .metrics import metrics, MetricNames
+
+logger = logging.getLogger(__name__)
+
+KEY_DISABLE_SECONDS = 3600
+KEY_RATE_LIMITED_SECONDS = 60
+# How often a worker picks up keys disabled by other workers
+SHARED_STATE_REFRESH_SECONDS = 5.0
+
+
+class NoHealthyKeyError(UpstreamUnavailable):
+    """Every key of the pool is disabled"""
+
+    def __init__(self, pool: str, retry_after: float):
+        super().__init__(f"No healthy {pool} API key, retry in {retry_after:.0f}s", pool, "keys", retry_after)
+
+
+class APIKey:
+    def __init__(self, secret: str, weight: float = 1.0):
+        self.secret = secret
+        self.weight = weight
+        self.id = hashlib.sha256(secret.encode("utf-8")).hexdigest()[:8]
+        self.disabled_until = 0.0
+        self.disabled_reason: Optional[str] = None
+
+    def is_healthy(self, now: float) -> bool:
+        return self.disabled_until <= now
+
+    def headers(self, base: dict) -> dict:
+        """Request headers with this key's Authorization"""
+        return {**base, "Authorization": f"Bearer {self.secret}"}
+
+
+def parse_keys(raw: Optional[str], fallback: Optional[str]) -> list[APIKey]:
+    keys = []
+    for item in (raw or "").split(","):
+        item = item.strip()
+        if not item:
+            continue
+        secret, _, weight = item.rpartition(":")
+        try:
+            keys.append(APIKey(secret, float(weight)) if secret else APIKey(item))
+        except ValueError:
+            keys.append(APIKey(item))  # the key itself contains ':'
+    if not keys and fallback:
+        keys.append(APIKey(fallback))
+    return keys
+
+
+class KeyPool:
+    def __init__(self, name: str, keys: list[APIKey]):
+        self.name = name
+        self.keys = keys
+        self._refreshed = 0.0
+
+    def __bool__(self) -> bool:
+        return bool(self.keys)
+
+    def _state_key(self, key: APIKey) -> str:
+        return f"keypool:{self.name}:{key.id}:disabled"
+
+    async def _refresh_shared_state(self):
+        now = time.monotonic()
+        if now - self._refreshed < SHARED_STATE_REFRESH_SECONDS or len(self.keys) < 2:
+            return
+        self._refreshed = now
+        redis = await cache.client()
+        if redis is None:
+            return
+        try:
+            async with redis.pipeline(transaction=False) as pipe:
+                for key in self.keys:
+                    pipe.hgetall(self._state_key(key))
+                states = await pipe.execute()
+        except Exception as e:
+            logger.warning(f"Key pool {self.name}: shared state refresh failed: {e}")
+            return
+        for key, state in zip(self.keys, states):
+            if state:
+                key.disabled_until = max(key.disabled_until, float(state["until"]))
+                key.disabled_reason = state.get("reason")
+
+    async def choose(self) -> APIKey:
+        """A healthy key, weighted at random"""
+        if not self.keys:
+            raise NoHealthyKeyError(self.name, KEY_DISABLE_SECONDS)
+        await self._refresh_shared_state()
+
+        now = time.time()
+        healthy = [key for key in self.keys if key.is_healthy(now)]
+        if not healthy:
+            retry_after = min(key.disabled_until for key in self.keys) - now
+            raise NoHealthyKeyError(self.name, retry_after)
+        return random.choices(healthy, weights=[key.weight for key in healthy])[0]
+
+    async def report(self, key: APIKey, response: httpx.Response):
+        """Count the response and take the key out of rotation on 401/402/429"""
+        status_code = response.status_code
+        metrics.inc_counter(
+            MetricNames.KEY_POOL_REQUESTS,
+            labels={"pool": self.name, "key": key.id, "status": str(status_code)}
+        )
+        if len(self.keys) < 2:
+            return  # with a single key there is nothing to rotate to
+        if status_code in (401, 402):
+            await self.disable(key, KEY_DISABLE_SECONDS, "unauthorized" if status_code == 401 else "no_credit")
+        elif status_code == 429:
+            retry_after = parse_retry_after(response.headers.get("retry-after")) or KEY_RATE_LIMITED_SECONDS
+            await self.disable(key, retry_after, "rate_limited")
+
+    def error(self, key: APIKey, upstream: str, response: httpx.Response, body: Optional[str] = None) -> UpstreamHTTPError:
+        """Error for a failed response; after a 429 the retry goes to another key without waiting"""
+        error = UpstreamHTTPError.from_response(upstream, response, body)
+        now = time.time()
+        if response.status_code == 429 and not key.is_healthy(now) and any(k.is_healthy(now) for k in self.keys):
+            error.retry_after = None
+        return error
+
+    async def disable(self, key: APIKey, seconds: float, reason: str):
+        key.disabled_until = time.time() + seconds
+        key.disabled_reason = reason
+        metrics.inc_counter(MetricNames.KEY_POOL_DISABLED, labels={"pool": self.name, "key": key.id, "reason": reason})
+        logger.warning(f"Key pool {self.name}: key {key.id} disabled for {seconds:.0f}s ({reason})")
+
+        redis = await cache.client()
+        if redis is None:
+            return
+        try:
+            async with redis.pipeline(transaction=True) as pipe:
+                pipe.hset(self._state_key(key), mapping={"until": key.disabled_until, "reason": reason})
+                pipe.expire(self._state_key(key), max(1, int(seconds)))
+                await pipe.execute()
+        except Exception as e:
+            logger.warning(f"Key pool {self.name}: failed to share disabled key {key.id}: {e}")
+
+    async def record_spend(self, key: APIKey, cost_usd: float):
+        if not cost_usd:
+            return
+        metrics.inc_counter(MetricNames.KEY_POOL_SPEND_USD, cost_usd, labels={"pool": self.name, "key": key.id})
+        redis = await cache.client()
+        if redis is None:
+            return
+        try:
+            await redis.hincrbyfloat(f"keypool:{self.name}:spend", key.id, cost_usd)
+        except Exception as e:
+            logger.warning(f"Failed to record spend for key {self.name}/{key.id}: {e}")
+
+    async def status(self) -> dict:
+        """Keys with health and total spend (for the admin API)"""
+        await self._refresh_shared_state()
+        spend: dict[str, str] = {}
+        redis = await cache.client()
+        if redis is not None:
+            try:
+                spend = await redis.hgetall(f"keypool:{self.name}:spend") or {}
+            except Exception as e:
+                logger.warning(f"Failed to read key spend for {self.name}: {e}")
+
+        now = time.time()
+        return {
+            "pool": self.name,
+            "keys": [
+                {
+                    "id": key.id,
+                    "weight": key.weight,
+                    "healthy": key.is_healthy(now),
+                    "disabled_for": max(0, round(key.disabled_until - now)),
+                    "disabled_reason": key.disabled_reason if not key.is_healthy(now) else None,
+                    "spend_usd": round(float(spend.get(key.id, 0)), 4)
+                }
+                for key in self.keys
+            ]
+        }
+
+    def record_metrics(self):
+        now = time.time()
+        metrics.set_gauge(
+            MetricNames.KEY_POOL_HEALTHY,
+            sum(1 for key in self.keys if key.is_healthy(now)),
+            labels={"pool": self.name}
+        )
+
+
+openrouter_keys = KeyPool("openrouter", parse_keys(settings.OPENROUTER_API_KEYS, settings.OPENROUTER_API_KEY))
+replicate_keys = KeyPool("replicate", parse_keys(settings.REPLICATE_API_TOKENS, settings.REPLICATE_API_TOKEN))
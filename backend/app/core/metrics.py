@@ -108,6 +108,57 @@ class MetricNames:
     ACTIVE_USERS = "lana_active_users"
     AUTH_ATTEMPTS = "lana_auth_attempts_total"
     ERRORS_TOTAL = "lana_errors_total"
+    DB_POOL_CHECKED_OUT = "lana_db_pool_checked_out"
+    DB_CONNECTIONS_HELD_ACROSS_AWAIT = "lana_db_connections_held_across_await_total"
+    DB_ROUND_TRIPS = "lana_db_round_trips"
+    CHAT_RETENTION_DELETED = "lana_chat_retention_deleted_messages_total"
+    CHAT_RETENTION_CONVERSATIONS = "lana_chat_retention_trimmed_conversations_total"
+    CONTEXT_CACHE_HITS = "lana_context_cache_hits_total"
+    CONTEXT_CACHE_MISSES = "lana_context_cache_misses_total"
+    CONTEXT_CACHE_HIT_RATIO = "lana_context_cache_hit_ratio"
+    CONTEXT_TOKENS_SAVED = "lana_context_input_tokens_saved_total"
+    CONTEXT_SUMMARIES = "lana_context_summaries_total"
+    PROMPT_INPUT_TOKENS = "lana_prompt_input_tokens_total"
+    PROMPT_CACHED_TOKENS = "lana_prompt_cached_tokens_total"
+    AI_UPSTREAM_SECONDS = "lana_ai_upstream_seconds"
+    RESPONSE_CACHE_HITS = "lana_response_cache_hits_total"
+    RESPONSE_CACHE_MISSES = "lana_response_cache_misses_total"
+    RESPONSE_CACHE_EVICTIONS = "lana_response_cache_evictions_total"
+    RESPONSE_CACHE_HIT_SECONDS = "lana_response_cache_hit_seconds"
+    RESPONSE_CACHE_COINS_SAVED = "lana_response_cache_coins_saved_total"
+    SINGLEFLIGHT_COALESCED = "lana_singleflight_coalesced_total"
+    NEAR_DUP_HITS = "lana_near_dup_hits_total"
+    NEAR_DUP_MISSES = "lana_near_dup_misses_total"
+    NEAR_DUP_LOOKUP_SECONDS = "lana_near_dup_lookup_seconds"
+    HTTP_POOL_WAITS = "lana_http_pool_waits_total"
+    HTTP_POOL_IN_USE = "lana_http_pool_in_use"
+    HTTP_POOL_IDLE = "lana_http_pool_idle"
+    HTTP_POOL_QUEUED = "lana_http_pool_queued"
+    FAILOVER_ATTEMPTS = "lana_failover_attempts_total"
+    HEDGES_FIRED = "lana_hedges_fired_total"
+    RETRIES = "lana_upstream_retries_total"
+    RETRY_GIVEUPS = "lana_upstream_retry_giveups_total"
+    RETRY_BUDGET_TOKENS = "lana_retry_budget_tokens"
+    CIRCUIT_STATE = "lana_circuit_state"
+    CIRCUIT_TRANSITIONS = "lana_circuit_transitions_total"
+    CIRCUIT_REJECTED = "lana_circuit_rejected_total"
+    RATE_LIMIT_WAIT_SECONDS = "lana_upstream_rate_limit_wait_seconds"
+    RATE_LIMIT_REJECTED = "lana_upstream_rate_limit_rejected_total"
+    KEY_POOL_REQUESTS = "lana_key_pool_requests_total"
+    KEY_POOL_DISABLED = "lana_key_pool_disabled_total"
+    KEY_POOL_SPEND_USD = "lana_key_pool_spend_usd_total"
+    KEY_POOL_HEALTHY = "lana_key_pool_healthy_keys"
+    ADMISSION_LIMIT = "lana_admission_limit"
+    ADMISSION_INFLIGHT = "lana_admission_inflight"
+    ADMISSION_SHED = "lana_admission_shed_total"
+    SCHEDULER_WAIT_SECONDS = "lana_upstream_queue_wait_seconds"
+    SCHEDULER_TIMEOUTS = "lana_upstream_queue_timeouts_total"
+    SCHEDULER_QUEUE_DEPTH = "lana_upstream_queue_depth"
+    SCHEDULER_SLOTS_FREE = "lana_upstream_slots_free"
+    USER_CONCURRENCY_REJECTED = "lana_user_concurrency_rejected_total"
+    USER_CONCURRENCY_WAIT_SECONDS = "lana_user_concurrency_wait_seconds"
+    REQUESTS_CANCELLED = "lana_requests_cancelled_total"
+    IDEMPOTENCY_REQUESTS = "lana_idempotency_requests_total"
 
 
 # Helper functions
@@ -1,72 +1,30 @@
 """
-Retry decorator for external API calls
+Retries for external API calls
+
+Only transient failures are retried: RETRYABLE_HTTP_CODES and connection
+errors. Non-idempotent calls (creating a prediction, generating an image)
+are retried only when the upstream certainly did not process the request:
+the connection was never established, or it answered 429.
+
+Every retry is paid from a process-wide retry budget (token bucket): each
+first attempt adds RETRY_BUDGET_RATIO tokens, each retry takes one, with a
+small time-based floor so rare calls can still retry. During a provider
+brownout retries stay a bounded fraction of live traffic instead of
+multiplying it. Retry-After from the upstream is honored; if it asks to wait
+longer than max_delay, the error is raised right away.
 """
 import asyncio
-from functools import wraps
-from typing import Type, Tuple, Callable
 import random
-from .logging import logger, log_error
+import time
+from functools import wraps
+from collections.abc import Awaitable, Callable
+from typing import Optional
 
+import httpx
 
-def async_retry(
-    max_attempts: int = 3,
-    delay: float = 1.0,
-    backoff: float = 2.0,
-    exceptions: Tuple[Type[Exception], ...] = (Exception,),
-    jitter: bool = True
-):
-    """
-    Async retry decorator with exponential backoff
-
-    Args:
-        max_attempts: Maximum number of retry attempts
-        delay: Initial delay between retries (seconds)
-        backoff: Multiplier for delay after each retry
-        exceptions: Tuple of exceptions to catch and retry
-        jitter: Add random jitter to delay
-    """
-    def decorator(func: Callable):
-        @wraps(func)
-        async def wrapper(*args, **kwargs):
-            last_exception = None
-            current_delay = delay
-
-            for attempt in range(1, max_attempts + 1):
-                try:
-                    return await func(*args, **kwargs)
-                except exceptions as e:
-                    last_exception = e
-
-                    if attempt == max_attempts:
-                        logger.error(
-                            f"Retry exhausted for {func.__name__}",
-                            function=func.__name__,
-                            attempts=attempt,
-                            error=str(e)
-                        )
-                        raise
-
-                    # Calculate delay with optional jitter
-                    wait_time = current_delay
-                    if jitter:
-                        wait_time += random.uniform(0, current_delay * 0.5)
-
-                    logger.warning(
-                        f"Retry attempt {attempt}/{max_attempts} for {func.__name__}",
-                        function=func.__name__,
-                        attempt=attempt,
-                        max_attempts=max_attempts,
-                        error=str(e),
-                        next_delay=round(wait_time, 2)
-                    )
-
-                    await asyncio.sleep(wait_time)
-                    current_delay *= backoff
-
-            raise last_exception
-
-        return wrapper
-    return decorator
+from .http import UpstreamHTTPError
+from .logging import logger
+from .metrics import metrics, MetricNames
 
 
 class RetryableError(Exception):
@@ -82,7 +40,156 @@ class NonRetryableError(Exception):
 # Common HTTP errors that should be retried
 RETRYABLE_HTTP_CODES = {408, 429, 500, 502, 503, 504}
 
+# Retries allowed per first attempt (10% of live traffic) and the floor for idle periods
+RETRY_BUDGET_RATIO = 0.1
+RETRY_BUDGET_MIN_PER_SECOND = 0.5
+RETRY_BUDGET_MAX_TOKENS = 50.0
+
 
 def should_retry_http(status_code: int) -> bool:
     """Check if HTTP status code should trigger retry"""
     return status_code in RETRYABLE_HTTP_CODES
+
+
+def retry_reason(error: BaseException, idempotent: bool = True) -> Optional[str]:
+    """Why the call may be retried (metric label), or None if it must not be"""
+    if isinstance(error, NonRetryableError):
+        return None
+    if isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout)):
+        return "connect"
+    if isinstance(error, UpstreamHTTPError):
+        if error.status_code == 429:
+            return "429"
+        if idempotent and should_retry_http(error.status_code):
+            return str(error.status_code)
+        return None
+    if idempotent and isinstance(error, RetryableError):
+        return "retryable"
+    return None
+
+
+class RetryBudget:
+    """Token bucket shared by all upstream calls of the process"""
+
+    def __init__(self, ratio: float, min_per_second: float, max_tokens: float):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_tokens = max_tokens
+        self._tokens = max_tokens
+        self._updated = time.monotonic()
+
+    def _refill(self, amount: float = 0.0):
+        now = time.monotonic()
+        self._tokens = min(
+            self.max_tokens,
+            self._tokens + amount + (now - self._updated) * self.min_per_second
+        )
+        self._updated = now
+
+    def deposit(self):
+        """Called once per logical call (first attempt)"""
+        self._refill(self.ratio)
+
+    def try_withdraw(self) -> bool:
+        """Take one token for a retry; False when the budget is spent"""
+        self._refill()
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+    @property
+    def tokens(self) -> float:
+        self._refill()
+        return self._tokens
+
+
+retry_budget = RetryBudget(RETRY_BUDGET_RATIO, RETRY_BUDGET_MIN_PER_SECOND, RETRY_BUDGET_MAX_TOKENS)
+
+
+async def retry_call(
+    upstream: str,
+    fn: Callable[[], Awaitable],
+    idempotent: bool = True,
+    max_attempts: int = 3,
+    delay: float = 0.5,
+    backoff: float = 2.0,
+    max_delay: float = 10.0,
+    deposit: bool = True
+):
+    """
+    Call fn() and retry transient failures within the retry budget.
+
+    Args:
+        upstream: Upstream name for metrics and logs (see core.http.UPSTREAMS)
+        fn: Makes one attempt; raises UpstreamHTTPError on a bad status
+        idempotent: Whether repeating a possibly processed request is safe
+        max_attempts: Attempts including the first one
+        delay: Initial backoff (full jitter is applied)
+        backoff: Multiplier for the backoff after each retry
+        max_delay: Longest wait before a retry, including Retry-After
+        deposit: Whether the call adds to the retry budget; False for repeated
+            status polls, so a long poll loop does not bank retries for others
+    """
+    if deposit:
+        retry_budget.deposit()
+    current_delay = delay
+
+    for attempt in range(1, max_attempts + 1):
+        try:
+            return await fn()
+        except Exception as e:
+            reason = retry_reason(e, idempotent)
+            if reason is None or attempt == max_attempts:
+                raise
+
+            wait_time = random.uniform(0, current_delay)
+            retry_after = getattr(e, "retry_after", None)
+            if retry_after is not None:
+                if retry_after > max_delay:
+                    metrics.inc_counter(MetricNames.RETRY_GIVEUPS, labels={"upstream": upstream, "reason": "retry_after"})
+                    raise
+                wait_time = max(wait_time, retry_after)
+
+            if not retry_budget.try_withdraw():
+                metrics.inc_counter(MetricNames.RETRY_GIVEUPS, labels={"upstream": upstream, "reason": "budget"})
+                raise
+
+            metrics.inc_counter(MetricNames.RETRIES, labels={"upstream": upstream, "reason": reason})
+            logger.warning(
+                f"Retry attempt {attempt}/{max_attempts} for {upstream}",
+                upstream=upstream,
+                attempt=attempt,
+                reason=reason,
+                error=str(e),
+                next_delay=round(wait_time, 2)
+            )
+
+            await asyncio.sleep(wait_time)
+            current_delay = min(current_delay * backoff, max_delay)
+
+
+def async_retry(
+    upstream: str,
+    idempotent: bool = True,
+    max_attempts: int = 3,
+    delay: float = 0.5,
+    backoff: float = 2.0,
+    max_delay: float = 10.0
+):
+    """Decorator form of retry_call"""
+    def decorator(func: Callable):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            return await retry_call(
+                upstream,
+                lambda: func(*args, **kwargs),
+                idempotent=idempotent,
+                max_attempts=max_attempts,
+                delay=delay,
+                backoff=backoff,
+                max_delay=max_delay
+            )
+
+        return wrapper
+    return decorator
@@ -0,0 +1,200 @@
+"""
+Priority lanes for upstream calls.
+
+Every worker has a fixed number of concurrent upstream slots per provider
+(UPSTREAM_SLOTS_*). While slots are free calls go straight through; once they
+are all taken, callers queue and each freed slot is handed out by weighted
+fair queuing across lanes (stride scheduling: the lane that has received the
+least service relative to its weight goes next), and round-robin between
+users inside the lane, so one user flooding a lane only delays themselves.
+
+The lane comes from the user: an active subscription, any deposit, then the
+request source - free Telegram bot traffic gets its own, lightest lane. It is
+set per request with set_request_lane() and picked up by upstream_slot()
+deep inside the services through a context variable. Calls made outside a
+request (background jobs) use the free lane.
+
+A caller that waits longer than UPSTREAM_QUEUE_TIMEOUT_SECONDS gets
+UpstreamQueueTimeout (503 with Retry-After in the API).
+"""
+import asyncio
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Optional
+
+from .config import settings
+from .http import UpstreamUnavailable
+from .metrics import metrics, MetricNames
+
+LANE_SUBSCRIBER = "subscriber"
+LANE_PAID = "paid"
+LANE_FREE = "free"
+LANE_BOT = "bot"
+
+# Share of freed slots each lane gets while all of them are queued
+LANE_WEIGHTS = {
+    LANE_SUBSCRIBER: 8,
+    LANE_PAID: 6,
+    LANE_FREE: 2,
+    LANE_BOT: 1,
+}
+
+FREE_PLANS = {"", "none", "free"}
+
+_request_lane: ContextVar[Optional[tuple[str, int]]] = ContextVar("upstream_lane", default=None)
+
+
+class UpstreamQueueTimeout(UpstreamUnavailable):
+    """No upstream slot freed up in time"""
+
+    error_type = "overloaded"
+    user_message = "Сервис перегружен. Попробуйте через {seconds} сек."
+
+    def __init__(self, pool: str, lane: str, retry_after: float):
+        super().__init__(f"No {pool} slot for lane {lane} in {retry_after:.0f}s", pool, lane, retry_after)
+
+
+def lane_for(
+    subscription_plan: Optional[str],
+    subscription_expires: Optional[datetime],
+    total_deposited: Optional[int],
+    source: Optional[str]
+) -> str:
+    plan = (subscription_plan or "").lower()
+    if plan not in FREE_PLANS and (subscription_expires is None or subscription_expires > datetime.utcnow()):
+        return LANE_SUBSCRIBER
+    if (total_deposited or 0) > 0:
+        return LANE_PAID
+    if source == "telegram":
+        return LANE_BOT
+    return LANE_FREE
+
+
+def set_request_lane(user, source: Optional[str] = "web") -> str:
+    """Route this request's upstream calls through the user's lane"""
+    lane = lane_for(
+        getattr(user, "subscription_plan", None),
+        getattr(user, "subscription_expires", None),
+        getattr(user, "total_deposited", None),
+        source
+    )
+    _request_lane.set((lane, user.id))
+    return lane
+
+
+class _Lane:
+    def __init__(self, name: str, weight: int):
+        self.name = name
+        self.stride = 1.0 / weight
+        self.pass_value = 0.0
+        # user_id -> waiters of that user, in round-robin order
+        self.users: "OrderedDict[int, deque]" = OrderedDict()
+        self.size = 0
+
+    def push(self, user_id: int, waiter: asyncio.Future):
+        self.users.setdefault(user_id, deque()).append(waiter)
+        self.size += 1
+
+    def pop(self) -> asyncio.Future:
+        user_id, waiters = next(iter(self.users.items()))
+        waiter = waiters.popleft()
+        if waiters:
+            self.users.move_to_end(user_id)
+        else:
+            del self.users[user_id]
+        self.size -= 1
+        return waiter
+
+    def remove(self, user_id: int, waiter: asyncio.Future):
+        waiters = self.users.get(user_id)
+        if waiters is None or waiter not in waiters:
+            return
+        waiters.remove(waiter)
+        if not waiters:
+            del self.users[user_id]
+        self.size -= 1
+
+
+class UpstreamScheduler:
+    def __init__(self, name: str, slots: int):
+        self.name = name
+        self.slots = slots
+        self.free = slots
+        self._lanes: dict[str, _Lane] = {
+            lane: _Lane(lane, weight) for lane, weight in LANE_WEIGHTS.items()
+        }
+        # Virtual time: pass value of the lane served last
+        self._virtual_time = 0.0
+
+    def queued(self) -> int:
+        return sum(lane.size for lane in self._lanes.values())
+
+    async def acquire(self, lane_name: str, user_id: int):
+        labels = {"pool": self.name, "lane": lane_name}
+        if self.free > 0 and not self.queued():
+            self.free -= 1
+            metrics.observe_histogram(MetricNames.SCHEDULER_WAIT_SECONDS, 0.0, labels=labels)
+            return
+
+        lane = self._lanes[lane_name]
+        if not lane.size:
+            # An idle lane does not bank credit for the time it had nothing queued
+            lane.pass_value = max(lane.pass_value, self._virtual_time)
+        waiter = asyncio.get_running_loop().create_future()
+        lane.push(user_id, waiter)
+        started = time.perf_counter()
+        timeout = settings.UPSTREAM_QUEUE_TIMEOUT_SECONDS
+        try:
+            await asyncio.wait_for(waiter, timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.done() and not waiter.cancelled():
+                self.release()  # the slot was handed over just as we gave up
+            else:
+                lane.remove(user_id, waiter)
+            if isinstance(e, asyncio.TimeoutError):
+                metrics.inc_counter(MetricNames.SCHEDULER_TIMEOUTS, labels=labels)
+                raise UpstreamQueueTimeout(self.name, lane_name, timeout) from None
+            raise
+        metrics.observe_histogram(MetricNames.SCHEDULER_WAIT_SECONDS, time.perf_counter() - started, labels=labels)
+
+    def release(self):
+        while True:
+            active = [lane for lane in self._lanes.values() if lane.size]
+            if not active:
+                self.free += 1
+                return
+            lane = min(active, key=lambda lane: lane.pass_value)
+            self._virtual_time = lane.pass_value
+            lane.pass_value += lane.stride
+            waiter = lane.pop()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+
+    @asynccontextmanager
+    async def slot(self):
+        lane, user_id = _request_lane.get() or (LANE_FREE, 0)
+        await self.acquire(lane, user_id)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def record_metrics(self):
+        metrics.set_gauge(MetricNames.SCHEDULER_SLOTS_FREE, self.free, labels={"pool": self.name})
+        for lane in self._lanes.values():
+            metrics.set_gauge(MetricNames.SCHEDULER_QUEUE_DEPTH, lane.size, labels={"pool": self.name, "lane": lane.name})
+
+
+upstream_schedulers = {
+    "openrouter": UpstreamScheduler("openrouter", settings.UPSTREAM_SLOTS_OPENROUTER),
+    "replicate": UpstreamScheduler("replicate", settings.UPSTREAM_SLOTS_REPLICATE),
+}
+
+
+def upstream_slot(pool: str):
+    """async with upstream_slot("openrouter"): one upstream call in the request's lane"""
+    return upstream_schedulers[pool].slot()
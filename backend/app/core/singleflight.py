@@ -0,0 +1,200 @@
+"""
+Singleflight: concurrent identical calls share one upstream request.
+
+Inside a worker, callers with the same key await the same task.
+Across workers, the first one takes a Redis lock holding a flight id and
+publishes the result on a pub/sub channel (and in a short-lived result key
+for followers that subscribe late); the others read the flight id from the
+lock and wait for that flight's result instead of calling upstream. Results
+are keyed by flight, so a later flight with the same key never reads them. Upstream HTTP errors,
+timeouts and transport errors are published with their details and re-raised
+as the same kind of error on the followers, so retries, failover and circuit
+breakers see them as if the call had failed locally. For any other failure,
+or if Redis is unavailable or the leader disappears, callers fall back to
+making the call themselves.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import uuid
+from collections.abc import Awaitable, Callable
+from typing import Any, Optional
+
+import httpx
+
+from .cache import cache
+from .http import UpstreamHTTPError
+from .metrics import metrics, MetricNames
+
+logger = logging.getLogger(__name__)
+
+RESULT_TTL = 30  # seconds a finished result stays available to followers of that flight
+
+
+class SingleFlightError(Exception):
+    """Upstream call failed in another worker that was leading the flight"""
+
+
+def error_payload(error: Exception) -> Optional[dict]:
+    """What followers need to re-raise the leader's error; None - they call upstream themselves"""
+    if isinstance(error, UpstreamHTTPError):
+        return {
+            "kind": "http",
+            "upstream": error.upstream,
+            "status_code": error.status_code,
+            "body": error.body,
+            "retry_after": error.retry_after
+        }
+    if isinstance(error, asyncio.TimeoutError):
+        return {"kind": "timeout", "error": str(error)}
+    if isinstance(error, httpx.TransportError):
+        return {"kind": "transport", "error": str(error)}
+    return None
+
+
+def error_from_payload(payload: dict) -> Exception:
+    kind = payload.get("kind")
+    if kind == "http":
+        return UpstreamHTTPError(payload["upstream"], payload["status_code"], payload["body"], payload["retry_after"])
+    if kind == "timeout":
+        return asyncio.TimeoutError(payload["error"])
+    if kind == "transport":
+        return httpx.TransportError(payload["error"])
+    return SingleFlightError(payload.get("error", "upstream call failed"))
+
+
+def make_key(*parts: Any) -> str:
+    """Stable hash of JSON-serializable call arguments"""
+    payload = json.dumps(parts, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class SingleFlight:
+    def __init__(self, name: str, timeout: float):
+        self.name = name
+        self.timeout = timeout
+        self._inflight: dict[str, asyncio.Task] = {}
+        self._waiters: dict[str, int] = {}
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """Run fn once per key among concurrent callers; result must be JSON-serializable"""
+        task = self._inflight.get(key)
+        if task is not None:
+            metrics.inc_counter(MetricNames.SINGLEFLIGHT_COALESCED, labels={"operation": self.name, "scope": "local"})
+        else:
+            task = asyncio.ensure_future(self._run_shared(key, fn))
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._done(key, t))
+
+        # shield: one caller going away must not cancel the call for the others;
+        # the call itself is cancelled when the last caller is gone
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if self._waiters.get(key) == 1 and not task.done():
+                task.cancel()
+            raise
+        finally:
+            self._waiters[key] -= 1
+            if self._waiters[key] <= 0:
+                del self._waiters[key]
+
+    def _done(self, key: str, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            task.exception()  # mark as retrieved even if every caller went away
+
+    async def _run_shared(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        redis = await cache.client()
+        if redis is None:
+            return await fn()
+
+        lock_key = f"singleflight:{self.name}:{key}:lock"
+        channel = f"singleflight:{self.name}:{key}"
+        flight_id = uuid.uuid4().hex
+
+        try:
+            is_leader = await redis.set(lock_key, flight_id, nx=True, ex=int(self.timeout))
+            if not is_leader:
+                flight_id = await redis.get(lock_key)
+        except Exception:
+            return await fn()
+
+        if not is_leader:
+            if flight_id is None:
+                # The flight ended between the two commands - nothing to join
+                return await fn()
+            payload = await self._wait_for_leader(redis, channel, flight_id, lock_key)
+            if payload is not None and "result" in payload:
+                metrics.inc_counter(MetricNames.SINGLEFLIGHT_COALESCED, labels={"operation": self.name, "scope": "redis"})
+                return payload["result"]
+            if payload is not None and payload.get("kind"):
+                metrics.inc_counter(MetricNames.SINGLEFLIGHT_COALESCED, labels={"operation": self.name, "scope": "redis"})
+                raise error_from_payload(payload)
+            # Leader timed out, crashed or failed in a way we cannot reproduce - call upstream ourselves
+            return await fn()
+
+        payload = None
+        try:
+            result = await fn()
+            payload = {"result": result}
+            return result
+        except Exception as e:
+            # Without a reproducible error followers get {} and make the call themselves
+            payload = error_payload(e) or {}
+            raise
+        finally:
+            # On cancellation payload stays None: only the lock is dropped and followers fall back
+            await self._publish(redis, channel, flight_id, lock_key, payload)
+
+    def _result_key(self, channel: str, flight_id: str) -> str:
+        return f"{channel}:result:{flight_id}"
+
+    async def _wait_for_leader(self, redis, channel: str, flight_id: str, lock_key: str):
+        result_key = self._result_key(channel, flight_id)
+        pubsub = redis.pubsub()
+        try:
+            await pubsub.subscribe(channel)
+            # The leader may have finished before we subscribed
+            raw = await redis.get(result_key)
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + self.timeout
+            while raw is None:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    return None
+                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=min(remaining, 1.0))
+                if message is not None:
+                    envelope = json.loads(message["data"])
+                    if envelope.get("flight") == flight_id:
+                        return envelope["payload"]
+                elif await redis.get(lock_key) != flight_id:
+                    # Our flight's lock is gone without a result (leader was cancelled) - check once more and give up
+                    raw = await redis.get(result_key)
+                    if raw is None:
+                        return None
+            return json.loads(raw)
+        except Exception as e:
+            logger.warning(f"Singleflight wait failed for {self.name}: {e}")
+            return None
+        finally:
+            try:
+                await pubsub.unsubscribe(channel)
+                await pubsub.close()
+            except Exception as e:
+                logger.debug(f"Singleflight unsubscribe failed for {self.name}: {e}")
+
+    async def _publish(self, redis, channel: str, flight_id: str, lock_key: str, payload):
+        try:
+            if payload is not None:
+                raw = json.dumps(payload, ensure_ascii=False)
+                await redis.set(self._result_key(channel, flight_id), raw, ex=RESULT_TTL)
+                await redis.publish(channel, json.dumps({"flight": flight_id, "payload": payload}, ensure_ascii=False))
+            # The lock may have expired and been taken by the next flight
+            if await redis.get(lock_key) == flight_id:
+                await redis.delete(lock_key)
+        except Exception as e:
+            logger.warning(f"Singleflight publish failed for {self.name}: {e}")
@@ -0,0 +1,234 @@
+"""
+Client-side rate limiting in front of upstream models.
+
+One token bucket per (upstream, API key, model) in Redis, shared by all
+workers (limits are per provider account, see core.key_pool).
+Bucket size and refill rate are learned from the upstream's x-ratelimit-*
+response headers; until a model's limit is known, calls are not limited.
+The remaining/reset headers and 429 responses pull the bucket down to what
+the upstream reports, so a burst queues here instead of turning into a
+storm of 429s.
+
+acquire() reserves a token atomically (Lua). If the bucket is empty the
+caller sleeps until its token is due, at most UPSTREAM_RATE_LIMIT_MAX_WAIT_SECONDS;
+a longer wait raises UpstreamRateLimited without taking a token.
+Without Redis calls are not limited.
+"""
+import asyncio
+import logging
+import re
+import time
+from typing import Optional
+
+import httpx
+
+from .cache import cache
+from .config import settings
+from .http import UpstreamUnavailable, parse_retry_after
+from .metrics import metrics, MetricNames
+
+logger = logging.getLogger(__name__)
+
+# Re-check Redis for a learned limit this often while a model has none
+UNKNOWN_LIMIT_TTL = 30.0
+STATE_TTL = 86400
+
+# tokens < 0 are reservations of queued callers; wait = (1 - tokens) / rate after taking one
+_ACQUIRE_SCRIPT = """
+local capacity = tonumber(redis.call('HGET', KEYS[2], 'capacity'))
+local rate = tonumber(redis.call('HGET', KEYS[2], 'rate'))
+if not capacity or not rate or rate <= 0 then
+    return '-1'
+end
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local tokens = tonumber(redis.call('HGET', KEYS[1], 'tokens'))
+local ts = tonumber(redis.call('HGET', KEYS[1], 'ts'))
+if not tokens then
+    tokens = capacity
+    ts = now
+end
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local wait = 0
+if tokens < 1 then
+    wait = (1 - tokens) / rate
+end
+if wait <= tonumber(ARGV[1]) then
+    tokens = tokens - 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return tostring(wait)
+"""
+
+# Lower the bucket to what the upstream reports: at most ARGV[1] tokens,
+# or the next token no earlier than ARGV[2] seconds from now
+_SYNC_SCRIPT = """
+local capacity = tonumber(redis.call('HGET', KEYS[2], 'capacity'))
+local rate = tonumber(redis.call('HGET', KEYS[2], 'rate'))
+if not capacity or not rate or rate <= 0 then
+    return 0
+end
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local tokens = tonumber(redis.call('HGET', KEYS[1], 'tokens'))
+local ts = tonumber(redis.call('HGET', KEYS[1], 'ts'))
+if not tokens then
+    tokens = capacity
+    ts = now
+end
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+if ARGV[1] ~= '' then
+    tokens = math.min(tokens, tonumber(ARGV[1]))
+end
+if ARGV[2] ~= '' then
+    tokens = math.min(tokens, 1 - tonumber(ARGV[2]) * rate)
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return 1
+"""
+
+_DURATION_RE = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+class UpstreamRateLimited(UpstreamUnavailable):
+    """The model's rate limit would make the caller wait too long"""
+
+    error_type = "rate_limited"
+    user_message = "Слишком много запросов к модели. Попробуйте через {seconds} сек."
+
+    def __init__(self, upstream: str, scope: str, retry_after: float):
+        super().__init__(
+            f"{upstream} rate limit for {scope}, retry in {retry_after:.1f}s",
+            upstream, scope, retry_after
+        )
+
+
+def _header_number(headers: httpx.Headers, *names: str) -> Optional[float]:
+    for name in names:
+        value = headers.get(name)
+        if value:
+            try:
+                return float(value)
+            except ValueError:
+                return None
+    return None
+
+
+def parse_reset(value: Optional[str]) -> Optional[float]:
+    """Seconds until the limit resets: epoch ms/s, plain seconds or '6m0s'"""
+    if not value:
+        return None
+    try:
+        number = float(value)
+    except ValueError:
+        parts = _DURATION_RE.findall(value)
+        if not parts:
+            return None
+        return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in parts)
+    if number > 1e12:
+        return max(0.0, number / 1000 - time.time())
+    if number > 1e9:
+        return max(0.0, number - time.time())
+    return number
+
+
+class UpstreamRateLimiter:
+    def __init__(self):
+        self._unknown_until: dict[tuple[str, str, str], float] = {}
+        self._capacity: dict[tuple[str, str, str], float] = {}
+        self._acquire = None
+        self._sync = None
+
+    def _keys(self, upstream: str, model: str, key_id: str) -> list:
+        prefix = f"ratelimit:{upstream}:{key_id}:{model}" if key_id else f"ratelimit:{upstream}:{model}"
+        return [f"{prefix}:bucket", f"{prefix}:limit"]
+
+    async def _scripts(self):
+        redis = await cache.client()
+        if redis is None:
+            return None
+        if self._acquire is None:
+            self._acquire = redis.register_script(_ACQUIRE_SCRIPT)
+            self._sync = redis.register_script(_SYNC_SCRIPT)
+        return redis
+
+    async def acquire(self, upstream: str, model: str, key_id: str = ""):
+        """Wait for a token of the model's bucket (or raise UpstreamRateLimited)"""
+        key = (upstream, model, key_id)
+        if self._unknown_until.get(key, 0) > time.monotonic():
+            return
+
+        max_wait = settings.UPSTREAM_RATE_LIMIT_MAX_WAIT_SECONDS
+        try:
+            if await self._scripts() is None:
+                return
+            wait = float(await self._acquire(
+                keys=self._keys(upstream, model, key_id),
+                args=[max_wait, STATE_TTL]
+            ))
+        except Exception as e:
+            logger.warning(f"Rate limiter unavailable for {upstream}/{model}: {e}")
+            return
+
+        if wait < 0:
+            self._unknown_until[key] = time.monotonic() + UNKNOWN_LIMIT_TTL
+            return
+
+        labels = {"upstream": upstream, "model": model}
+        if wait > max_wait:
+            metrics.inc_counter(MetricNames.RATE_LIMIT_REJECTED, labels=labels)
+            raise UpstreamRateLimited(upstream, model, wait)
+
+        metrics.observe_histogram(MetricNames.RATE_LIMIT_WAIT_SECONDS, wait, labels=labels)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    async def observe(self, upstream: str, model: str, response: httpx.Response, key_id: str = ""):
+        """Learn the limit from response headers; a 429 empties the bucket until Retry-After"""
+        headers = response.headers
+        limit = _header_number(headers, "x-ratelimit-limit-requests", "x-ratelimit-limit")
+        remaining = _header_number(headers, "x-ratelimit-remaining-requests", "x-ratelimit-remaining")
+        reset_in = parse_reset(headers.get("x-ratelimit-reset-requests") or headers.get("x-ratelimit-reset"))
+
+        next_token_in = None
+        if response.status_code == 429:
+            next_token_in = parse_retry_after(headers.get("retry-after")) or reset_in or 1.0
+        elif remaining is not None and reset_in is not None and remaining < 1:
+            next_token_in = reset_in
+
+        key = (upstream, model, key_id)
+        learn = limit is not None and limit > 0 and self._capacity.get(key) != limit
+        if not learn and remaining is None and next_token_in is None:
+            return
+
+        try:
+            redis = await self._scripts()
+            if redis is None:
+                return
+            bucket_key, limit_key = self._keys(upstream, model, key_id)
+            if learn:
+                async with redis.pipeline(transaction=True) as pipe:
+                    pipe.hset(limit_key, mapping={
+                        "capacity": limit,
+                        "rate": limit / settings.UPSTREAM_RATE_LIMIT_WINDOW_SECONDS
+                    })
+                    pipe.expire(limit_key, STATE_TTL)
+                    await pipe.execute()
+                self._capacity[key] = limit
+                self._unknown_until.pop(key, None)
+            await self._sync(
+                keys=[bucket_key, limit_key],
+                args=[
+                    remaining if remaining is not None else "",
+                    next_token_in if next_token_in is not None else "",
+                    STATE_TTL
+                ]
+            )
+        except Exception as e:
+            logger.warning(f"Rate limit update failed for {upstream}/{model}: {e}")
+
+
+upstream_limiter = UpstreamRateLimiter()
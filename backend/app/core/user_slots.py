@@ -0,0 +1,152 @@
+"""
+Per-user concurrency limits for expensive generation endpoints.
+
+A user holds one lease per running image/video generation. Leases live in a
+Redis sorted set per (endpoint, user), scored by their expiry time, so the
+limit holds across all workers and a lease left behind by a crashed worker
+disappears after LEASE_SECONDS.
+
+Limits come from USER_CONCURRENCY_LIMITS per endpoint and lane (the same
+lanes as core.scheduler). Over the limit the call waits up to
+USER_CONCURRENCY_WAIT_SECONDS for a lease to be released, then fails with
+UserConcurrencyLimited (429 in the API). Without Redis calls are not limited.
+"""
+import asyncio
+import logging
+import math
+import time
+import uuid
+from typing import Optional
+
+from .cache import cache
+from .config import settings
+from .metrics import metrics, MetricNames
+
+logger = logging.getLogger(__name__)
+
+# Longest a generation may run before its lease expires on its own
+LEASE_SECONDS = {
+    "images": 600,
+    "videos": 900,
+}
+POLL_SECONDS = 1.0
+# Retry-After for a rejected call: about how long a generation takes
+RETRY_AFTER_SECONDS = {
+    "images": 15,
+    "videos": 60,
+}
+
+
+class UserConcurrencyLimited(Exception):
+    """The user already runs as many generations as their lane allows"""
+
+    def __init__(self, endpoint: str, limit: int):
+        super().__init__(f"Concurrency limit {limit} reached for {endpoint}")
+        self.endpoint = endpoint
+        self.limit = limit
+        self.retry_after = RETRY_AFTER_SECONDS.get(endpoint, 10)
+
+    @property
+    def retry_after_seconds(self) -> int:
+        return max(1, math.ceil(self.retry_after))
+
+    @property
+    def detail(self) -> dict:
+        """Body of the 429 response"""
+        return {
+            "error": f"Уже выполняется генераций: {self.limit}. Дождитесь завершения и попробуйте снова.",
+            "error_type": "concurrency_limit",
+            "limit": self.limit,
+            "retry_after": self.retry_after_seconds
+        }
+
+
+class Lease:
+    def __init__(self, key: Optional[str], lease_id: str):
+        self.key = key
+        self.id = lease_id
+
+    async def release(self):
+        if self.key is None:
+            return
+        key, self.key = self.key, None
+        redis = await cache.client()
+        if redis is None:
+            return
+        try:
+            await redis.zrem(key, self.id)
+        except Exception as e:
+            # The lease expires on its own
+            logger.warning(f"Failed to release concurrency lease {key}: {e}")
+
+
+class UserSlots:
+    def _key(self, endpoint: str, user_id: int) -> str:
+        return f"user_slots:{endpoint}:{user_id}"
+
+    def limit_for(self, endpoint: str, lane: str) -> Optional[int]:
+        limits = settings.USER_CONCURRENCY_LIMITS.get(endpoint)
+        if not limits:
+            return None
+        return limits.get(lane, min(limits.values()))
+
+    async def _try_take(self, redis, key: str, lease_id: str, limit: int, lease_seconds: int) -> bool:
+        now = time.time()
+        async with redis.pipeline(transaction=True) as pipe:
+            pipe.zremrangebyscore(key, "-inf", now)
+            pipe.zadd(key, {lease_id: now + lease_seconds})
+            pipe.zcard(key)
+            pipe.expire(key, lease_seconds)
+            _, _, count, _ = await pipe.execute()
+        if count <= limit:
+            return True
+        await redis.zrem(key, lease_id)
+        return False
+
+    async def acquire(self, endpoint: str, user_id: int, lane: str) -> Lease:
+        """Take a lease for one generation or raise UserConcurrencyLimited"""
+        lease_id = uuid.uuid4().hex
+        limit = self.limit_for(endpoint, lane)
+        redis = await cache.client()
+        if limit is None or redis is None:
+            return Lease(None, lease_id)
+
+        key = self._key(endpoint, user_id)
+        lease_seconds = LEASE_SECONDS.get(endpoint, 600)
+        started = time.monotonic()
+        deadline = started + settings.USER_CONCURRENCY_WAIT_SECONDS
+        try:
+            while not await self._try_take(redis, key, lease_id, limit, lease_seconds):
+                if time.monotonic() >= deadline:
+                    metrics.inc_counter(MetricNames.USER_CONCURRENCY_REJECTED, labels={"endpoint": endpoint, "lane": lane})
+                    raise UserConcurrencyLimited(endpoint, limit)
+                await asyncio.sleep(POLL_SECONDS)
+        except UserConcurrencyLimited:
+            raise
+        except Exception as e:
+            logger.warning(f"User concurrency check failed for {endpoint}/{user_id}: {e}")
+            return Lease(None, lease_id)
+
+        metrics.observe_histogram(
+            MetricNames.USER_CONCURRENCY_WAIT_SECONDS, time.monotonic() - started,
+            labels={"endpoint": endpoint}
+        )
+        return Lease(key, lease_id)
+
+    async def in_flight(self, user_id: Optional[int] = None) -> list[dict]:
+        """Live leases per user and endpoint (for the admin API)"""
+        redis = await cache.client()
+        if redis is None:
+            return []
+        pattern = f"user_slots:*:{user_id}" if user_id is not None else "user_slots:*"
+        now = time.time()
+        result = []
+        async for key in redis.scan_iter(match=pattern, count=500):
+            _, endpoint, owner = key.split(":", 2)
+            count = await redis.zcount(key, now, "+inf")
+            if count:
+                result.append({"user_id": int(owner), "endpoint": endpoint, "in_flight": count})
+        return sorted(result, key=lambda item: (-item["in_flight"], item["user_id"]))
+
+
+user_slots = UserSlots()
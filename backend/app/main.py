@@ -7,9 +7,12 @@ from starlette.middleware.base import BaseHTTPMiddleware
 from contextlib import asynccontextmanager
 from .api import auth, chat, payments, analytics, subscriptions, budget, admin, files, contact, images, videos
 from .core.database import engine, Base
+from .core.http import http_clients
 from .services.currency_service import currency_service
 from .services.openrouter_prices import openrouter_prices_service
 from .services.file_service import cleanup_old_files, start_cleanup_scheduler
+from .services.billing_service import start_stale_holds_scheduler
+from .services.retention_service import start_retention_scheduler
 from .core.logging import (
     logger, generate_request_id, set_request_id,
     log_api_request, log_api_response
@@ -71,6 +74,9 @@ async def lifespan(app: FastAPI):
         print(f"⚠️ Failed to load USD rate: {e}", flush=True)
         traceback.print_exc()
     
+    # Общие HTTP-клиенты к провайдерам (keep-alive пулы, прогрев соединений)
+    await http_clients.start()
+    
     # Загрузка цен с OpenRouter
     print("💰 Loading model prices from OpenRouter...", flush=True)
     try:
@@ -88,6 +94,8 @@ async def lifespan(app: FastAPI):
     # Запускаем фоновую очистку
     import asyncio
     asyncio.create_task(start_cleanup_scheduler())
+    asyncio.create_task(start_stale_holds_scheduler())
+    asyncio.create_task(start_retention_scheduler())
     
     print("🎉 AI Chat Platform ready!", flush=True)
     sys.stdout.flush()
@@ -95,6 +103,7 @@ async def lifespan(app: FastAPI):
     yield
     
     print("👋 AI Chat Platform shutting down...", flush=True)
+    await http_clients.close()
 
 app = FastAPI(
     title="AI Chat Platform API",
@@ -119,7 +128,8 @@ app.add_middleware(
     allow_origins=ALLOWED_ORIGINS,
     allow_credentials=True,
     allow_methods=["GET", "POST", "PUT", "DELETE", "PATCH", "OPTIONS"],
-    allow_headers=["Authorization", "Content-Type", "X-Requested-With"],
+    allow_headers=["Authorization", "Content-Type", "X-Requested-With", "Idempotency-Key"],
+    expose_headers=["X-Next-Cursor", "Idempotent-Replayed", "Retry-After"],
 )
 
 # Подключение роутеров
@@ -182,6 +192,17 @@ async def health_detailed():
         result["services"]["redis"] = {"status": "unhealthy", "error": str(e)}
         result["status"] = "degraded"
 
+    # Предохранители провайдеров
+    from .core.circuit_breaker import circuit_breakers, CLOSED
+    breakers = await circuit_breakers.record_metrics()
+    result["services"]["circuit_breakers"] = breakers
+    if any(b["state"] != CLOSED for b in breakers):
+        result["status"] = "degraded"
+
+    # Лимиты допуска этого воркера
+    from .core.admission import admission_controller
+    result["services"]["admission"] = admission_controller.snapshot()
+
     return result
 
 
@@ -189,7 +210,20 @@ async def health_detailed():
 async def metrics_endpoint():
     """Prometheus-compatible metrics endpoint"""
     from fastapi.responses import PlainTextResponse
-    from .core.metrics import metrics
+    from .core.metrics import metrics, MetricNames
+    from .core.retry import retry_budget
+    from .core.circuit_breaker import circuit_breakers
+    from .core.key_pool import openrouter_keys, replicate_keys
+    from .core.admission import admission_controller
+    from .core.scheduler import upstream_schedulers
+    http_clients.record_metrics()
+    admission_controller.record_metrics()
+    for scheduler in upstream_schedulers.values():
+        scheduler.record_metrics()
+    openrouter_keys.record_metrics()
+    replicate_keys.record_metrics()
+    await circuit_breakers.record_metrics()
+    metrics.set_gauge(MetricNames.RETRY_BUDGET_TOKENS, retry_budget.tokens)
     return PlainTextResponse(
         content=metrics.get_prometheus_format(),
         media_type="text/plain"
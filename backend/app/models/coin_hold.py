@@ -0,0 +1,20 @@
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey
+from sqlalchemy.sql import func
+from datetime import datetime
+
+from ..core.database import Base
+
+
+class CoinHold(Base):
+    """Резерв коинов на время запроса к AI (снимается при расчёте или отмене)"""
+    __tablename__ = "coin_holds"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    amount = Column(Integer, nullable=False)
+    purpose = Column(String(50), nullable=False)  # chat, image, video
+
+    created_at = Column(DateTime, default=datetime.utcnow, server_default=func.now(), index=True)
+
+    def __repr__(self):
+        return f"<CoinHold {self.id} - {self.amount} coins ({self.purpose})>"
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Text, Enum as SQLEnum
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Text, Index, Enum as SQLEnum
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from datetime import datetime
@@ -26,11 +26,21 @@ class Conversation(Base):
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
     title = Column(String, default="New Chat")
     ai_model = Column(SQLEnum(AIModel), default=AIModel.CLAUDE_SONNET)
+    # Поддерживается при вставке/удалении сообщений (chat._save_turn, retention, админка)
+    message_count = Column(Integer, nullable=False, default=0, server_default="0")
+    # Краткое содержание сообщений, не влезающих в бюджет контекста (services/context_budget.py)
+    summary = Column(Text, nullable=True)
+    summary_upto_id = Column(Integer, nullable=True)
     
     created_at = Column(DateTime, default=datetime.utcnow, server_default=func.now())
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=func.now(), server_default=func.now())
     
     messages = relationship("Message", back_populates="conversation", cascade="all, delete-orphan")
+
+    __table_args__ = (
+        # Список диалогов в сайдбаре: keyset-пагинация по (updated_at, id)
+        Index("ix_conversations_user_updated", "user_id", "updated_at", "id"),
+    )
     
     def __repr__(self):
         return f"<Conversation {self.id} - {self.title}>"
@@ -49,6 +59,11 @@ class Message(Base):
     created_at = Column(DateTime, default=datetime.utcnow, server_default=func.now())
     
     conversation = relationship("Conversation", back_populates="messages")
+
+    __table_args__ = (
+        # История диалога (keyset-пагинация), фоновая очистка старых сообщений
+        Index("ix_messages_conversation_created_id", "conversation_id", "created_at", "id"),
+    )
     
     def __repr__(self):
         return f"<Message {self.id} - {self.role}>"
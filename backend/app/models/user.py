@@ -34,6 +34,9 @@ class User(Base):
     subscription_plan = Column(String, default="NONE")
     subscription_expires = Column(DateTime, nullable=True)
 
+    # Всего пополнено (в коинах), обновляется при оплате
+    total_deposited = Column(Integer, default=0)
+
     # Legacy поля (для совместимости)
     tokens_used = Column(Integer, default=0)
     tokens_limit = Column(Integer, default=0)
@@ -31,11 +31,15 @@ class ConversationResponse(BaseModel):
     ai_model: str
     created_at: datetime
     updated_at: datetime
-    messages: List[MessageResponse] = []
+    message_count: int = 0
 
     class Config:
         from_attributes = True
 
+class MessagePageResponse(BaseModel):
+    messages: List[MessageResponse]  # от старых к новым
+    next_cursor: Optional[str] = None  # передать в before для более ранних сообщений
+
 class ConversationListResponse(BaseModel):
     id: int
     title: str
@@ -54,6 +58,8 @@ class ChatRequest(BaseModel):
     file_id: Optional[str] = None  # ID загруженного файла
     file_type: Optional[str] = None  # "image" или "document"
     source: Optional[str] = "web"  # "web" или "telegram"
+    temperature: float = Field(0.7, ge=0, le=2)
+    use_cache: bool = False  # разрешить ответ из кэша и при temperature > 0
 
 class ChatResponse(BaseModel):
     conversation_id: int
@@ -1,9 +1,27 @@
+import asyncio
+import logging
 import math
-import httpx
-from typing import Dict, Any, Optional
+import json
+import time
+from collections.abc import AsyncIterator
+from typing import Any, Optional
 from ..core.config import settings
+from ..core.metrics import metrics, MetricNames
+from ..core.http import http_clients, UpstreamHTTPError
+from ..core.retry import retry_call
+from ..core.circuit_breaker import circuit_breakers
+from ..core.upstream_limits import upstream_limiter
+from ..core.key_pool import openrouter_keys
+from ..core.scheduler import upstream_slot
 from .currency_service import currency_service
 from .openrouter_prices import openrouter_prices_service
+from ..core.singleflight import SingleFlight, make_key
+from .tokenizer import token_counter
+from .response_cache import response_cache
+from .near_duplicate import near_duplicate_index
+from .failover import failover_router, is_failover_error
+
+logger = logging.getLogger(__name__)
 
 # ============================================
 # СИСТЕМА КОИНОВ - 1 коин = 1 копейка (100 коинов = 1₽)
@@ -86,6 +104,21 @@ def calculate_cost_sync(input_tokens: int, output_tokens: int, model_id: str, us
     return max(1, math.ceil(cost_coins))
 
 
+def usage_cost_usd(usage: dict, model: str) -> float:
+    """Себестоимость запроса в USD: из usage OpenRouter, иначе по ценам модели"""
+    if usage.get("cost") is not None:
+        return float(usage["cost"])
+    model_id = get_model_id(model)
+    input_price, output_price = (
+        openrouter_prices_service.get_cached_prices().get(model_id)
+        or MODEL_PRICES_USD.get(model_id, DEFAULT_PRICE_USD)
+    )
+    return (
+        (usage.get("prompt_tokens", 0) / 1_000_000) * input_price
+        + (usage.get("completion_tokens", 0) / 1_000_000) * output_price
+    )
+
+
 async def get_model_prices_usd() -> dict:
     """Получить актуальные цены моделей в USD (с OpenRouter или fallback)"""
     openrouter_prices = await openrouter_prices_service.fetch_prices()
@@ -227,16 +260,31 @@ async def get_model_prices():
     }
 
 
+async def _first_event_within(stream: AsyncIterator[dict[str, Any]], timeout: Optional[float]) -> AsyncIterator[dict[str, Any]]:
+    """Поток, первое событие которого должно прийти за timeout (иначе asyncio.TimeoutError)"""
+    try:
+        if timeout is not None:
+            try:
+                first = await asyncio.wait_for(stream.__anext__(), timeout=timeout)
+            except StopAsyncIteration:
+                return
+            yield first
+        async for event in stream:
+            yield event
+    finally:
+        await stream.aclose()
+
+
 class AIService:
     def __init__(self):
-        self.api_key = settings.OPENROUTER_API_KEY
         self.base_url = "https://openrouter.ai/api/v1"
+        # Authorization добавляется на каждый запрос ключом из openrouter_keys
         self.headers = {
-            "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json",
             "HTTP-Referer": settings.SITE_URL,
             "X-Title": "LANA AI Helper"
         }
+        self._generate_flight = SingleFlight("chat", timeout=120.0)
 
     async def generate_response(
         self,
@@ -244,46 +292,267 @@ class AIService:
         model: str = "google/gemini-2.0-flash-001",
         max_tokens: int = 4096,
         temperature: float = 0.7
-    ) -> Dict[str, Any]:
-        """Генерация ответа через OpenRouter API"""
-        async with httpx.AsyncClient(timeout=120.0) as client:
-            response = await client.post(
+    ) -> dict[str, Any]:
+        """
+        Генерация ответа через OpenRouter API.
+        Одновременные одинаковые запросы (в т.ч. из других воркеров)
+        делят один вызов провайдера; стоимость каждому вызывающему
+        считается и списывается отдельно.
+        """
+        key = make_key(messages, model, max_tokens, temperature)
+        return await self._generate_flight.do(
+            key,
+            lambda: self._post_completion(messages, model, max_tokens, temperature)
+        )
+
+    async def _post_completion(self, messages: list, model: str, max_tokens: int, temperature: float) -> dict[str, Any]:
+        client = http_clients.get("openrouter")
+
+        async def attempt():
+            async with upstream_slot("openrouter"):
+                key = await openrouter_keys.choose()
+                await upstream_limiter.acquire("openrouter", model, key.id)
+                response = await client.post(
+                    f"{self.base_url}/chat/completions",
+                    headers=key.headers(self.headers),
+                    json={
+                        "model": model,
+                        "messages": messages,
+                        "max_tokens": max_tokens,
+                        "temperature": temperature
+                    }
+                )
+                await upstream_limiter.observe("openrouter", model, response, key.id)
+                await openrouter_keys.report(key, response)
+                if response.status_code != 200:
+                    raise openrouter_keys.error(key, "OpenRouter", response)
+                data = response.json()
+                await openrouter_keys.record_spend(key, usage_cost_usd(data.get("usage") or {}, model))
+                return data
+
+        # Один повтор: дальше запрос подхватит failover_router на другой модели.
+        # Исход пишется в circuit breaker здесь, внутри SingleFlight, - один раз
+        # на вызов провайдера, а не на каждого ожидающего результат
+        return await circuit_breakers.call(
+            "openrouter", model,
+            lambda: retry_call("openrouter", attempt, max_attempts=2)
+        )
+
+    async def stream_response(
+        self,
+        messages: list,
+        model: str = "google/gemini-2.0-flash-001",
+        max_tokens: int = 4096,
+        temperature: float = 0.7
+    ) -> AsyncIterator[dict[str, Any]]:
+        """
+        Потоковая генерация через OpenRouter API (stream=true).
+        Отдаёт распарсенные SSE-чанки по мере поступления; следующий чанк
+        читается из сокета только после того, как потребитель забрал предыдущий.
+        """
+        client = http_clients.get("openrouter")
+        body = {
+            "model": model,
+            "messages": messages,
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+            "stream": True,
+            "usage": {"include": True}
+        }
+
+        async def open_stream():
+            key = await openrouter_keys.choose()
+            await upstream_limiter.acquire("openrouter", model, key.id)
+            request = client.build_request(
+                "POST",
                 f"{self.base_url}/chat/completions",
-                headers=self.headers,
-                json={
-                    "model": model,
-                    "messages": messages,
-                    "max_tokens": max_tokens,
-                    "temperature": temperature
-                }
+                headers=key.headers(self.headers),
+                json=body
             )
-
+            response = await client.send(request, stream=True)
+            await upstream_limiter.observe("openrouter", model, response, key.id)
+            await openrouter_keys.report(key, response)
             if response.status_code != 200:
-                error_text = response.text
-                raise Exception(f"OpenRouter API error: {response.status_code} - {error_text}")
-
-            return response.json()
-
-    def estimate_tokens(self, text: str) -> int:
-        """Примерная оценка количества токенов в тексте"""
-        return max(1, len(text) // 3)
+                error_text = (await response.aread()).decode("utf-8", errors="replace")
+                await response.aclose()
+                raise openrouter_keys.error(key, "OpenRouter", response, error_text)
+            return key, response
+
+        # Слот провайдера занят, пока идёт поток
+        async with upstream_slot("openrouter"):
+            # Повторяется только открытие потока - до первого полученного байта
+            key, response = await retry_call("openrouter", open_stream, max_attempts=2)
+            try:
+                async for line in response.aiter_lines():
+                    # Комментарии вида ": OPENROUTER PROCESSING" пропускаем
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[5:].strip()
+                    if data == "[DONE]":
+                        break
+                    try:
+                        chunk = json.loads(data)
+                    except json.JSONDecodeError:
+                        continue
+                    if chunk.get("usage"):
+                        await openrouter_keys.record_spend(key, usage_cost_usd(chunk["usage"], model))
+                    yield chunk
+            finally:
+                await response.aclose()
+
+    def estimate_tokens(self, text: str, model: Optional[str] = None) -> int:
+        """Количество токенов в тексте (локальный токенизатор семейства модели)"""
+        return max(1, token_counter.count(text, model))
 
     def estimate_coins(self, model: str, input_tokens: int, output_tokens: int) -> int:
         """Примерная оценка стоимости в коинах"""
         usd_rate = currency_service.get_cached_rate()
         return calculate_cost_sync(input_tokens, output_tokens, model, usd_rate)
 
-    async def send_message(self, messages: list, model: str) -> dict:
-        """Отправка сообщения в AI модель с полной детализацией стоимости"""
-        response = await self.generate_response(messages, model)
+    async def send_message(
+        self,
+        messages: list,
+        model: str,
+        temperature: float = 0.7,
+        max_tokens: int = 4096,
+        use_cache: bool = False
+    ) -> dict:
+        """
+        Отправка сообщения в AI модель с полной детализацией стоимости.
+        Одинаковые запросы могут отдаваться из response_cache (см. key_for),
+        а с use_cache - и почти одинаковые одноходовые из near_duplicate_index;
+        у такого результата cached=True и стоимость со скидкой.
+        При сбое провайдера запрос может ответить другая модель из группы
+        failover_router - стоимость и поле model тогда по ней.
+        """
+        cache_key = response_cache.key_for(messages, model, temperature, max_tokens, use_cache)
+        if cache_key:
+            cached = await response_cache.get(cache_key, model)
+            if cached:
+                return cached
+        if use_cache:
+            cached = await near_duplicate_index.lookup(messages, model)
+            if cached:
+                return cached
+
+        result = await failover_router.call(
+            model,
+            lambda candidate: self._complete(messages, candidate, max_tokens, temperature)
+        )
+
+        # Ответ запасной модели не кэшируем под запрошенную
+        if result["model"] == model:
+            if cache_key:
+                await response_cache.put(cache_key, result)
+            if use_cache:
+                await near_duplicate_index.add(messages, model, result)
+        return result
+
+    async def _complete(self, messages: list, model: str, max_tokens: int, temperature: float) -> dict:
+        """Один запрос к конкретной модели с расчётом стоимости"""
+        started = time.perf_counter()
+        response = await self.generate_response(messages, model, max_tokens=max_tokens, temperature=temperature)
+        elapsed = time.perf_counter() - started
 
         # Извлекаем данные из ответа OpenRouter
         choice = response.get("choices", [{}])[0]
         content = choice.get("message", {}).get("content", "")
-        usage = response.get("usage", {})
-        input_tokens = usage.get("prompt_tokens", 0)
-        output_tokens = usage.get("completion_tokens", 0)
+        result = await self._build_result(content, response.get("usage") or {}, model, messages)
+        metrics.observe_histogram(
+            MetricNames.AI_UPSTREAM_SECONDS, elapsed,
+            labels={"model": model, "prompt_cache": "hit" if result["cached_tokens"] else "miss"}
+        )
+        return result
+
+    async def stream_message(self, messages: list, model: str, temperature: float = 0.7) -> AsyncIterator[dict[str, Any]]:
+        """
+        Потоковая отправка сообщения.
+        Отдаёт {"type": "delta", "content": ...} для каждого фрагмента ответа и
+        финальное {"type": "done", ...} с той же детализацией, что и send_message
+        (стоимость берётся из usage последнего чанка).
+        Пока не отдан ни один фрагмент, сбой провайдера переключает поток
+        на следующую модель группы failover_router.
+        """
+        policy = failover_router.policy_for(model)
+        chain = policy.chain(model) if policy else [model]
+
+        for i, candidate in enumerate(chain):
+            started = False
+            try:
+                probe = await circuit_breakers.before_call("openrouter", candidate)
+                # Кроме последней модели цепочки: не дождались первого фрагмента - следующая
+                stall = settings.FAILOVER_STALL_SECONDS if i < len(chain) - 1 else None
+                try:
+                    async for event in _first_event_within(self._stream_model(messages, candidate, temperature), stall):
+                        started = True
+                        yield event
+                except Exception as e:
+                    await circuit_breakers.record_failure("openrouter", candidate, probe, e)
+                    raise
+                except BaseException:
+                    # Клиент ушёл посреди потока - исход пробы неизвестен
+                    if probe:
+                        await circuit_breakers.release_probe("openrouter", candidate)
+                    raise
+                await circuit_breakers.record_success("openrouter", candidate, probe)
+            except Exception as e:
+                if policy:
+                    failover_router.record(policy, candidate, "error")
+                if started or i == len(chain) - 1 or not is_failover_error(e):
+                    raise
+                continue
+            if policy:
+                failover_router.record(policy, candidate, "win")
+            return
+
+    async def _stream_model(self, messages: list, model: str, temperature: float) -> AsyncIterator[dict[str, Any]]:
+        content_parts = []
+        usage = {}
+
+        async for chunk in self.stream_response(messages, model, temperature=temperature):
+            if chunk.get("error"):
+                error = chunk["error"]
+                code = error.get("code") if isinstance(error, dict) else None
+                if isinstance(code, int):
+                    raise UpstreamHTTPError("OpenRouter", code, str(error))
+                raise Exception(f"OpenRouter API error: {error}")
+
+            choices = chunk.get("choices") or []
+            if choices:
+                delta = (choices[0].get("delta") or {}).get("content")
+                if delta:
+                    content_parts.append(delta)
+                    yield {"type": "delta", "content": delta}
+
+            if chunk.get("usage"):
+                usage = chunk["usage"]
+
+        result = await self._build_result("".join(content_parts), usage, model, messages)
+        yield {"type": "done", **result}
+
+    async def _build_result(self, content: str, usage: dict, model: str, messages: list) -> dict:
+        """
+        Собирает результат запроса с расчётом стоимости по usage OpenRouter.
+        Если usage не пришёл (оборванный поток, прокси без usage), токены
+        считаются локально по запросу и ответу - иначе списался бы минимум.
+        """
+        if usage.get("prompt_tokens") is None or usage.get("completion_tokens") is None:
+            logger.warning(f"No usage in OpenRouter response for {model}, counting tokens locally")
+            usage = {
+                **usage,
+                "prompt_tokens": token_counter.count_messages(messages, model),
+                "completion_tokens": token_counter.count(content, model) if content else 0
+            }
+            usage.pop("total_tokens", None)
+        input_tokens = usage["prompt_tokens"]
+        output_tokens = usage["completion_tokens"]
         total_tokens = usage.get("total_tokens", input_tokens + output_tokens)
+        # Часть входа, прочитанная провайдером из кэша префикса (см. prompt_builder)
+        cached_tokens = (usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0) or 0
+
+        metrics.inc_counter(MetricNames.PROMPT_INPUT_TOKENS, input_tokens, labels={"model": model})
+        if cached_tokens:
+            metrics.inc_counter(MetricNames.PROMPT_CACHED_TOKENS, cached_tokens, labels={"model": model})
 
         # Используем реальную стоимость от OpenRouter если есть
         openrouter_cost = usage.get("cost")
@@ -305,10 +574,12 @@ class AIService:
             "tokens_used": total_tokens,
             "input_tokens": input_tokens,
             "output_tokens": output_tokens,
+            "cached_tokens": cached_tokens,
             "coins_spent": cost_coins,
             "cost_usd": cost_usd,
             "usd_rate": usd_rate,
-            "model": model
+            "model": model,
+            "cached": False
         }
 
 
@@ -0,0 +1,426 @@
+"""
+Учёт расходов коинов на AI: резерв (hold) перед запросом к провайдеру
+и расчёт (settle) по фактической стоимости после ответа.
+
+Резерв ставится одним условным UPDATE ... WHERE balance >= :hold RETURNING,
+поэтому параллельные запросы из веба и Telegram-бота не могут уйти в минус.
+Расчёт одним запросом возвращает остаток резерва, списывает фактическую
+стоимость и пишет usage_logs и transactions.
+"""
+
+import asyncio
+import logging
+from datetime import date
+from typing import Optional
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..models.coin_hold import CoinHold  # noqa: F401 - регистрирует таблицу coin_holds
+
+logger = logging.getLogger(__name__)
+
+PERIOD_DAYS_MAP = {"none": 0, "week": 7, "two_weeks": 14, "three_weeks": 21, "month": 30}
+
+# Резервы старше этого срока считаются брошенными (упавший воркер) и возвращаются.
+# Срок заведомо больше самого долгого запроса: генерация видео идёт не дольше
+# 20 минут (IN_PROGRESS_SECONDS в core.idempotency), чат с failover, повторами
+# и потоком - единицы минут.
+# Если резерв всё же сняли раньше расчёта, settle списывает стоимость напрямую.
+STALE_HOLD_MINUTES = 60
+
+# Дневной лимит в SQL (0 - без лимита), как User.daily_limit
+_DAILY_LIMIT_SQL = """
+    (COALESCE(budget_coins, 0) / NULLIF(CASE budget_period
+        WHEN 'week' THEN 7
+        WHEN 'two_weeks' THEN 14
+        WHEN 'three_weeks' THEN 21
+        WHEN 'month' THEN 30
+        ELSE 0
+    END, 0))
+"""
+
+# Потрачено сегодня с учётом смены дня
+_DAILY_SPENT_SQL = "(CASE WHEN daily_spent_date = :today THEN COALESCE(daily_spent, 0) ELSE 0 END)"
+
+
+class BudgetError(Exception):
+    """Недостаточно коинов или превышен дневной лимит"""
+
+    def __init__(self, status_code: int, detail: dict):
+        super().__init__(detail.get("error", "Budget error"))
+        self.status_code = status_code
+        self.detail = detail
+
+
+def check_budget(budget: dict, estimated_coins: int):
+    """Проверка баланса и дневного лимита по снимку бюджета"""
+    current_balance = budget["balance"]
+    daily_limit = budget["daily_limit"]
+    daily_spent = budget["daily_spent"]
+
+    if current_balance <= 0:
+        raise BudgetError(402, {
+            "error": "Недостаточно коинов. Пожалуйста, пополните баланс.",
+            "error_type": "no_balance",
+            "balance": current_balance,
+            "topup_url": "/pricing"
+        })
+
+    if current_balance < estimated_coins:
+        raise BudgetError(402, {
+            "error": f"Недостаточно коинов. Нужно ~{estimated_coins}, у вас {current_balance}.",
+            "error_type": "low_balance",
+            "balance": current_balance,
+            "topup_url": "/pricing"
+        })
+
+    if budget["budget_period"] != "none" and daily_limit > 0:
+        daily_remaining = daily_limit - daily_spent
+
+        if daily_spent >= daily_limit:
+            raise BudgetError(429, {
+                "error": f"Достигнут дневной лимит ({daily_limit} коинов). Попробуйте завтра.",
+                "error_type": "daily_limit",
+                "daily_limit": daily_limit,
+                "daily_spent": daily_spent,
+                "daily_remaining": 0,
+                "settings_url": "/settings"
+            })
+
+        if daily_remaining < estimated_coins:
+            raise BudgetError(429, {
+                "error": f"Недостаточно коинов в дневном лимите. Осталось {daily_remaining}, нужно ~{estimated_coins}.",
+                "error_type": "daily_limit",
+                "daily_limit": daily_limit,
+                "daily_spent": daily_spent,
+                "daily_remaining": daily_remaining,
+                "settings_url": "/settings"
+            })
+
+
+def budget_from_row(balance, budget_period, budget_coins, daily_spent, today: date) -> dict:
+    """Снимок бюджета из колонок users (daily_spent уже с учётом смены дня)"""
+    budget_period = budget_period or "none"
+    budget_coins = budget_coins or 0
+    period_days = PERIOD_DAYS_MAP.get(budget_period, 0)
+
+    return {
+        "balance": balance or 0,
+        "budget_period": budget_period,
+        "budget_coins": budget_coins,
+        "daily_spent": daily_spent or 0,
+        "daily_limit": budget_coins // period_days if period_days > 0 else 0,
+        "today": today
+    }
+
+
+class BillingService:
+    async def get_budget_state(self, db: AsyncSession, user_id: int) -> dict:
+        """Снимок баланса и дневного бюджета (daily_spent за прошлые дни считается нулём)"""
+        today = date.today()
+        result = await db.execute(
+            text(f"""
+                SELECT balance, budget_period, budget_coins, {_DAILY_SPENT_SQL} AS daily_spent
+                FROM users WHERE id = :user_id
+            """),
+            {"user_id": user_id, "today": today}
+        )
+        row = result.fetchone()
+        return budget_from_row(row[0], row[1], row[2], row[3], today)
+
+    async def reserve(
+        self,
+        db: AsyncSession,
+        user_id: int,
+        amount: int,
+        purpose: str
+    ) -> dict:
+        """
+        Ставит резерв на amount коинов одним условным UPDATE.
+        Если баланса или дневного лимита не хватает - BudgetError
+        (с деталями по свежему снимку бюджета).
+        """
+        amount = max(1, int(amount))
+        today = date.today()
+        result = await db.execute(
+            text(f"""
+                WITH hold AS (
+                    UPDATE users SET
+                        balance = balance - :amount,
+                        daily_spent = {_DAILY_SPENT_SQL} + :amount,
+                        daily_spent_date = :today
+                    WHERE id = :user_id
+                      AND balance >= :amount
+                      AND (
+                          COALESCE({_DAILY_LIMIT_SQL}, 0) <= 0
+                          OR {_DAILY_SPENT_SQL} + :amount <= {_DAILY_LIMIT_SQL}
+                      )
+                    RETURNING id, balance, daily_spent
+                ), ins AS (
+                    INSERT INTO coin_holds (user_id, amount, purpose, created_at)
+                    SELECT id, :amount, :purpose, NOW() FROM hold
+                    RETURNING id
+                )
+                SELECT ins.id, hold.balance, hold.daily_spent FROM ins, hold
+            """),
+            {"user_id": user_id, "amount": amount, "purpose": purpose, "today": today}
+        )
+        row = result.fetchone()
+
+        if row is None:
+            # Резерв не встал: объясняем причину по актуальному состоянию
+            await self.raise_insufficient(db, user_id, amount)
+
+        return {
+            "hold_id": row[0],
+            "user_id": user_id,
+            "amount": amount,
+            "purpose": purpose,
+            "balance": row[1],
+            "daily_spent": row[2]
+        }
+
+    async def settle(
+        self,
+        db: AsyncSession,
+        reservation: dict,
+        coins: int,
+        model: str,
+        tokens_used: int,
+        cost_usd: float,
+        usd_rate: float,
+        description: str,
+        source: Optional[str] = "web",
+        allow_overdraft: bool = False
+    ) -> Optional[dict]:
+        """
+        Закрывает резерв фактической стоимостью: возвращает остаток резерва,
+        списывает coins, пишет usage_logs и transactions - одним запросом.
+
+        Без allow_overdraft списание проходит, только если баланс и дневной лимит
+        покрывают фактическую стоимость; иначе None (резерв остаётся - его
+        нужно снять через release). allow_overdraft используется, когда ответ
+        уже доставлен пользователю (стриминг).
+
+        Если резерва уже нет (его вернул release_stale_holds), стоимость
+        списывается напрямую через charge с теми же условиями.
+        """
+        result = await db.execute(
+            text(f"""
+                WITH charged AS (
+                    UPDATE users SET
+                        balance = users.balance + h.amount - :coins,
+                        daily_spent = GREATEST(COALESCE(users.daily_spent, 0) - h.amount + :coins, 0)
+                    FROM coin_holds h
+                    WHERE h.id = :hold_id
+                      AND users.id = h.user_id
+                      AND (
+                          CAST(:allow_overdraft AS BOOLEAN)
+                          OR (
+                              users.balance + h.amount >= :coins
+                              AND (
+                                  COALESCE({_DAILY_LIMIT_SQL}, 0) <= 0
+                                  OR COALESCE(users.daily_spent, 0) - h.amount + :coins <= {_DAILY_LIMIT_SQL}
+                              )
+                          )
+                      )
+                    RETURNING users.id, users.balance, users.daily_spent
+                ), released AS (
+                    DELETE FROM coin_holds
+                    WHERE id = :hold_id AND EXISTS (SELECT 1 FROM charged)
+                ), usage AS (
+                    INSERT INTO usage_logs (user_id, model_id, tokens_used, cost_rub, coins_spent)
+                    SELECT id, :model, CAST(:tokens AS INTEGER), CAST(:cost_rub AS DOUBLE PRECISION), :coins FROM charged
+                ), tx AS (
+                    INSERT INTO transactions (user_id, type, amount, balance_before, balance_after, description, model, tokens_used, cost_usd, usd_rate, source)
+                    SELECT id, 'spend', -:coins, balance + :coins, balance, :desc, :model, CAST(:tokens AS INTEGER),
+                           CAST(:cost_usd AS DOUBLE PRECISION), CAST(:usd_rate AS DOUBLE PRECISION), :source
+                    FROM charged
+                )
+                SELECT balance, daily_spent FROM charged
+            """),
+            {
+                "hold_id": reservation["hold_id"],
+                "coins": coins,
+                "allow_overdraft": allow_overdraft,
+                "model": model,
+                "tokens": tokens_used,
+                "cost_rub": coins / 100,
+                "cost_usd": cost_usd,
+                "usd_rate": usd_rate,
+                "desc": description,
+                "source": source or "web"
+            }
+        )
+        row = result.fetchone()
+        if row is None:
+            if await self._hold_exists(db, reservation["hold_id"]):
+                return None
+            logger.warning(
+                f"Coin hold {reservation['hold_id']} of user {reservation['user_id']} "
+                f"was released before settle, charging {coins} coins directly"
+            )
+            return await self.charge(
+                db, reservation["user_id"], coins, model, tokens_used, cost_usd, usd_rate,
+                description, source, allow_overdraft
+            )
+
+        return {
+            "coins_spent": coins,
+            "balance": row[0] or 0,
+            "daily_spent": row[1] or 0
+        }
+
+    async def _hold_exists(self, db: AsyncSession, hold_id: int) -> bool:
+        result = await db.execute(text("SELECT 1 FROM coin_holds WHERE id = :hold_id"), {"hold_id": hold_id})
+        return result.fetchone() is not None
+
+    async def charge(
+        self,
+        db: AsyncSession,
+        user_id: int,
+        coins: int,
+        model: str,
+        tokens_used: int,
+        cost_usd: float,
+        usd_rate: float,
+        description: str,
+        source: Optional[str] = "web",
+        allow_overdraft: bool = False
+    ) -> Optional[dict]:
+        """
+        Списание без резерва (резерв уже снят): те же usage_logs и transactions,
+        что и в settle. Без allow_overdraft - только если хватает баланса
+        и дневного лимита, иначе None.
+        """
+        today = date.today()
+        result = await db.execute(
+            text(f"""
+                WITH charged AS (
+                    UPDATE users SET
+                        balance = balance - :coins,
+                        daily_spent = {_DAILY_SPENT_SQL} + :coins,
+                        daily_spent_date = :today
+                    WHERE id = :user_id
+                      AND (
+                          CAST(:allow_overdraft AS BOOLEAN)
+                          OR (
+                              balance >= :coins
+                              AND (
+                                  COALESCE({_DAILY_LIMIT_SQL}, 0) <= 0
+                                  OR {_DAILY_SPENT_SQL} + :coins <= {_DAILY_LIMIT_SQL}
+                              )
+                          )
+                      )
+                    RETURNING id, balance, daily_spent
+                ), usage AS (
+                    INSERT INTO usage_logs (user_id, model_id, tokens_used, cost_rub, coins_spent)
+                    SELECT id, :model, CAST(:tokens AS INTEGER), CAST(:cost_rub AS DOUBLE PRECISION), :coins FROM charged
+                ), tx AS (
+                    INSERT INTO transactions (user_id, type, amount, balance_before, balance_after, description, model, tokens_used, cost_usd, usd_rate, source)
+                    SELECT id, 'spend', -:coins, balance + :coins, balance, :desc, :model, CAST(:tokens AS INTEGER),
+                           CAST(:cost_usd AS DOUBLE PRECISION), CAST(:usd_rate AS DOUBLE PRECISION), :source
+                    FROM charged
+                )
+                SELECT balance, daily_spent FROM charged
+            """),
+            {
+                "user_id": user_id,
+                "coins": coins,
+                "today": today,
+                "allow_overdraft": allow_overdraft,
+                "model": model,
+                "tokens": tokens_used,
+                "cost_rub": coins / 100,
+                "cost_usd": cost_usd,
+                "usd_rate": usd_rate,
+                "desc": description,
+                "source": source or "web"
+            }
+        )
+        row = result.fetchone()
+        if row is None:
+            return None
+
+        return {
+            "coins_spent": coins,
+            "balance": row[0] or 0,
+            "daily_spent": row[1] or 0
+        }
+
+    async def release(self, db: AsyncSession, reservation: dict):
+        """Снимает резерв целиком (ошибка провайдера, отмена). Повторный вызов ничего не делает"""
+        await db.execute(
+            text("""
+                WITH released AS (
+                    DELETE FROM coin_holds WHERE id = :hold_id
+                    RETURNING user_id, amount
+                )
+                UPDATE users SET
+                    balance = users.balance + released.amount,
+                    daily_spent = GREATEST(COALESCE(users.daily_spent, 0) - released.amount, 0)
+                FROM released
+                WHERE users.id = released.user_id
+            """),
+            {"hold_id": reservation["hold_id"]}
+        )
+
+    async def abort(self, db: AsyncSession, reservation: dict):
+        """Откатывает незавершённую запись результата и снимает резерв"""
+        await db.rollback()
+        await self.release(db, reservation)
+        await db.commit()
+
+    async def raise_insufficient(self, db: AsyncSession, user_id: int, coins: int):
+        """BudgetError с причиной отказа по свежему снимку бюджета"""
+        fresh = await self.get_budget_state(db, user_id)
+        check_budget(fresh, coins)
+        raise BudgetError(402, {
+            "error": f"Недостаточно коинов. Нужно {coins}, у вас {fresh['balance']}.",
+            "error_type": "low_balance",
+            "balance": fresh["balance"],
+            "topup_url": "/pricing"
+        })
+
+    async def release_stale_holds(self, db: AsyncSession) -> int:
+        """Возвращает резервы, которые не были закрыты (воркер упал посреди запроса)"""
+        result = await db.execute(
+            text("""
+                WITH released AS (
+                    DELETE FROM coin_holds
+                    WHERE created_at < NOW() - INTERVAL '1 minute' * :minutes
+                    RETURNING user_id, amount
+                ), totals AS (
+                    SELECT user_id, SUM(amount) AS amount, COUNT(*) AS holds
+                    FROM released GROUP BY user_id
+                )
+                UPDATE users SET
+                    balance = users.balance + totals.amount,
+                    daily_spent = GREATEST(COALESCE(users.daily_spent, 0) - totals.amount, 0)
+                FROM totals
+                WHERE users.id = totals.user_id
+                RETURNING totals.holds
+            """),
+            {"minutes": STALE_HOLD_MINUTES}
+        )
+        return sum(row[0] for row in result.fetchall())
+
+
+billing_service = BillingService()
+
+
+async def start_stale_holds_scheduler():
+    """Фоновая задача: раз в 5 минут возвращает брошенные резервы"""
+    from ..core.database import AsyncSessionLocal
+
+    while True:
+        await asyncio.sleep(300)
+        try:
+            async with AsyncSessionLocal() as db:
+                released = await billing_service.release_stale_holds(db)
+                await db.commit()
+            if released > 0:
+                logger.warning(f"Released {released} stale coin holds")
+        except Exception as e:
+            logger.error(f"Failed to release stale coin holds: {e}")
@@ -0,0 +1,194 @@
+"""
+Бюджет контекста: сколько истории диалога отправлять модели.
+
+История (последние CONTEXT_WINDOW сообщений) укладывается в бюджет токенов
+модели по сохранённым счётчикам Message.tokens_used - от новых к старым.
+Не поместившиеся сообщения заменяются кратким содержанием (conversations.summary),
+которое в фоне обновляет дешёвая модель. Краткое содержание покрывает
+сообщения до summary_upto_id включительно.
+"""
+
+import asyncio
+import logging
+
+from sqlalchemy import text
+
+from ..core.config import settings
+from ..core.metrics import metrics, MetricNames
+from .tokenizer import token_counter
+
+logger = logging.getLogger(__name__)
+
+# Дорогие модели получают меньше истории (префикс id модели -> бюджет в токенах)
+HISTORY_BUDGET_OVERRIDES = {
+    "anthropic/claude-opus": 3000,
+    "openai/o1": 3000,
+    "openai/gpt-4-turbo": 3000,
+}
+
+SUMMARY_MODEL = "google/gemini-2.0-flash-001"
+# Краткое содержание обновляется, когда за бюджет вышло хотя бы столько токенов
+SUMMARY_MIN_TOKENS = 1000
+SUMMARY_MAX_TOKENS = 600
+# Сколько сообщений максимум сворачивается за один фоновый вызов
+SUMMARY_BATCH_MESSAGES = 40
+
+SUMMARY_PROMPT = """Сожми переписку пользователя с ассистентом в краткое содержание на языке переписки.
+Сохрани факты, договорённости, имена, числа и открытые вопросы. Не добавляй ничего от себя.
+Не длиннее 200 слов."""
+
+
+def _message_tokens(msg: dict, model: str) -> int:
+    return msg.get("tokens") or token_counter.count(msg["content"], model)
+
+
+class ContextBudgeter:
+    def __init__(self):
+        # conversation_id -> фоновая задача; держим ссылку, чтобы задачу не собрал GC
+        self._summarizing = {}
+
+    def budget_for(self, model: str) -> int:
+        for prefix, budget in HISTORY_BUDGET_OVERRIDES.items():
+            if model.startswith(prefix):
+                return budget
+        return settings.CHAT_HISTORY_TOKEN_BUDGET
+
+    def fit(self, preflight: dict, model: str) -> dict:
+        """
+        История, которая уходит модели: самые новые сообщения в пределах бюджета
+        (последнее сообщение - всегда) плюс краткое содержание остального.
+        """
+        history = preflight["history"]
+        summary = preflight.get("summary")
+        budget = self.budget_for(model)
+        summary_tokens = token_counter.count(summary, SUMMARY_MODEL) if summary else 0
+
+        kept = []
+        used = summary_tokens
+        for msg in reversed(history):
+            tokens = _message_tokens(msg, model)
+            if kept and used + tokens > budget:
+                break
+            kept.append(msg)
+            used += tokens
+        kept.reverse()
+        dropped = history[:len(history) - len(kept)]
+
+        # Краткое содержание нужно, только если что-то из диалога не попало в запрос
+        omitted = bool(dropped) or preflight.get("message_count", 0) > len(kept)
+        if not omitted:
+            summary = None
+
+        dropped_tokens = sum(_message_tokens(msg, model) for msg in dropped)
+        tokens_saved = max(0, dropped_tokens - (summary_tokens if summary else 0))
+        if tokens_saved:
+            metrics.inc_counter(MetricNames.CONTEXT_TOKENS_SAVED, tokens_saved, labels={"model": model})
+
+        summary_upto_id = preflight.get("summary_upto_id") or 0
+        uncovered = [msg for msg in dropped if msg.get("id") and msg["id"] > summary_upto_id]
+        summarize_upto_id = None
+        if sum(_message_tokens(msg, model) for msg in uncovered) >= SUMMARY_MIN_TOKENS:
+            summarize_upto_id = uncovered[-1]["id"]
+
+        return {
+            "history": kept,
+            "summary": summary,
+            # Весь диалог в запросе: история между ходами только дополняется (см. prompt_builder)
+            "history_complete": not omitted,
+            "tokens_saved": tokens_saved,
+            "summarize_upto_id": summarize_upto_id
+        }
+
+    def schedule_summary(self, conversation_id: int, context: dict):
+        """Запускает фоновое обновление краткого содержания, если оно отстало"""
+        upto_id = context["summarize_upto_id"]
+        if upto_id is None or conversation_id in self._summarizing:
+            return
+        task = asyncio.create_task(self._summarize(conversation_id, upto_id))
+        self._summarizing[conversation_id] = task
+        task.add_done_callback(lambda t: self._summary_done(conversation_id, t))
+
+    def _summary_done(self, conversation_id: int, task: asyncio.Task):
+        self._summarizing.pop(conversation_id, None)
+        if task.cancelled():
+            return
+        error = task.exception()
+        if error is not None:
+            logger.error(f"Summary task failed for conversation {conversation_id}: {error!r}")
+
+    async def _summarize(self, conversation_id: int, upto_id: int):
+        """
+        Сворачивает сообщения (summary_upto_id, upto_id] вместе с прежним кратким
+        содержанием. Стоимость вызова дешёвой модели пользователю не списывается.
+        """
+        from ..core.database import AsyncSessionLocal
+        from .ai_service import ai_service
+
+        try:
+            async with AsyncSessionLocal() as db:
+                result = await db.execute(
+                    text("""
+                        SELECT c.summary, COALESCE(c.summary_upto_id, 0) AS summary_upto_id
+                        FROM conversations c WHERE c.id = :conversation_id
+                    """),
+                    {"conversation_id": conversation_id}
+                )
+                row = result.fetchone()
+                if row is None or row.summary_upto_id >= upto_id:
+                    return
+
+                result = await db.execute(
+                    text("""
+                        SELECT id, lower(role::text) AS role, content
+                        FROM messages
+                        WHERE conversation_id = :conversation_id AND id > :after AND id <= :upto
+                        ORDER BY id
+                        LIMIT :batch
+                    """),
+                    {
+                        "conversation_id": conversation_id,
+                        "after": row.summary_upto_id,
+                        "upto": upto_id,
+                        "batch": SUMMARY_BATCH_MESSAGES
+                    }
+                )
+                messages = result.fetchall()
+                await db.commit()  # не держим соединение во время вызова модели
+                if not messages:
+                    return
+
+                transcript = "\n\n".join(
+                    f"{'Пользователь' if m.role == 'user' else 'Ассистент'}: {m.content}" for m in messages
+                )
+                if row.summary:
+                    transcript = f"Краткое содержание ранее:\n{row.summary}\n\nПродолжение:\n{transcript}"
+
+                response = await ai_service.generate_response(
+                    [
+                        {"role": "system", "content": SUMMARY_PROMPT},
+                        {"role": "user", "content": transcript}
+                    ],
+                    SUMMARY_MODEL,
+                    max_tokens=SUMMARY_MAX_TOKENS,
+                    temperature=0
+                )
+                summary = (response.get("choices", [{}])[0].get("message", {}).get("content") or "").strip()
+                if not summary:
+                    return
+
+                await db.execute(
+                    text("""
+                        UPDATE conversations
+                        SET summary = :summary, summary_upto_id = :upto
+                        WHERE id = :conversation_id AND COALESCE(summary_upto_id, 0) < :upto
+                    """),
+                    {"summary": summary, "upto": messages[-1].id, "conversation_id": conversation_id}
+                )
+                await db.commit()
+            metrics.inc_counter(MetricNames.CONTEXT_SUMMARIES)
+        except Exception as e:
+            logger.error(f"Failed to summarize conversation {conversation_id}: {e}")
+
+
+context_budgeter = ContextBudgeter()
+
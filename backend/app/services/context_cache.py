@@ -0,0 +1,78 @@
+"""
+Кэш контекста диалога в Redis: последние сообщения в виде
+{id, role, content, tokens}, из которых собирается история для модели.
+
+Ключ привязан к пользователю и ставится только после проверки владельца
+диалога в БД, поэтому попадание в кэш само по себе подтверждает доступ.
+Новые ответы дописываются в конец списка, правка и удаление диалога
+сбрасывают ключ; при промахе история читается из БД и кэш заполняется заново.
+"""
+
+import logging
+from typing import Optional
+
+from ..core.cache import cache, CacheKeys, CacheTTL
+from ..core.metrics import metrics, MetricNames
+
+logger = logging.getLogger(__name__)
+
+# Сколько последних сообщений диалога отправляется модели
+CONTEXT_WINDOW = 10
+
+
+class ConversationContextCache:
+    def __init__(self):
+        self._hits = 0
+        self._misses = 0
+
+    def _record(self, hit: bool):
+        if hit:
+            self._hits += 1
+            metrics.inc_counter(MetricNames.CONTEXT_CACHE_HITS)
+        else:
+            self._misses += 1
+            metrics.inc_counter(MetricNames.CONTEXT_CACHE_MISSES)
+        metrics.set_gauge(MetricNames.CONTEXT_CACHE_HIT_RATIO, self._hits / (self._hits + self._misses))
+
+    async def get(self, user_id: int, conversation_id: int) -> Optional[list]:
+        """История диалога из кэша или None (нужно читать из БД)"""
+        history = await cache.list_get(CacheKeys.conversation_context(user_id, conversation_id))
+        self._record(history is not None)
+        return history
+
+    async def fill(self, user_id: int, conversation_id: int, history: list):
+        """Заполняет кэш историей, прочитанной из БД"""
+        if history:
+            await cache.list_set(
+                CacheKeys.conversation_context(user_id, conversation_id),
+                history, CONTEXT_WINDOW, CacheTTL.LONG
+            )
+
+    async def append(self, user_id: int, conversation_id: int, entries: list):
+        """Дописывает новые сообщения (если контекста в кэше нет - ничего не делает)"""
+        await cache.list_append(
+            CacheKeys.conversation_context(user_id, conversation_id),
+            entries, CONTEXT_WINDOW, CacheTTL.LONG
+        )
+
+    async def invalidate(self, user_id: int, conversation_id: int):
+        await cache.delete(CacheKeys.conversation_context(user_id, conversation_id))
+
+    async def invalidate_user(self, user_id: int):
+        await cache.delete_pattern(CacheKeys.conversation_context(user_id, "*"))
+
+    async def invalidate_all(self):
+        await cache.delete_pattern(CacheKeys.conversation_context("*", "*"))
+
+
+context_cache = ConversationContextCache()
+
+
+def context_entry(message) -> dict:
+    """Запись кэша из сохранённого Message"""
+    return {
+        "id": message.id,
+        "role": message.role.value,
+        "content": message.content,
+        "tokens": message.tokens_used
+    }
@@ -0,0 +1,177 @@
+"""
+Переключение на равноценные модели и хеджирование запросов.
+
+Политика - группа взаимозаменяемых моделей. Если запрошенная модель из
+группы отвечает 5xx/429, обрывает соединение, её предохранитель открыт или
+исчерпан лимит запросов, запрос уходит следующей модели группы. Общего
+ограничения на длительность ответа нет: долгий, но живой ответ не
+обрывается (иначе ждать пришлось бы вдвое дольше, а провайдер взял бы плату
+за оба запроса). Зависание ловят таймаут чтения httpx и, в потоке,
+FAILOVER_STALL_SECONDS до первого фрагмента (AIService.stream_message).
+
+С хеджированием (hedge=True) второй запрос к запасной модели уходит, не
+дожидаясь ошибки: если основная модель не ответила за свой p95 (по последним
+успешным ответам в этом воркере). Побеждает первый успешный ответ,
+проигравший запрос отменяется. Стоимость считается по модели, которая
+ответила (поле model результата).
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+from collections.abc import Awaitable, Callable
+from typing import Optional
+
+import httpx
+
+from ..core.config import settings
+from ..core.http import UpstreamHTTPError, UpstreamUnavailable
+from ..core.metrics import metrics, MetricNames
+from ..core.scheduler import UpstreamQueueTimeout
+
+logger = logging.getLogger(__name__)
+
+# Сколько последних длительностей хранится на модель и сколько нужно для p95
+LATENCY_WINDOW = 200
+LATENCY_MIN_SAMPLES = 20
+
+
+class FailoverPolicy:
+    def __init__(self, name: str, models: list[str], hedge: bool = False):
+        self.name = name
+        self.models = models
+        self.hedge = hedge
+
+    def chain(self, model: str) -> list[str]:
+        """Запрошенная модель, затем остальные модели группы по порядку"""
+        return [model] + [m for m in self.models if m != model]
+
+
+FAILOVER_POLICIES = [
+    # Дешёвые модели: второй запрос почти ничего не стоит - хеджируем
+    FailoverPolicy("gemini-flash", ["google/gemini-2.0-flash-001", "openai/gpt-4o-mini"], hedge=True),
+    FailoverPolicy("claude-sonnet", ["anthropic/claude-sonnet-4", "anthropic/claude-3.7-sonnet"]),
+]
+
+
+def is_failover_error(error: BaseException) -> bool:
+    """Ошибки, при которых есть смысл спросить другую модель"""
+    if isinstance(error, UpstreamHTTPError):
+        return error.status_code == 429 or error.status_code >= 500
+    if isinstance(error, UpstreamQueueTimeout):
+        return False  # перегружен сам воркер, другая модель ждала бы в той же очереди
+    return isinstance(error, (httpx.TransportError, asyncio.TimeoutError, UpstreamUnavailable))
+
+
+class FailoverRouter:
+    def __init__(self, policies: list[FailoverPolicy]):
+        self._policies: dict[str, FailoverPolicy] = {}
+        for policy in policies:
+            for model in policy.models:
+                self._policies[model] = policy
+        self._latencies: dict[str, deque] = {}
+
+    def policy_for(self, model: str) -> Optional[FailoverPolicy]:
+        if not settings.FAILOVER_ENABLED:
+            return None
+        return self._policies.get(model)
+
+    def record_latency(self, model: str, seconds: float):
+        self._latencies.setdefault(model, deque(maxlen=LATENCY_WINDOW)).append(seconds)
+
+    def hedge_delay(self, model: str) -> float:
+        """p95 успешных ответов модели в пределах [HEDGE_MIN, HEDGE_MAX]"""
+        samples = self._latencies.get(model)
+        if not samples or len(samples) < LATENCY_MIN_SAMPLES:
+            return settings.HEDGE_MAX_DELAY_SECONDS
+        ordered = sorted(samples)
+        p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+        return min(max(p95, settings.HEDGE_MIN_DELAY_SECONDS), settings.HEDGE_MAX_DELAY_SECONDS)
+
+    def record(self, policy: FailoverPolicy, model: str, outcome: str):
+        """outcome: win - модель ответила, error - ошибка, lost - отменена проигравшей в хедже"""
+        metrics.inc_counter(
+            MetricNames.FAILOVER_ATTEMPTS,
+            labels={"policy": policy.name, "model": model, "outcome": outcome}
+        )
+
+    async def call(self, model: str, fn: Callable[[str], Awaitable[dict]]) -> dict:
+        """
+        fn(model) делает запрос к конкретной модели и возвращает результат
+        с полем model. Без политики для модели - просто fn(model).
+        """
+        policy = self.policy_for(model)
+        if policy is None:
+            return await fn(model)
+
+        chain = policy.chain(model)
+        if policy.hedge and settings.HEDGING_ENABLED:
+            return await self._hedged(policy, chain, fn)
+        return await self._sequential(policy, chain, fn)
+
+    async def _attempt(self, model: str, fn: Callable[[str], Awaitable[dict]]) -> dict:
+        started = time.perf_counter()
+        result = await fn(model)
+        self.record_latency(model, time.perf_counter() - started)
+        return result
+
+    async def _sequential(self, policy: FailoverPolicy, chain: list[str], fn) -> dict:
+        for i, model in enumerate(chain):
+            last = i == len(chain) - 1
+            try:
+                result = await self._attempt(model, fn)
+            except Exception as e:
+                self.record(policy, model, "error")
+                if last or not is_failover_error(e):
+                    raise
+                logger.warning(f"Failover {policy.name}: {model} failed ({e}), trying {chain[i + 1]}")
+                continue
+            self.record(policy, model, "win")
+            return result
+
+    async def _hedged(self, policy: FailoverPolicy, chain: list[str], fn) -> dict:
+        primary, backup = chain[0], chain[1]
+        primary_task = asyncio.ensure_future(self._attempt(primary, fn))
+        tasks = {primary_task: primary}
+        try:
+            done, _ = await asyncio.wait({primary_task}, timeout=self.hedge_delay(primary))
+            if not done:
+                metrics.inc_counter(MetricNames.HEDGES_FIRED, labels={"policy": policy.name})
+            elif primary_task.exception() is None:
+                self.record(policy, primary, "win")
+                return primary_task.result()
+            else:
+                self.record(policy, primary, "error")
+                if not is_failover_error(primary_task.exception()):
+                    raise primary_task.exception()
+                del tasks[primary_task]
+
+            # Основная модель тормозит или упала - подключаем запасную
+            tasks[asyncio.ensure_future(self._attempt(backup, fn))] = backup
+            error = None
+            while tasks:
+                done, _ = await asyncio.wait(set(tasks), return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    model = tasks.pop(task)
+                    if task.exception() is None:
+                        self.record(policy, model, "win")
+                        return task.result()
+                    self.record(policy, model, "error")
+                    error = task.exception()
+                    if not is_failover_error(error):
+                        # Ошибка запроса, а не провайдера: запасная модель её не исправит
+                        raise error
+            raise error
+        finally:
+            for task, model in tasks.items():
+                if not task.done():
+                    task.cancel()
+                    self.record(policy, model, "lost")
+            # Дожидаемся отменённых попыток: они освобождают слоты и токены лимитов,
+            # а их исключения не должны остаться необработанными
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+
+failover_router = FailoverRouter(FAILOVER_POLICIES)
@@ -5,16 +5,21 @@
 """
 
 import math
-import httpx
 import base64
 import re
-from typing import Dict, Any, Optional, List
+from typing import Any
 from pathlib import Path
-from datetime import datetime
 import aiofiles
 import uuid
 
 from ..core.config import settings
+from ..core.singleflight import SingleFlight, make_key
+from ..core.http import http_clients
+from ..core.retry import retry_call
+from ..core.circuit_breaker import circuit_breakers
+from ..core.upstream_limits import upstream_limiter
+from ..core.key_pool import openrouter_keys
+from ..core.scheduler import upstream_slot
 from .currency_service import currency_service
 from .openrouter_prices import openrouter_prices_service
 
@@ -63,14 +68,14 @@ IMAGES_DIR.mkdir(parents=True, exist_ok=True)
 
 class ImageGenerationService:
     def __init__(self):
-        self.api_key = settings.OPENROUTER_API_KEY
         self.base_url = "https://openrouter.ai/api/v1"
+        # Authorization добавляется на каждый запрос ключом из openrouter_keys
         self.headers = {
-            "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json",
             "HTTP-Referer": settings.SITE_URL,
             "X-Title": "LANA AI Helper"
         }
+        self._generate_flight = SingleFlight("images", timeout=180.0)
 
     async def generate_image(
         self,
@@ -78,7 +83,7 @@ class ImageGenerationService:
         model: str = "google/gemini-2.0-flash-exp-image-generation",
         aspect_ratio: str = "1:1",
         num_images: int = 1
-    ) -> Dict[str, Any]:
+    ) -> dict[str, Any]:
         """
         Генерация изображения через OpenRouter API
 
@@ -96,6 +101,15 @@ class ImageGenerationService:
             model = "google/gemini-2.0-flash-exp-image-generation"
             model_info = IMAGE_MODELS[model]
 
+        # Одинаковые одновременные запросы делят одну генерацию (и одни файлы);
+        # списание коинов по-прежнему у каждого пользователя своё
+        key = make_key(prompt, model, aspect_ratio, num_images)
+        return await self._generate_flight.do(
+            key,
+            lambda: self._generate(prompt, model, model_info, aspect_ratio)
+        )
+
+    async def _generate(self, prompt: str, model: str, model_info: dict, aspect_ratio: str) -> dict[str, Any]:
         # Формируем запрос
         request_body = {
             "model": model,
@@ -116,18 +130,32 @@ class ImageGenerationService:
                     "aspect_ratio": aspect_ratio
                 }
 
-        async with httpx.AsyncClient(timeout=180.0) as client:
-            response = await client.post(
-                f"{self.base_url}/chat/completions",
-                headers=self.headers,
-                json=request_body
-            )
-
-            if response.status_code != 200:
-                error_text = response.text
-                raise Exception(f"OpenRouter API error: {response.status_code} - {error_text}")
-
-            result = response.json()
+        client = http_clients.get("openrouter")
+        used_key = None
+
+        async def attempt():
+            nonlocal used_key
+            async with upstream_slot("openrouter"):
+                key = await openrouter_keys.choose()
+                await upstream_limiter.acquire("openrouter", model, key.id)
+                response = await client.post(
+                    f"{self.base_url}/chat/completions",
+                    headers=key.headers(self.headers),
+                    json=request_body,
+                    timeout=180.0
+                )
+                await upstream_limiter.observe("openrouter", model, response, key.id)
+                await openrouter_keys.report(key, response)
+                if response.status_code != 200:
+                    raise openrouter_keys.error(key, "OpenRouter", response)
+                used_key = key
+                return response.json()
+
+        # Генерация платная у провайдера: повторяем, только если запрос точно не обработан
+        result = await circuit_breakers.call(
+            "openrouter", model,
+            lambda: retry_call("openrouter", attempt, idempotent=False)
+        )
 
         # Извлекаем изображения из ответа
         images = []
@@ -194,6 +222,8 @@ class ImageGenerationService:
                 model_info.get("image_price", 0.02) * len(images)
             )
 
+        await openrouter_keys.record_spend(used_key, cost_usd)
+
         multiplier = get_usd_to_coins_multiplier(usd_rate)
         coins_spent = max(MIN_IMAGE_COST_COINS, math.ceil(cost_usd * multiplier))
 
@@ -230,7 +260,7 @@ class ImageGenerationService:
         except Exception as e:
             raise Exception(f"Failed to save image: {str(e)}")
 
-    async def get_image_models(self) -> List[Dict[str, Any]]:
+    async def get_image_models(self) -> list[dict[str, Any]]:
         """Получить список доступных моделей для генерации изображений с динамическими ценами"""
         usd_rate = await currency_service.get_usd_rate()
         multiplier = get_usd_to_coins_multiplier(usd_rate)
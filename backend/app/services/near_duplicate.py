@@ -0,0 +1,230 @@
+"""
+Индекс почти одинаковых промптов (SimHash + LSH) в Redis.
+
+Промпты, которые отличаются только регистром, пунктуацией или вежливым
+«пожалуйста» в конце, получают близкие 64-битные SimHash-отпечатки.
+Отпечаток режется на NEAR_DUP_BANDS полос; кандидаты - отпечатки, совпавшие
+хотя бы в одной полосе (при расстоянии Хэмминга < числа полос такое совпадение
+гарантировано). Кандидат принимается, если расстояние не больше
+NEAR_DUP_MAX_HAMMING, пересечение слов не ниже NEAR_DUP_MIN_JACCARD и
+совпадают все числа в тексте.
+
+Используется только для одноходовых запросов к дешёвым моделям и только
+по явной просьбе клиента (use_cache). Попадания со сравнением текстов
+пишутся в выборку для отчёта администратору (поиск ложных совпадений).
+"""
+
+import hashlib
+import json
+import logging
+import math
+import re
+import time
+from typing import Optional
+
+from ..core.cache import cache
+from ..core.config import settings
+from ..core.metrics import metrics, MetricNames
+
+logger = logging.getLogger(__name__)
+
+NEAR_DUP_BANDS = 4
+_BAND_BITS = 64 // NEAR_DUP_BANDS
+_BAND_MASK = (1 << _BAND_BITS) - 1
+
+SAMPLES_KEY = "neardup:samples"
+SAMPLES_LIMIT = 200
+STATS_KEY = "neardup:stats"
+
+_WORD_RE = re.compile(r"\w+")
+# Вежливые слова не меняют смысл запроса
+_FILLER_WORDS = {"please", "pls", "plz", "thanks", "thank", "you", "пожалуйста", "плиз", "спасибо", "пж", "пжл"}
+
+
+def normalize_prompt(text: str) -> list[str]:
+    """Слова промпта в нижнем регистре без пунктуации и вежливых слов в конце"""
+    words = _WORD_RE.findall(text.lower().replace("ё", "е"))
+    while words and words[-1] in _FILLER_WORDS:
+        words.pop()
+    while words and words[0] in _FILLER_WORDS:
+        words.pop(0)
+    return words
+
+
+def _feature_hash(feature: str) -> int:
+    return int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+def simhash(words: list[str]) -> int:
+    """64-битный SimHash по словам и парам соседних слов"""
+    features = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+    weights = [0] * 64
+    for feature in features:
+        h = _feature_hash(feature)
+        for bit in range(64):
+            weights[bit] += 1 if (h >> bit) & 1 else -1
+    fingerprint = 0
+    for bit in range(64):
+        if weights[bit] > 0:
+            fingerprint |= 1 << bit
+    return fingerprint
+
+
+def _bands(fingerprint: int) -> list[int]:
+    return [(fingerprint >> (i * _BAND_BITS)) & _BAND_MASK for i in range(NEAR_DUP_BANDS)]
+
+
+def _jaccard(a: list[str], b: list[str]) -> float:
+    sa, sb = set(a), set(b)
+    if not sa and not sb:
+        return 1.0
+    return len(sa & sb) / len(sa | sb)
+
+
+def _numbers(words: list[str]) -> set:
+    return {w for w in words if w.isdigit()}
+
+
+class NearDuplicateIndex:
+    def _prompt(self, messages: list, model: str) -> Optional[str]:
+        """Текст промпта, если запрос подходит для индекса, иначе None"""
+        if not settings.NEAR_DUP_CACHE_ENABLED:
+            return None
+        if model not in {m.strip() for m in settings.NEAR_DUP_MODELS.split(",")}:
+            return None
+
+        user_messages = [m for m in messages if m.get("role") == "user"]
+        if len(user_messages) != 1 or any(m.get("role") == "assistant" for m in messages):
+            return None  # только одноходовые запросы
+        content = user_messages[0].get("content")
+        if not isinstance(content, str):
+            return None
+        return content
+
+    def _band_key(self, model: str, band: int, value: int) -> str:
+        return f"neardup:{model}:b{band}:{value:04x}"
+
+    async def lookup(self, messages: list, model: str) -> Optional[dict]:
+        """Сохранённый ответ на похожий промпт со скидкой, как у response_cache"""
+        prompt = self._prompt(messages, model)
+        if prompt is None:
+            return None
+        words = normalize_prompt(prompt)
+        if not words:
+            return None
+
+        redis = await cache.client()
+        if redis is None:
+            return None
+
+        started = time.perf_counter()
+        fingerprint = simhash(words)
+        try:
+            async with redis.pipeline(transaction=False) as pipe:
+                for band, value in enumerate(_bands(fingerprint)):
+                    pipe.smembers(self._band_key(model, band, value))
+                candidates = set().union(*(await pipe.execute()))
+
+            best = None
+            for candidate in candidates:
+                distance = bin(int(candidate, 16) ^ fingerprint).count("1")
+                if distance <= settings.NEAR_DUP_MAX_HAMMING and (best is None or distance < best[1]):
+                    best = (candidate, distance)
+
+            entry = None
+            if best is not None:
+                raw = await redis.get(f"neardup:{model}:entry:{best[0]}")
+                entry = json.loads(raw) if raw else None
+        except Exception as e:
+            logger.warning(f"Near-duplicate lookup failed: {e}")
+            return None
+        finally:
+            metrics.observe_histogram(MetricNames.NEAR_DUP_LOOKUP_SECONDS, time.perf_counter() - started)
+
+        if entry is not None:
+            if (
+                _jaccard(words, entry["words"]) < settings.NEAR_DUP_MIN_JACCARD
+                or _numbers(words) != _numbers(entry["words"])
+            ):
+                entry = None
+
+        if entry is None:
+            metrics.inc_counter(MetricNames.NEAR_DUP_MISSES, labels={"model": model})
+            await self._record(redis, "misses")
+            return None
+
+        metrics.inc_counter(MetricNames.NEAR_DUP_HITS, labels={"model": model})
+        await self._record(redis, "hits", {
+            "model": model,
+            "prompt": prompt[:300],
+            "matched_prompt": entry["prompt"][:300],
+            "distance": best[1],
+            "at": int(time.time())
+        })
+
+        result = entry["result"]
+        coins = max(1, math.ceil(result["coins_spent"] * (1 - settings.RESPONSE_CACHE_DISCOUNT)))
+        return {**result, "coins_spent": coins, "cost_usd": 0.0, "cached": True}
+
+    async def add(self, messages: list, model: str, result: dict):
+        """Запоминает ответ на одноходовый промпт"""
+        prompt = self._prompt(messages, model)
+        if prompt is None or not result.get("content"):
+            return
+        words = normalize_prompt(prompt)
+        if not words:
+            return
+
+        redis = await cache.client()
+        if redis is None:
+            return
+
+        fingerprint = simhash(words)
+        member = f"{fingerprint:016x}"
+        ttl = settings.RESPONSE_CACHE_TTL_SECONDS
+        try:
+            async with redis.pipeline(transaction=False) as pipe:
+                pipe.setex(
+                    f"neardup:{model}:entry:{member}", ttl,
+                    json.dumps({"prompt": prompt[:2000], "words": words, "result": result}, ensure_ascii=False)
+                )
+                for band, value in enumerate(_bands(fingerprint)):
+                    key = self._band_key(model, band, value)
+                    pipe.sadd(key, member)
+                    pipe.expire(key, ttl)
+                await pipe.execute()
+        except Exception as e:
+            logger.warning(f"Near-duplicate index update failed: {e}")
+
+    async def _record(self, redis, outcome: str, sample: Optional[dict] = None):
+        try:
+            async with redis.pipeline(transaction=False) as pipe:
+                pipe.hincrby(STATS_KEY, outcome, 1)
+                if sample is not None:
+                    pipe.lpush(SAMPLES_KEY, json.dumps(sample, ensure_ascii=False))
+                    pipe.ltrim(SAMPLES_KEY, 0, SAMPLES_LIMIT - 1)
+                await pipe.execute()
+        except Exception as e:
+            logger.debug(f"Failed to record near-duplicate stats: {e}")
+
+    async def report(self, limit: int = 50) -> dict:
+        """Доля попаданий и последние совпадения (сначала самые далёкие - кандидаты в ложные)"""
+        redis = await cache.client()
+        stats = await redis.hgetall(STATS_KEY) or {}
+        samples = [json.loads(s) for s in await redis.lrange(SAMPLES_KEY, 0, SAMPLES_LIMIT - 1)]
+        samples.sort(key=lambda s: (-s["distance"], -s["at"]))
+
+        hits = int(stats.get("hits", 0))
+        misses = int(stats.get("misses", 0))
+        return {
+            "enabled": settings.NEAR_DUP_CACHE_ENABLED,
+            "max_hamming": settings.NEAR_DUP_MAX_HAMMING,
+            "min_jaccard": settings.NEAR_DUP_MIN_JACCARD,
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": round(hits / (hits + misses), 4) if hits + misses else 0.0,
+            "samples": samples[:limit]
+        }
+
+
+near_duplicate_index = NearDuplicateIndex()
@@ -1,8 +1,10 @@
-import httpx
 import logging
 from datetime import datetime, timedelta
 from typing import Dict, Tuple, Optional
 
+from ..core.http import http_clients, UpstreamHTTPError
+from ..core.retry import retry_call, should_retry_http
+
 logger = logging.getLogger(__name__)
 
 class OpenRouterPricesService:
@@ -67,46 +69,53 @@ class OpenRouterPricesService:
             return self._prices
 
         try:
-            async with httpx.AsyncClient(timeout=30) as client:
-                response = await client.get(self._api_url)
-
-                if response.status_code == 200:
-                    data = response.json()
-                    models = data.get("data", [])
-
-                    new_prices = {}
-                    for model in models:
-                        model_id = model.get("id", "")
-
-                        # Берём только нужные модели
-                        if model_id not in self._target_models:
-                            continue
-
-                        pricing = model.get("pricing", {})
-
-                        # Цены в долларах за токен, конвертируем в $ за 1M токенов
-                        prompt_price = float(pricing.get("prompt", 0)) * 1_000_000
-                        completion_price = float(pricing.get("completion", 0)) * 1_000_000
-
-                        if prompt_price > 0 or completion_price > 0:
-                            new_prices[model_id] = (prompt_price, completion_price)
-                            logger.info(f"Price updated: {model_id} = ${prompt_price:.4f} / ${completion_price:.4f} per 1M")
-
-                    if new_prices:
-                        self._prices = new_prices
-                        self._last_update = now
-                        logger.info(f"OpenRouter prices updated: {len(new_prices)} models")
-
-                        # Отдельно сохраняем цены для image моделей
-                        self._image_prices = {
-                            k: v for k, v in new_prices.items()
-                            if k in self._image_models
-                        }
-                        logger.info(f"Image model prices: {len(self._image_prices)} models")
-
-                    return self._prices
-                else:
-                    logger.warning(f"OpenRouter API returned {response.status_code}")
+            client = http_clients.get("openrouter")
+
+            async def attempt():
+                response = await client.get(self._api_url, timeout=30)
+                if should_retry_http(response.status_code):
+                    raise UpstreamHTTPError.from_response("OpenRouter", response)
+                return response
+
+            response = await retry_call("openrouter", attempt)
+
+            if response.status_code == 200:
+                data = response.json()
+                models = data.get("data", [])
+
+                new_prices = {}
+                for model in models:
+                    model_id = model.get("id", "")
+
+                    # Берём только нужные модели
+                    if model_id not in self._target_models:
+                        continue
+
+                    pricing = model.get("pricing", {})
+
+                    # Цены в долларах за токен, конвертируем в $ за 1M токенов
+                    prompt_price = float(pricing.get("prompt", 0)) * 1_000_000
+                    completion_price = float(pricing.get("completion", 0)) * 1_000_000
+
+                    if prompt_price > 0 or completion_price > 0:
+                        new_prices[model_id] = (prompt_price, completion_price)
+                        logger.info(f"Price updated: {model_id} = ${prompt_price:.4f} / ${completion_price:.4f} per 1M")
+
+                if new_prices:
+                    self._prices = new_prices
+                    self._last_update = now
+                    logger.info(f"OpenRouter prices updated: {len(new_prices)} models")
+
+                    # Отдельно сохраняем цены для image моделей
+                    self._image_prices = {
+                        k: v for k, v in new_prices.items()
+                        if k in self._image_models
+                    }
+                    logger.info(f"Image model prices: {len(self._image_prices)} models")
+
+                return self._prices
+            else:
+                logger.warning(f"OpenRouter API returned {response.status_code}")
 
         except Exception as e:
             logger.error(f"Failed to fetch OpenRouter prices: {e}")
@@ -0,0 +1,101 @@
+"""
+Сборка запроса к модели со стабильным префиксом.
+
+Провайдеры кэшируют общий префикс запроса (Anthropic и Gemini через
+OpenRouter - по меткам cache_control). Чтобы префикс совпадал байт в байт
+между ходами диалога, в начале стоит только неизменная инструкция, затем
+краткое содержание и история в том же виде, что и в прошлый раз, а текущая
+дата идёт отдельным сообщением непосредственно перед новым вопросом.
+
+Метка cache_control ставится одна - в конце самого длинного префикса, который
+не меняется между ходами, и только если он не короче минимума провайдера
+(MIN_CACHEABLE_TOKENS): более короткий префикс провайдер не кэширует, а за
+запись в кэш берёт доплату. Инструкция с кратким содержанием до минимума
+не дотягивают, поэтому на практике кэшируется история, пока диалог целиком
+помещается в запрос; когда история становится скользящим окном, префикс
+меняется каждый ход и меток нет.
+"""
+
+from datetime import datetime
+from typing import Optional
+
+from .tokenizer import token_counter
+
+STATIC_SYSTEM_PROMPT = """Ты — полезный AI-ассистент LANA.
+Отвечай на языке пользователя. Будь точным, полезным и дружелюбным.
+Если не знаешь ответа — честно скажи об этом."""
+
+DATE_PROMPT_TEMPLATE = "Сегодня {current_date}."
+
+# Модели, для которых OpenRouter принимает метки cache_control
+CACHE_CONTROL_PREFIXES = ("anthropic/", "google/gemini-2.5")
+
+_CACHE_CONTROL = {"type": "ephemeral"}
+
+# Минимальная длина кэшируемого префикса в токенах (префикс id модели -> минимум)
+MIN_CACHEABLE_TOKENS = {
+    "anthropic/claude-3-haiku": 2048,
+    "anthropic/claude-3.5-haiku": 2048,
+    "anthropic/claude-haiku": 2048,
+    "google/gemini-2.5-pro": 2048,
+}
+DEFAULT_MIN_CACHEABLE_TOKENS = 1024
+
+
+def supports_prompt_caching(model: str) -> bool:
+    return model.startswith(CACHE_CONTROL_PREFIXES)
+
+
+def min_cacheable_tokens(model: str) -> int:
+    for prefix, tokens in MIN_CACHEABLE_TOKENS.items():
+        if model.startswith(prefix):
+            return tokens
+    return DEFAULT_MIN_CACHEABLE_TOKENS
+
+
+def _with_breakpoint(message: dict) -> dict:
+    """Сообщение с меткой cache_control на последнем текстовом блоке"""
+    content = message["content"]
+    if isinstance(content, str):
+        parts = [{"type": "text", "text": content}]
+    else:
+        parts = [dict(part) for part in content]
+    for part in reversed(parts):
+        if part.get("type") == "text":
+            part["cache_control"] = _CACHE_CONTROL
+            break
+    return {**message, "content": parts}
+
+
+def build_prompt(
+    model: str,
+    history: list[dict],
+    user_message: dict,
+    summary: Optional[str] = None,
+    current_date: Optional[str] = None,
+    history_complete: bool = False
+) -> list[dict]:
+    """
+    [инструкция] [краткое содержание] [история] [дата] [новое сообщение].
+    history_complete - в истории весь диалог (context_budgeter.fit), и на
+    следующем ходу она только дополнится: тогда история входит в стабильный
+    префикс. Для моделей с prompt caching метка ставится в конце стабильного
+    префикса, если он не короче min_cacheable_tokens(model).
+    """
+    current_date = current_date or datetime.now().strftime("%d.%m.%Y")
+
+    messages = [{"role": "system", "content": STATIC_SYSTEM_PROMPT}]
+    if summary:
+        messages.append({"role": "system", "content": f"Краткое содержание предыдущей части диалога:\n{summary}"})
+    # Счётчики токенов из сохранённой истории нужны только для оценки префикса
+    stable = messages + history if history_complete else list(messages)
+
+    for msg in history:
+        messages.append({"role": msg["role"], "content": msg["content"]})
+
+    if supports_prompt_caching(model) and token_counter.count_messages(stable, model) >= min_cacheable_tokens(model):
+        messages[len(stable) - 1] = _with_breakpoint(messages[len(stable) - 1])
+
+    messages.append({"role": "system", "content": DATE_PROMPT_TEMPLATE.format(current_date=current_date)})
+    messages.append(user_message)
+    return messages
@@ -0,0 +1,99 @@
+"""
+Кэш ответов моделей на полностью совпадающие запросы.
+
+Ключ - хэш нормализованного списка сообщений, модели и параметров
+генерации. При temperature > 0 ответ недетерминирован, поэтому такие
+запросы кэшируются, только если клиент явно попросил (use_cache).
+Попадание в кэш списывается через обычный billing со скидкой
+RESPONSE_CACHE_DISCOUNT.
+"""
+
+import hashlib
+import json
+import logging
+import math
+import time
+from typing import Optional
+
+from ..core.cache import cache
+from ..core.config import settings
+from ..core.metrics import metrics, MetricNames
+
+logger = logging.getLogger(__name__)
+
+CACHE_PREFIX = "response_cache:"
+CACHE_INDEX_KEY = "response_cache:index"
+
+
+def _normalize_text(text: str) -> str:
+    return " ".join(text.split())
+
+
+class ResponseCache:
+    def key_for(
+        self,
+        messages: list,
+        model: str,
+        temperature: float,
+        max_tokens: int,
+        use_cache: bool = False
+    ) -> Optional[str]:
+        """Ключ кэша или None, если запрос кэшировать нельзя"""
+        if not settings.RESPONSE_CACHE_ENABLED:
+            return None
+        if temperature > 0 and not use_cache:
+            return None
+
+        normalized = []
+        for msg in messages:
+            content = msg.get("content")
+            if not isinstance(content, str):
+                # Текстовые блоки (с метками cache_control) склеиваем; картинки не кэшируем
+                if any(part.get("type") != "text" for part in content):
+                    return None
+                content = "".join(part["text"] for part in content)
+            normalized.append([msg.get("role"), _normalize_text(content)])
+
+        payload = json.dumps(
+            {"messages": normalized, "model": model, "temperature": temperature, "max_tokens": max_tokens},
+            ensure_ascii=False,
+            separators=(",", ":")
+        )
+        return CACHE_PREFIX + hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    async def get(self, key: str, model: str) -> Optional[dict]:
+        """Сохранённый ответ с пересчитанной (со скидкой) стоимостью"""
+        started = time.perf_counter()
+        entry = await cache.get(key)
+        if entry is None:
+            metrics.inc_counter(MetricNames.RESPONSE_CACHE_MISSES, labels={"model": model})
+            return None
+
+        full_coins = entry["coins_spent"]
+        coins = max(1, math.ceil(full_coins * (1 - settings.RESPONSE_CACHE_DISCOUNT)))
+
+        metrics.inc_counter(MetricNames.RESPONSE_CACHE_HITS, labels={"model": model})
+        metrics.inc_counter(MetricNames.RESPONSE_CACHE_COINS_SAVED, full_coins - coins, labels={"model": model})
+        metrics.observe_histogram(MetricNames.RESPONSE_CACHE_HIT_SECONDS, time.perf_counter() - started)
+
+        return {
+            **entry,
+            "coins_spent": coins,
+            "cost_usd": 0.0,  # к провайдеру не ходили
+            "cached": True
+        }
+
+    async def put(self, key: str, result: dict):
+        if not result.get("content"):
+            return
+        evicted = await cache.set_capped(
+            key, result,
+            ttl=settings.RESPONSE_CACHE_TTL_SECONDS,
+            index_key=CACHE_INDEX_KEY,
+            max_entries=settings.RESPONSE_CACHE_MAX_ENTRIES
+        )
+        if evicted:
+            metrics.inc_counter(MetricNames.RESPONSE_CACHE_EVICTIONS, evicted)
+
+
+response_cache = ResponseCache()
@@ -0,0 +1,106 @@
+"""
+Фоновая очистка истории чатов: в каждом диалоге оставляем последние
+CHAT_RETENTION_MESSAGES сообщений.
+
+Раньше это делал DELETE внутри каждого /chat/send; теперь отправка только
+вставляет, а воркер выбирает диалоги по conversations.message_count
+порциями по id и удаляет лишнее по индексу ix_messages_conversation_created_id;
+каждая порция - своя короткая транзакция.
+"""
+
+import asyncio
+import logging
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..core.config import settings
+from ..core.metrics import metrics, MetricNames
+
+logger = logging.getLogger(__name__)
+
+
+class RetentionService:
+    async def trim_batch(self, db: AsyncSession, after_conversation_id: int, keep: int, batch_size: int) -> dict:
+        """
+        Обрезает до batch_size диалогов с id > after_conversation_id, в которых
+        больше keep сообщений. Возвращает число удалённых сообщений, диалогов
+        и последний обработанный conversation_id (None - диалогов больше нет).
+        """
+        result = await db.execute(
+            text("""
+                WITH over_limit AS (
+                    SELECT id AS conversation_id
+                    FROM conversations
+                    WHERE id > :after AND message_count > :keep
+                    ORDER BY id
+                    LIMIT :batch_size
+                ), doomed AS (
+                    SELECT old.id
+                    FROM over_limit o
+                    CROSS JOIN LATERAL (
+                        SELECT id FROM messages
+                        WHERE conversation_id = o.conversation_id
+                        ORDER BY created_at DESC, id DESC
+                        OFFSET :keep
+                    ) old
+                ), deleted AS (
+                    DELETE FROM messages
+                    WHERE id IN (SELECT id FROM doomed)
+                    RETURNING conversation_id
+                ), counted AS (
+                    UPDATE conversations c
+                    SET message_count = GREATEST(c.message_count - d.removed, 0)
+                    FROM (SELECT conversation_id, COUNT(*) AS removed FROM deleted GROUP BY conversation_id) d
+                    WHERE c.id = d.conversation_id
+                )
+                SELECT
+                    (SELECT COUNT(*) FROM deleted) AS messages,
+                    (SELECT COUNT(*) FROM over_limit) AS conversations,
+                    (SELECT MAX(conversation_id) FROM over_limit) AS last_id
+            """),
+            {"after": after_conversation_id, "keep": keep, "batch_size": batch_size}
+        )
+        row = result.fetchone()
+        return {"messages": row[0] or 0, "conversations": row[1] or 0, "last_id": row[2]}
+
+    async def run_once(self, keep: int = None, batch_size: int = None) -> int:
+        """Один полный проход по всем диалогам. Возвращает число удалённых сообщений"""
+        from ..core.database import AsyncSessionLocal
+
+        keep = keep or settings.CHAT_RETENTION_MESSAGES
+        batch_size = batch_size or settings.CHAT_RETENTION_BATCH_SIZE
+        after = 0
+        total = 0
+
+        while True:
+            async with AsyncSessionLocal() as db:
+                batch = await self.trim_batch(db, after, keep, batch_size)
+                await db.commit()
+
+            if batch["messages"]:
+                metrics.inc_counter(MetricNames.CHAT_RETENTION_DELETED, batch["messages"])
+                metrics.inc_counter(MetricNames.CHAT_RETENTION_CONVERSATIONS, batch["conversations"])
+                total += batch["messages"]
+
+            if batch["last_id"] is None or batch["conversations"] < batch_size:
+                return total
+
+            after = batch["last_id"]
+            # Не занимаем БД подряд - даём пройти пользовательским запросам
+            await asyncio.sleep(0.1)
+
+
+retention_service = RetentionService()
+
+
+async def start_retention_scheduler():
+    """Фоновая задача: периодически обрезает историю диалогов"""
+    while True:
+        await asyncio.sleep(settings.CHAT_RETENTION_INTERVAL_SECONDS)
+        try:
+            deleted = await retention_service.run_once()
+            if deleted > 0:
+                logger.info(f"Retention: deleted {deleted} old messages")
+        except Exception as e:
+            logger.error(f"Retention worker failed: {e}")
@@ -4,6 +4,8 @@
 Ценообразование: динамическое с маржой 900% + курс ЦБ РФ
 """
 
+import asyncio
+import logging
 import math
 import httpx
 import uuid
@@ -12,9 +14,16 @@ from pathlib import Path
 from datetime import datetime
 import aiofiles
 
-from ..core.config import settings
+from ..core.http import http_clients, UpstreamHTTPError
+from ..core.retry import retry_call
+from ..core.circuit_breaker import circuit_breakers
+from ..core.upstream_limits import upstream_limiter
+from ..core.key_pool import APIKey, replicate_keys
+from ..core.scheduler import upstream_slot
 from .currency_service import currency_service
 
+logger = logging.getLogger(__name__)
+
 # Маржа и комиссии (как в ai_service и image_service)
 MARGIN_MULTIPLIER = 10.0  # 900% маржа
 YOOKASSA_COMMISSION = 1.012  # 1.2% комиссия YooKassa
@@ -90,10 +99,10 @@ VIDEOS_DIR.mkdir(parents=True, exist_ok=True)
 
 class VideoGenerationService:
     def __init__(self):
-        self.api_token = settings.REPLICATE_API_TOKEN
         self.base_url = "https://api.replicate.com/v1"
+        # Authorization добавляется ключом из replicate_keys; prediction
+        # опрашивается тем же ключом, которым создан (он привязан к аккаунту)
         self.headers = {
-            "Authorization": f"Bearer {self.api_token}",
             "Content-Type": "application/json"
         }
 
@@ -140,26 +149,42 @@ class VideoGenerationService:
         if "duration" not in input_data:
             input_data["duration"] = duration
 
-        async with httpx.AsyncClient(timeout=300.0) as client:
-            # Создаем prediction
+        client = http_clients.get("replicate")
+
+        async def create_prediction():
+            # Ключ выбирается на каждую попытку: после 429 повтор уйдёт другому
+            key = await replicate_keys.choose()
+            version = await self._get_model_version(client, model, key)
+            await upstream_limiter.acquire("replicate", model, key.id)
             response = await client.post(
                 f"{self.base_url}/predictions",
-                headers=self.headers,
+                headers=key.headers(self.headers),
                 json={
-                    "version": await self._get_model_version(client, model),
+                    "version": version,
                     "input": input_data
                 }
             )
-
+            await upstream_limiter.observe("replicate", model, response, key.id)
+            await replicate_keys.report(key, response)
             if response.status_code != 201:
-                error_text = response.text
-                raise Exception(f"Replicate API error: {response.status_code} - {error_text}")
-
-            prediction = response.json()
-            prediction_id = prediction.get("id")
-
-            # Ждем завершения (polling)
-            video_url = await self._wait_for_prediction(client, prediction_id)
+                raise replicate_keys.error(key, "Replicate", response)
+            return response.json(), key
+
+        async def run():
+            # Слот Replicate занят на всё время генерации
+            async with upstream_slot("replicate"):
+                # Создаем prediction (повтор - только если Replicate точно его не создал)
+                prediction, key = await retry_call("replicate", create_prediction, idempotent=False)
+                # Ждем завершения (polling)
+                try:
+                    return await self._wait_for_prediction(client, prediction.get("id"), key), key
+                except asyncio.CancelledError:
+                    # Клиент ушёл - останавливаем генерацию, чтобы Replicate не считал её дальше
+                    await self._cancel_prediction(client, prediction.get("id"), key)
+                    raise
+
+        # При недоступном Replicate сразу CircuitOpenError вместо ожидания таймаутов
+        video_url, used_key = await circuit_breakers.call("replicate", model, run)
 
         # Скачиваем и сохраняем видео
         filename = await self._save_video(video_url)
@@ -167,6 +192,7 @@ class VideoGenerationService:
         # Расчет стоимости
         cost_per_second = model_info.get("cost_per_second", 0.05)
         cost_usd = cost_per_second * duration
+        await replicate_keys.record_spend(used_key, cost_usd)
 
         usd_rate = await currency_service.get_usd_rate()
         multiplier = get_usd_to_coins_multiplier(usd_rate)
@@ -183,15 +209,27 @@ class VideoGenerationService:
             "duration": duration
         }
 
-    async def _get_model_version(self, client: httpx.AsyncClient, model: str) -> str:
+    def estimate_coins(self, model: str, duration: int = 5) -> int:
+        """Стоимость видео в коинах до генерации (по цене за секунду)"""
+        model_info = VIDEO_MODELS.get(model) or VIDEO_MODELS["wan-video/wan-2.5-t2v-fast"]
+        duration = max(1, min(duration or 5, model_info.get("max_duration", 10)))
+        cost_usd = model_info.get("cost_per_second", 0.05) * duration
+        multiplier = get_usd_to_coins_multiplier(currency_service.get_cached_rate())
+        return max(MIN_VIDEO_COST_COINS, math.ceil(cost_usd * multiplier))
+
+    async def _get_model_version(self, client: httpx.AsyncClient, model: str, key: APIKey) -> str:
         """Получает последнюю версию модели"""
-        response = await client.get(
-            f"{self.base_url}/models/{model}/versions",
-            headers=self.headers
-        )
+        async def attempt():
+            response = await client.get(
+                f"{self.base_url}/models/{model}/versions",
+                headers=key.headers(self.headers)
+            )
+            await replicate_keys.report(key, response)
+            if response.status_code != 200:
+                raise replicate_keys.error(key, "Replicate", response)
+            return response
 
-        if response.status_code != 200:
-            raise Exception(f"Failed to get model version: {response.text}")
+        response = await retry_call("replicate", attempt)
 
         versions = response.json().get("results", [])
         if not versions:
@@ -203,21 +241,25 @@ class VideoGenerationService:
         self,
         client: httpx.AsyncClient,
         prediction_id: str,
+        key: APIKey,
         max_wait: int = 300
     ) -> str:
         """Ожидает завершения prediction и возвращает URL видео"""
-        import asyncio
-
         start_time = datetime.now()
 
-        while True:
+        async def poll():
             response = await client.get(
                 f"{self.base_url}/predictions/{prediction_id}",
-                headers=self.headers
+                headers=key.headers(self.headers)
             )
-
             if response.status_code != 200:
-                raise Exception(f"Failed to get prediction status: {response.text}")
+                raise UpstreamHTTPError.from_response("Replicate", response)
+            return response
+
+        while True:
+            # Опрос статуса не пополняет бюджет повторов: долгая генерация
+            # иначе накопила бы повторы для других запросов
+            response = await retry_call("replicate", poll, deposit=False)
 
             prediction = response.json()
             status = prediction.get("status")
@@ -246,28 +288,43 @@ class VideoGenerationService:
             # Ждем 2 секунды перед следующей проверкой
             await asyncio.sleep(2)
 
+    async def _cancel_prediction(self, client: httpx.AsyncClient, prediction_id: str, key: APIKey):
+        """Отменяет prediction; при ошибке она просто доработает (и будет оплачена провайдеру)"""
+        try:
+            await client.post(
+                f"{self.base_url}/predictions/{prediction_id}/cancel",
+                headers=key.headers(self.headers),
+                timeout=10.0
+            )
+        except httpx.HTTPError as e:
+            logger.warning(f"Failed to cancel Replicate prediction {prediction_id}: {e}")
+
     async def _save_video(self, video_url: str) -> str:
         """Скачивает и сохраняет видео"""
-        async with httpx.AsyncClient(timeout=120.0) as client:
-            response = await client.get(video_url)
+        client = http_clients.get("downloads")
 
+        async def download():
+            response = await client.get(video_url)
             if response.status_code != 200:
-                raise Exception(f"Failed to download video: {response.status_code}")
+                raise UpstreamHTTPError.from_response("Replicate", response, "failed to download video")
+            return response
+
+        response = await retry_call("replicate", download)
 
-            video_bytes = response.content
+        video_bytes = response.content
 
-            # Определяем формат
-            ext = "mp4"
-            if video_url.endswith(".webm"):
-                ext = "webm"
+        # Определяем формат
+        ext = "mp4"
+        if video_url.endswith(".webm"):
+            ext = "webm"
 
-            filename = f"{uuid.uuid4().hex}.{ext}"
-            filepath = VIDEOS_DIR / filename
+        filename = f"{uuid.uuid4().hex}.{ext}"
+        filepath = VIDEOS_DIR / filename
 
-            async with aiofiles.open(filepath, 'wb') as f:
-                await f.write(video_bytes)
+        async with aiofiles.open(filepath, 'wb') as f:
+            await f.write(video_bytes)
 
-            return filename
+        return filename
 
     async def get_video_models(self) -> List[Dict[str, Any]]:
         """Получить список доступных моделей для генерации видео"""
@@ -298,16 +355,18 @@ class VideoGenerationService:
 
     async def check_api_available(self) -> bool:
         """Проверяет доступность Replicate API"""
-        if not self.api_token:
+        if not replicate_keys:
             return False
 
         try:
-            async with httpx.AsyncClient(timeout=10.0) as client:
-                response = await client.get(
-                    f"{self.base_url}/models",
-                    headers=self.headers
-                )
-                return response.status_code == 200
+            key = await replicate_keys.choose()
+            client = http_clients.get("replicate")
+            response = await client.get(
+                f"{self.base_url}/models",
+                headers=key.headers(self.headers),
+                timeout=10.0
+            )
+            return response.status_code == 200
         except:
             return False
 
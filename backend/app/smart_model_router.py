@@ -13,6 +13,7 @@ from subscription_plans_optimized import (
     get_recommended_model,
     MODEL_ACCESS_RULES,
 )
+from services.tokenizer import token_counter
 
 class SmartModelRouter:
     """Умный выбор модели на основе контекста и тарифа"""
@@ -80,22 +81,18 @@ class SmartModelRouter:
         Returns:
             Примерное количество токенов (input + expected output)
         """
-        # Грубая оценка: 1 токен ≈ 4 символа для русского/английского
-        message_tokens = len(message) // 4
-        
-        # История диалога
+        message_tokens = token_counter.count(message)
+
+        # История диалога: сохранённые счётчики или подсчёт по тексту
         history_tokens = 0
         if conversation_history:
             for msg in conversation_history[-10:]:  # Последние 10 сообщений
-                history_tokens += len(msg.get("content", "")) // 4
-        
+                history_tokens += msg.get("tokens") or token_counter.count(msg.get("content", ""))
+
         # Ожидаемый ответ (обычно больше чем запрос)
         expected_output_tokens = message_tokens * 2
-        
-        total = message_tokens + history_tokens + expected_output_tokens
-        
-        # Округляем вверх с запасом
-        return int(total * 1.2)
+
+        return message_tokens + history_tokens + expected_output_tokens
     
     def select_optimal_model(
         self,
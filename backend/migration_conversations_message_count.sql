@@ -0,0 +1,10 @@
+-- Счётчик сообщений в диалоге (список диалогов без COUNT по messages)
+ALTER TABLE conversations ADD COLUMN IF NOT EXISTS message_count INTEGER NOT NULL DEFAULT 0;
+
+UPDATE conversations c SET message_count = m.cnt
+FROM (SELECT conversation_id, COUNT(*) AS cnt FROM messages GROUP BY conversation_id) m
+WHERE c.id = m.conversation_id;
+
+-- Keyset-пагинация списка диалогов по (updated_at, id)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_conversations_user_updated
+    ON conversations (user_id, updated_at, id);
@@ -0,0 +1,3 @@
+-- Краткое содержание ранней части диалога (бюджет контекста)
+ALTER TABLE conversations ADD COLUMN IF NOT EXISTS summary TEXT;
+ALTER TABLE conversations ADD COLUMN IF NOT EXISTS summary_upto_id INTEGER;
@@ -0,0 +1,4 @@
+-- Keyset-пагинация истории: (conversation_id, created_at, id) заменяет индекс из migration_messages_retention.sql
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_messages_conversation_created_id
+    ON messages (conversation_id, created_at, id);
+DROP INDEX CONCURRENTLY IF EXISTS ix_messages_conversation_created;
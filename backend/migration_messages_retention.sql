@@ -0,0 +1,3 @@
+-- Индекс для истории диалога и фоновой очистки старых сообщений (retention_service)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_messages_conversation_created
+    ON messages (conversation_id, created_at);
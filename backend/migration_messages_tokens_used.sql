@@ -0,0 +1,7 @@
+-- messages.tokens_used у ответов ассистента теперь хранит только токены ответа (completion).
+-- Раньше туда писался итог всего запроса (prompt + completion): бюджет контекста принимал
+-- его за размер сообщения и отбрасывал лишнюю историю, а оценка резерва завышала длину ответа.
+-- Старые значения обнуляются - context_budget и оценка резерва считают такие сообщения по content.
+-- Выполнить при выкладке, затем сбросить кэш контекста в Redis: redis-cli --scan --pattern 'user:*:conversation:*:context' | xargs -r redis-cli del
+UPDATE messages SET tokens_used = NULL
+WHERE lower(role::text) = 'assistant' AND tokens_used IS NOT NULL;
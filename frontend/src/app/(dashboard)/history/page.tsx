@@ -151,7 +151,7 @@ export default function HistoryPage() {
                         <Calendar size={14} />
                         <span>{formatDate(conv.updated_at)}</span>
                         <span>•</span>
-                        <span>{conv.messages_count || 0} сообщений</span>
+                        <span>{conv.message_count || 0} сообщений</span>
                       </div>
                     </div>
                   </div>
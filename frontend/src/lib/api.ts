@@ -7,6 +7,7 @@ import type {
   SendMessageRequest,
   ChatResponse,
   Conversation,
+  MessagePage,
   SubscriptionPlan,
   Payment,
   ApiError,
@@ -110,6 +111,14 @@ export const chatApi = {
     return response.data;
   },
 
+  // История диалога страницами: before = next_cursor предыдущей страницы
+  getConversationMessages: async (id: number, before?: string, limit = 50): Promise<MessagePage> => {
+    const response = await api.get<MessagePage>(`/chat/conversations/${id}/messages`, {
+      params: { before, limit },
+    });
+    return response.data;
+  },
+
   deleteConversation: async (id: number): Promise<void> => {
     await api.delete(`/chat/conversations/${id}`);
   },
@@ -131,10 +131,13 @@ export const useChatStore = create<ChatState>((set, get) => ({
   loadConversation: async (id: number) => {
     set({ isLoading: true, error: null });
     try {
-      const conversation = await chatApi.getConversation(id);
+      const [conversation, page] = await Promise.all([
+        chatApi.getConversation(id),
+        chatApi.getConversationMessages(id),
+      ]);
       set({
         currentConversation: conversation,
-        messages: conversation.messages || [],
+        messages: page.messages,
         isLoading: false,
       });
     } catch (error: unknown) {
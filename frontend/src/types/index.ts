@@ -60,12 +60,18 @@ export interface Conversation {
   id: number;
   title: string;
   model: string;
-  messages: Message[];
-  messages_count?: number;
+  messages?: Message[];
+  message_count?: number;
   created_at: string;
   updated_at: string;
 }
 
+// Страница истории диалога
+export interface MessagePage {
+  messages: Message[];
+  next_cursor: string | null;
+}
+
 // Запрос на отправку сообщения
 export interface SendMessageRequest {
   message: string;